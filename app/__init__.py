@@ -1,20 +1,60 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_migrate import Migrate
 from config import config_class
+from app.cache import PageCache, RefCache
+from app.database import PoolMonitor, engine_options
+from app.identity import SessionIdentity, VisitLog
+from app.jobs import JobQueue
+from app.limiter import RateLimiter
+from app.offload import Offloader
+from app.passwords import PasswordHasher
+from app.profiler import QueryProfiler
+from app.rates import RateCache
 
 
 db = SQLAlchemy()
+migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.sign_in'
+identity = SessionIdentity()
+visits = VisitLog()
+passwords = PasswordHasher()
+limiter = RateLimiter()
+offload = Offloader()
+jobs = JobQueue()
+ref_cache = RefCache()
+page_cache = PageCache()
+profiler = QueryProfiler()
+pool_monitor = PoolMonitor()
+rates = RateCache()
 
 
 def create_app(config='default'):
     app = Flask(__name__)
     app.config.from_object(config_class[config])
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError('SECRET_KEY is not set')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 
     db.init_app(app)
+    pool_monitor.init_app(app)
+    # Batch mode lets SQLite alter tables by copying them, money columns
+    # are rendered as money.Fixed(places)
+    migrate.init_app(app, db, render_as_batch=True,
+                     user_module_prefix='money.')
     login_manager.init_app(app)
+    identity.init_app(app)
+    visits.init_app(app)
+    passwords.init_app(app)
+    limiter.init_app(app)
+    offload.init_app(app)
+    jobs.init_app(app)
+    ref_cache.init_app(app)
+    page_cache.init_app(app)
+    profiler.init_app(app)
+    rates.init_app(app)
 
     from app.auth import bp as auth_bp
     app.register_blueprint(auth_bp)
@@ -31,6 +71,12 @@ def create_app(config='default'):
     from app.transaction import bp as transaction_bp
     app.register_blueprint(transaction_bp)
 
+    from app.report import bp as report_bp
+    app.register_blueprint(report_bp)
+
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp)
+
     return app
 
 from app import models
@@ -1,17 +1,19 @@
 from flask import render_template, redirect, url_for, flash, abort
 from flask_login import current_user, login_required
 
-from app import db
+from app import db, page_cache, ref_cache
 from app.account import bp
 from app.models import Account, Currency
+from app.money import money
 
 from app.account.forms import NewAccountForm, EditAccountForm
 
 
 @bp.route('/accounts')
 @login_required
+@page_cache.cached()
 def accounts():
-    accounts = current_user.accounts.all()
+    accounts = Account.query.filter_by(user_id=current_user.id).all()
     return render_template('account/accounts.html', accounts=accounts)
 
 
@@ -24,11 +26,13 @@ def new_account():
     if form.validate_on_submit():
         new_account = Account(
             account=form.account.data.strip(),
-            balance=round(float(form.balance.data), 2),
+            balance=money(form.balance.data),
+            opening_balance=money(form.balance.data),
             currency_id=form.currency.data,
             user_id=current_user.id
         )
         db.session.add(new_account)
+        ref_cache.invalidate(current_user.id)
         db.session.commit()
         flash('Account created', 'success')
         return redirect(url_for('main.index'))
@@ -38,7 +42,7 @@ def new_account():
 @bp.route('/account/<int:account_id>', methods=['GET', 'POST'])
 @login_required
 def account(account_id):
-    an_account = Account.query.filter_by(owner=current_user,
+    an_account = Account.query.filter_by(user_id=current_user.id,
                                          id=account_id).first()
     if an_account is None:
         abort(404)
@@ -47,6 +51,7 @@ def account(account_id):
 
     if form.validate_on_submit():
         form.populate_obj(an_account)
+        ref_cache.invalidate(current_user.id)
         db.session.commit()
         flash('Account has been changed', 'success')
         return redirect(url_for('account.accounts'))
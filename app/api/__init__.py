@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint(name='api', import_name=__name__, url_prefix='/api/v1')
+
+from app.api import auth, views
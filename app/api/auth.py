@@ -0,0 +1,70 @@
+"""Token authentication of API.
+
+A client exchanges phone and password for a signed token once, and sends
+it as 'Authorization: Bearer <token>' afterwards. Tokens are checked by
+signature, without a password hash per request. A token stops working
+when it expires (API_TOKEN_MAX_AGE) or the password is changed.
+The browser session is accepted too.
+"""
+from math import ceil
+
+from flask import current_app, jsonify, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from app import db, limiter, login_manager
+from app.api import bp
+from app.models import User
+from app.passwords import PasswordBusy
+
+
+# Unauthorized API requests get 401 instead of redirect to sign in page
+login_manager.blueprint_login_views['api'] = None
+
+
+def serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt='api-token')
+
+
+def make_token(user):
+    # Tail of password hash makes tokens stale after password change
+    return serializer().dumps([user.id, user.password_hash[-8:]])
+
+
+@login_manager.request_loader
+def load_user_from_token(req):
+    header = req.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        user_id, stamp = serializer().loads(
+            header[7:], max_age=current_app.config['API_TOKEN_MAX_AGE'])
+    except (BadSignature, ValueError, TypeError):
+        return None
+    user = db.session.get(User, user_id)
+    if user is None or user.password_hash[-8:] != stamp:
+        return None
+    return user
+
+
+@bp.route('/tokens', methods=['POST'])
+def create_token():
+    """Return token for JSON {"phone": ..., "password": ...}."""
+    data = request.get_json(silent=True) or {}
+    wait = limiter.hit(ip=request.remote_addr,
+                       phone=str(data.get('phone', '')))
+    if wait:
+        response = jsonify(error='Too many attempts, try again later')
+        response.headers['Retry-After'] = str(ceil(wait))
+        return response, 429
+    user = User.query.filter_by(phone=str(data.get('phone', ''))).first()
+    try:
+        # Token is stamped with the hash, so an upgrade must come first
+        valid = user is not None and user.check_password(
+            str(data.get('password', '')), wait_rehash=True)
+    except PasswordBusy:
+        return jsonify(error='Too many requests, try again later'), 503
+    if not valid:
+        return jsonify(error='Invalid phone number or password'), 401
+    return jsonify(token=make_token(user),
+                   expires_in=current_app.config['API_TOKEN_MAX_AGE']), 201
@@ -0,0 +1,346 @@
+"""JSON API over accounts, references, transactions and transfers.
+
+Responses of GET carry an ETag, and a request with matching If-None-Match
+gets 304 without body. ETags of ledger and references are derived from the
+user's versions by app.cache.PageCache, so polling with a current one runs
+no query but the one of the versions.
+
+Transactions and transfers are created one by one (JSON object) or in
+batches (JSON list of up to API_BATCH_SIZE objects).
+A batch is validated as a whole and written in one database transaction
+with aggregated balance updates: it is created entirely or not at all.
+
+Background jobs queued in the browser are polled at /jobs/<id>.
+
+Only requests with JSON content type are read, which browsers can not send
+cross-site without CORS, so the session cookie needs no CSRF token here.
+"""
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from flask import abort, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import desc, or_
+
+from app import db, page_cache, ref_cache
+from app.api import bp
+from app.models import Job, Postings, Transaction, Transfer
+from app.money import CENT, RATE_UNIT
+from app.transaction.importer import Row
+from app.transaction.views import (active_accounts, active_categories,
+                                   active_groups, active_parties,
+                                   make_cursor, parse_cursor)
+
+
+REFERENCES = {
+    'accounts': active_accounts,
+    'groups': active_groups,
+    'categories': active_categories,
+    'parties': active_parties,
+}
+
+MAX_LIMIT = 500
+
+# Larger amounts and coefficients overflow the BigInteger of Fixed(6)
+MAX_NUMBER = Decimal(10) ** 12
+
+
+@bp.errorhandler(400)
+@bp.errorhandler(401)
+@bp.errorhandler(404)
+def error(e):
+    return jsonify(error=e.description), e.code
+
+
+@bp.route('/<kind>', methods=['GET'])
+@login_required
+@page_cache.conditional()
+def references(kind):
+    """Active accounts, groups, categories or parties, most used first."""
+    if kind not in REFERENCES:
+        abort(404, 'Unknown resource')
+    choices = REFERENCES[kind](True)
+    return jsonify({kind: [{'id': i, 'name': name} for i, name in choices]})
+
+
+@bp.route('/transactions', methods=['GET'])
+@login_required
+@page_cache.conditional()
+def transactions():
+    """Transactions newest first, 'limit' at a time. The 'next' cursor of
+    response is passed as 'before' to get older ones.
+    """
+    limit = min(max(request.args.get(
+        'limit', current_app.config['TRANSACTIONS_PER_PAGE'], type=int), 1),
+        MAX_LIMIT)
+    query = db.session.query(Transaction).filter(
+            Transaction.user_id == current_user.id
+        )
+    before = parse_cursor(request.args.get('before'))
+    if before is not None:
+        query = query.filter(or_(
+            Transaction.tdate < before[0],
+            (Transaction.tdate == before[0]) & (Transaction.id < before[1])))
+    rows = query.order_by(
+            desc(Transaction.tdate), desc(Transaction.id)
+        ).limit(limit + 1).all()
+
+    page = rows[:limit]
+    return jsonify({
+        'transactions': [transaction_json(tr) for tr in page],
+        'next': make_cursor(page[-1]) if len(rows) > limit else None
+    })
+
+
+@bp.route('/transactions/<int:tr_id>', methods=['GET'])
+@login_required
+@page_cache.conditional()
+def transaction(tr_id):
+    tr = db.session.query(Transaction).filter(
+            Transaction.id == tr_id,
+            Transaction.user_id == current_user.id
+        ).first()
+    if tr is None:
+        abort(404, 'Transaction not found')
+    return jsonify(transaction_json(tr))
+
+
+@bp.route('/transactions', methods=['POST'])
+@login_required
+def create_transactions():
+    """Create transaction or batch of transactions.
+    Fields: date (yyyy-mm-dd), amount, minus (default true), account_id,
+    group_id, category_id, party_id, comment (optional).
+    """
+    items, batch = payload()
+    ids = {kind: {i for i, _ in loader(True)}
+           for kind, loader in REFERENCES.items()}
+
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        row, item_errors = parse_transaction(item, ids)
+        if item_errors:
+            errors.append({'index': index, 'errors': item_errors})
+        else:
+            rows.append(row)
+    if errors:
+        return jsonify(error='Invalid transactions', items=errors), 400
+
+    # Rows are inserted as one batch (multi-row INSERT where the database
+    # can return ids in order), their effects are summed up per account
+    # and reference and applied with one statement per table
+    postings = Postings()
+    for row in rows:
+        postings.add(row)
+    t = Transaction.__table__
+    new_ids = db.session.execute(
+        t.insert().returning(t.c.id, sort_by_parameter_order=True),
+        [row._asdict() for row in rows]).scalars().all()
+    postings.apply()
+    ref_cache.invalidate(current_user.id)
+    db.session.commit()
+
+    created = [transaction_json(row, tr_id)
+               for row, tr_id in zip(rows, new_ids)]
+    return jsonify(transactions=created) if batch else jsonify(created[0]), \
+        201
+
+
+@bp.route('/transfers', methods=['GET'])
+@login_required
+@page_cache.conditional()
+def transfers():
+    """Transfers newest first, paged like transactions."""
+    limit = min(max(request.args.get(
+        'limit', current_app.config['TRANSACTIONS_PER_PAGE'], type=int), 1),
+        MAX_LIMIT)
+    query = db.session.query(Transfer).filter(
+            Transfer.user_id == current_user.id
+        )
+    before = parse_cursor(request.args.get('before'))
+    if before is not None:
+        query = query.filter(or_(
+            Transfer.tdate < before[0],
+            (Transfer.tdate == before[0]) & (Transfer.id < before[1])))
+    rows = query.order_by(
+            desc(Transfer.tdate), desc(Transfer.id)
+        ).limit(limit + 1).all()
+
+    page = rows[:limit]
+    return jsonify({
+        'transfers': [transfer_json(tf) for tf in page],
+        'next': make_cursor(page[-1]) if len(rows) > limit else None
+    })
+
+
+@bp.route('/transfers', methods=['POST'])
+@login_required
+def create_transfers():
+    """Create transfer or batch of transfers.
+    Fields: date (yyyy-mm-dd), from_account_id, to_account_id, amount,
+    coef (default 1).
+    """
+    items, batch = payload()
+    accounts = {i for i, _ in active_accounts(True)}
+
+    transfers, errors = [], []
+    for index, item in enumerate(items):
+        tf, item_errors = parse_transfer(item, accounts)
+        if item_errors:
+            errors.append({'index': index, 'errors': item_errors})
+        else:
+            transfers.append(tf)
+    if errors:
+        return jsonify(error='Invalid transfers', items=errors), 400
+
+    db.session.add_all(transfers)
+    Transfer.apply([(tf, 1) for tf in transfers])
+    db.session.commit()
+
+    created = [transfer_json(tf) for tf in transfers]
+    return jsonify(transfers=created) if batch else jsonify(created[0]), 201
+
+
+@bp.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job(job_id):
+    """Status, progress and result of background job, see app.jobs."""
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if job is None:
+        abort(404, 'Job not found')
+    return conditional(job.to_dict())
+
+
+# ----------------------------- HELPER FUNCTIONS -----------------------------
+
+def conditional(data):
+    """Return JSON response with ETag of its body, 304 if client has it
+    already.
+    """
+    response = jsonify(data)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def payload():
+    """Return (list of items, True if a list was sent) from JSON body."""
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        return [data], False
+    if not isinstance(data, list) or not data:
+        abort(400, 'JSON object or non-empty list expected')
+    if len(data) > current_app.config['API_BATCH_SIZE']:
+        abort(400, 'At most {} items per request'.format(
+            current_app.config['API_BATCH_SIZE']))
+    return data, True
+
+
+def transaction_json(tr, tr_id=None):
+    return {
+        'id': tr.id if tr_id is None else tr_id,
+        'date': tr.tdate.isoformat(),
+        'amount': str(tr.amount),
+        'minus': tr.minus,
+        'account_id': tr.account_id,
+        'group_id': tr.group_id,
+        'category_id': tr.category_id,
+        'party_id': tr.party_id,
+        'comment': tr.comment,
+    }
+
+
+def transfer_json(tf):
+    return {
+        'id': tf.id,
+        'date': tf.tdate.isoformat(),
+        'from_account_id': tf.from_account_id,
+        'to_account_id': tf.to_account_id,
+        'amount': str(tf.amount),
+        'coef': str(Decimal(tf.coef).normalize()),
+    }
+
+
+def parse_date(value, errors):
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        errors['date'] = 'Date yyyy-mm-dd required'
+
+
+def parse_positive(item, field, errors, unit, default=None):
+    """Return number of field rounded to 'unit', which must be positive
+    after rounding.
+    """
+    value = item.get(field, default)
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        number = None
+    if number is None or not number.is_finite() or number <= 0:
+        errors[field] = 'Positive number required'
+    elif number > MAX_NUMBER:
+        errors[field] = 'At most {} allowed'.format(MAX_NUMBER)
+    else:
+        number = number.quantize(unit, rounding=ROUND_HALF_UP)
+        if number:
+            return number
+        errors[field] = 'Rounds to 0, the smallest value is {}'.format(unit)
+
+
+def parse_id(item, field, allowed, errors):
+    value = item.get(field)
+    if type(value) is not int or value not in allowed:
+        errors[field] = 'Unknown or inactive id'
+    return value
+
+
+def parse_transaction(item, ids):
+    """Return (Row, {}) for valid item, (None, {field: error}) otherwise."""
+    if not isinstance(item, dict):
+        return None, {'item': 'JSON object expected'}
+    errors = {}
+    tdate = parse_date(item.get('date'), errors)
+    amount = parse_positive(item, 'amount', errors, CENT)
+    minus = item.get('minus', True)
+    if not isinstance(minus, bool):
+        errors['minus'] = 'true or false required'
+    comment = item.get('comment') or ''
+    if not isinstance(comment, str) or len(comment) > 128:
+        errors['comment'] = 'String of at most 128 characters required'
+    row = Row(
+        tdate=tdate,
+        amount=amount,
+        minus=minus,
+        user_id=current_user.id,
+        account_id=parse_id(item, 'account_id', ids['accounts'], errors),
+        group_id=parse_id(item, 'group_id', ids['groups'], errors),
+        category_id=parse_id(item, 'category_id', ids['categories'],
+                             errors),
+        party_id=parse_id(item, 'party_id', ids['parties'], errors),
+        comment=comment.strip() if not errors.get('comment') else None
+    )
+    if errors:
+        return None, errors
+    return row, {}
+
+
+def parse_transfer(item, accounts):
+    """Return (Transfer, {}) for valid item, (None, {field: error})
+    otherwise.
+    """
+    if not isinstance(item, dict):
+        return None, {'item': 'JSON object expected'}
+    errors = {}
+    tf = Transfer(
+        tdate=parse_date(item.get('date'), errors),
+        amount=parse_positive(item, 'amount', errors, CENT),
+        coef=parse_positive(item, 'coef', errors, RATE_UNIT, default=1),
+        from_account_id=parse_id(item, 'from_account_id', accounts, errors),
+        to_account_id=parse_id(item, 'to_account_id', accounts, errors),
+        user_id=current_user.id
+    )
+    if not errors and tf.from_account_id == tf.to_account_id:
+        errors['to_account_id'] = 'Accounts must differ'
+    if errors:
+        return None, errors
+    return tf, {}
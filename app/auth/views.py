@@ -1,12 +1,15 @@
-from flask import flash, redirect, render_template, url_for
+from math import ceil
+
+from flask import (flash, make_response, redirect, render_template, request,
+                   url_for)
 from flask_login import login_user, login_required, logout_user, current_user
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime
 
-from app import db
+from app import db, limiter, visits
 from app.auth import bp
 from app.auth.forms import RegisterForm, SignInForm
 from app.models import User
+from app.passwords import PasswordBusy
 
 
 @bp.route('/signup', methods=['GET', 'POST'])
@@ -18,6 +21,9 @@ def sign_up():
     form = RegisterForm()
 
     if form.validate_on_submit():
+        wait = limiter.hit(ip=request.remote_addr)
+        if wait:
+            return throttled('auth/signup.html', form, wait)
         # Lookup for an existing user
         user_exist = User.query.filter_by(phone=form.phone.data).first()
         if user_exist:
@@ -25,7 +31,12 @@ def sign_up():
         else:
             user = User()
             user.phone = form.phone.data
-            user.set_password(form.password.data)
+            try:
+                user.set_password(form.password.data)
+            except PasswordBusy:
+                flash('Too many requests at the moment, try again later',
+                      'warning')
+                return render_template('auth/signup.html', form=form), 503
             try:
                 db.session.add(user)
                 db.session.commit()
@@ -46,9 +57,18 @@ def sign_in():
     form = SignInForm()
 
     if form.validate_on_submit():
+        wait = limiter.hit(ip=request.remote_addr, phone=form.phone.data)
+        if wait:
+            return throttled('auth/signin.html', form, wait)
         user = User.query.filter_by(phone=form.phone.data).first()
 
-        if user and user.check_password(form.password.data):
+        try:
+            valid = user and user.check_password(form.password.data)
+        except PasswordBusy:
+            flash('Too many sign-ins at the moment, try again later',
+                  'warning')
+            return render_template('auth/signin.html', form=form), 503
+        if valid:
             # User login succesfully
             login_user(user, remember=form.remember_me.data)
             set_visit(user)
@@ -67,6 +87,14 @@ def logout():
 
 # ----------------------------- Helper Functions ----------------------------
 def set_visit(user):
-    user.last_seen = datetime.utcnow()
-    user.times_used = user.times_used + 1
-    db.session.commit()
+    visits.record(user.id, sign_in=True)
+
+
+def throttled(template, form, wait):
+    """Return page of refused attempt with Retry-After."""
+    wait = ceil(wait)
+    flash('Too many attempts, try again in {} seconds'.format(wait),
+          'warning')
+    response = make_response(render_template(template, form=form), 429)
+    response.headers['Retry-After'] = str(wait)
+    return response
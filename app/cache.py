@@ -0,0 +1,187 @@
+import hashlib
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+
+class RefCache(object):
+    """Process-local LRU cache of form choices (lists of (id, label) tuples)
+    per user and kind of reference ('accounts', 'groups', ...).
+
+    With REFS_CACHE_VERSIONED every entry is stamped with 'User.refs_version'
+    read at load time. Writers bump the column in their own database
+    transaction, so other worker processes notice the change on the next
+    request of that user and reload.
+    """
+
+    def __init__(self, app=None):
+        self.size = 1024
+        self.versioned = True
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config.get('REFS_CACHE_SIZE', self.size)
+        self.versioned = app.config.get('REFS_CACHE_VERSIONED',
+                                        self.versioned)
+
+    def get(self, user, kind, loader):
+        """Return cached choices of 'kind' for user.
+        Call 'loader' to fetch them on a miss or a stale version.
+        """
+        key = (user.id, kind)
+        version = user.refs_version if self.versioned else 0
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        value = loader()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id):
+        """Drop cached choices of user.
+        With versioning the version bump is left in the session to be
+        committed together with the change that caused it.
+        """
+        self.invalidate_many({user_id})
+
+    def invalidate_many(self, user_ids):
+        """Drop cached choices of users, bumping versions in one UPDATE."""
+        if not user_ids:
+            return
+        with self._lock:
+            for key in [k for k in self._entries if k[0] in user_ids]:
+                del self._entries[key]
+
+        if self.versioned:
+            from app import db, identity
+            from app.models import User
+            db.session.query(User).filter(User.id.in_(user_ids)).update(
+                {User.refs_version: User.refs_version + 1},
+                synchronize_session=False)
+            identity.expire(user_ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PageCache(object):
+    """Conditional GET of read-only pages and process-local LRU cache of
+    their rendered HTML.
+
+    The weak ETag of a page is derived from 'User.ledger_version', bumped
+    by every write of transactions and transfers, and 'User.refs_version',
+    bumped by every change of references and accounts, plus an optional
+    'stamp' of the view. Both counters are read with one narrow query of
+    the user row, so a request with matching If-None-Match gets 304 before
+    the view runs any query of its own. With PAGE_CACHE_SIZE > 0 a page
+    rendered for the same user, URL and ETag is served from memory;
+    conditional() adds the ETag alone, e.g. to responses of the API.
+    """
+
+    def __init__(self, app=None):
+        self.size = 256
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config.get('PAGE_CACHE_SIZE', self.size)
+
+    def cached(self, stamp=None):
+        """Decorate view of GET page depending only on the user's ledger
+        and references. 'stamp' returns anything else the page depends on.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                # Pending flash messages are rendered into the page once
+                if request.method != 'GET' or \
+                        not current_user.is_authenticated or \
+                        '_flashes' in session:
+                    return view(*args, **kwargs)
+
+                etag = self.etag(None if stamp is None else stamp())
+                if request.if_none_match.contains_weak(etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    key = (current_user.id, request.full_path)
+                    body = self.get(key, etag)
+                    if body is None:
+                        response = make_response(view(*args, **kwargs))
+                        if response.status_code != 200 or \
+                                '_flashes' in session:
+                            return response
+                        self.put(key, etag, response.get_data())
+                    else:
+                        response = current_app.response_class(body)
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            return wrapper
+        return decorator
+
+    def conditional(self, stamp=None):
+        """Decorate GET view depending only on the user's ledger and
+        references with the ETag of cached(), without caching its body.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                etag = self.etag(None if stamp is None else stamp())
+                if request.if_none_match.contains_weak(etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            return wrapper
+        return decorator
+
+    def etag(self, stamp=None):
+        """Return ETag of current request from versions of current user,
+        URL and 'stamp', without running the view.
+        """
+        parts = [current_user.id, current_user.ledger_version,
+                 current_user.refs_version, request.full_path]
+        if stamp is not None:
+            parts.append(stamp)
+        return hashlib.md5(repr(parts).encode()).hexdigest()
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def put(self, key, etag, body):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,177 @@
+"""Database engine options, SQLite pragmas and connection pool metrics.
+
+Engine options are derived from DB_* settings for the backend of
+SQLALCHEMY_DATABASE_URI before Flask-SQLAlchemy creates the engine:
+pooled backends (PostgreSQL, file SQLite) get a bounded pool, PostgreSQL
+connections are pre-pinged, recycled and get a statement timeout.
+
+SQLite connections are set up on connect: WAL journal lets readers work
+while one writer commits, synchronous=NORMAL is safe with WAL, mmap
+speeds up reads, and busy_timeout makes writers wait for the lock instead
+of failing with "database is locked".
+"""
+import threading
+
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+def is_sqlite_memory(url):
+    return url.get_backend_name() == 'sqlite' and (
+        url.database in (None, '', ':memory:') or
+        url.query.get('mode') == 'memory')
+
+
+def engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the database of config.
+    Options given in config take precedence.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    # In-memory SQLite lives in its single connection, no pool to tune
+    if is_sqlite_memory(url):
+        return options
+
+    options.setdefault('pool_size', config['DB_POOL_SIZE'])
+    options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+    if url.get_backend_name() == 'sqlite':
+        connect_args = dict(options.get('connect_args') or {})
+        connect_args.setdefault(
+            'timeout', config['DB_SQLITE_BUSY_TIMEOUT'] / 1000)
+        options['connect_args'] = connect_args
+        return options
+
+    options.setdefault('pool_pre_ping', config['DB_POOL_PRE_PING'])
+    options.setdefault('pool_recycle', config['DB_POOL_RECYCLE'])
+    # Most recently used connections first, idle ones time out on server
+    options.setdefault('pool_use_lifo', True)
+    if url.get_backend_name() == 'postgresql' and \
+            config['DB_STATEMENT_TIMEOUT']:
+        connect_args = dict(options.get('connect_args') or {})
+        connect_args.setdefault('options', '-c statement_timeout={}'.format(
+            config['DB_STATEMENT_TIMEOUT']))
+        options['connect_args'] = connect_args
+    return options
+
+
+def sqlite_pragmas(config):
+    """Return connect event listener setting SQLite pragmas."""
+    statements = [
+        'PRAGMA busy_timeout = {:d}'.format(config['DB_SQLITE_BUSY_TIMEOUT']),
+        'PRAGMA synchronous = {}'.format(config['DB_SQLITE_SYNCHRONOUS']),
+        'PRAGMA mmap_size = {:d}'.format(config['DB_SQLITE_MMAP_SIZE']),
+    ]
+    if config['DB_SQLITE_WAL']:
+        statements.insert(0, 'PRAGMA journal_mode = WAL')
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    return on_connect
+
+
+class PoolMonitor(object):
+    """Counts connection pool events of the engine of the app.
+
+    stats() returns pool size, connections checked out and in overflow,
+    the peak of checked out connections, and totals of connects,
+    checkouts and invalidated connections of this process. With
+    DB_POOL_HEADER they are sent in X-DB-Pool response header. Requests
+    that found the pool exhausted are logged.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app import db
+
+        with app.app_context():
+            engine = db.engine
+        if engine.dialect.name == 'sqlite' and \
+                not is_sqlite_memory(engine.url):
+            event.listen(engine, 'connect', sqlite_pragmas(app.config))
+
+        self._pool = engine.pool
+        self._capacity = app.config['DB_POOL_SIZE'] + \
+            app.config['DB_MAX_OVERFLOW']
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+        app.after_request(self._finish)
+        self._header = app.config['DB_POOL_HEADER']
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.invalidated = 0
+            self.checked_out = 0
+            self.peak = 0
+
+    def stats(self):
+        """Return dict of pool metrics of this process."""
+        pool = self._pool
+        with self._lock:
+            result = {
+                'checked_out': self.checked_out,
+                'peak': self.peak,
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidated': self.invalidated,
+            }
+        # Only QueuePool knows its size and overflow
+        if pool is not None and hasattr(pool, 'overflow'):
+            result['size'] = pool.size()
+            result['overflow'] = max(pool.overflow(), 0)
+            result['idle'] = pool.checkedin()
+        return result
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak = max(self.peak, self.checked_out)
+            exhausted = self.checked_out >= self._capacity
+        if exhausted:
+            try:
+                g.db_pool_exhausted = True
+            except RuntimeError:
+                # Outside of application context, e.g. in worker threads
+                pass
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def _finish(self, response):
+        from flask import current_app as app, request
+
+        stats = None
+        if g.pop('db_pool_exhausted', False):
+            stats = self.stats()
+            app.logger.warning('Connection pool exhausted %s %s: %s',
+                               request.method, request.path, stats)
+        if self._header:
+            stats = stats or self.stats()
+            response.headers['X-DB-Pool'] = '; '.join(
+                '{}={}'.format(k, v) for k, v in sorted(stats.items()))
+        return response
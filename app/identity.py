@@ -0,0 +1,201 @@
+"""Identity of signed in users and their visits.
+
+Id, phone and active flag of the signed in user are kept in the signed
+session cookie and read from database again only when they are older than
+USER_SESSION_TTL seconds. The cache versions (refs_version and
+ledger_version) are changed by other sessions, workers and commands at
+any time, so they are read with one narrow query on first use in every
+request, and again after a write of the request bumps them.
+
+Visits (last_seen and number of sign-ins) are collected in memory and
+written by a background thread every VISITS_FLUSH_INTERVAL seconds with
+one batched UPDATE. With interval 0 they are written at once.
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context, session
+from flask_login import UserMixin, current_user, user_logged_in, \
+    user_logged_out
+from sqlalchemy import bindparam
+
+
+SESSION_KEY = '_identity'
+# Columns of User kept in session, in order of SessionUser arguments
+FIELDS = ('id', 'phone', 'is_active')
+
+
+class SessionUser(UserMixin):
+    """Snapshot of User columns, not bound to database session. Versions
+    are read from database when first used.
+    """
+
+    def __init__(self, id, phone, active):
+        self.id = id
+        self.phone = phone
+        self.active = active
+        self._versions = None
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @property
+    def refs_version(self):
+        return self.versions()[0]
+
+    @property
+    def ledger_version(self):
+        return self.versions()[1]
+
+    def versions(self):
+        """Return (refs_version, ledger_version), read once."""
+        if self._versions is None:
+            from app import db
+            from app.models import User
+            row = db.session.query(
+                    User.refs_version, User.ledger_version
+                ).filter(
+                    User.id == self.id
+                ).first()
+            self._versions = tuple(row) if row is not None else (0, 0)
+        return self._versions
+
+    def expire_versions(self):
+        self._versions = None
+
+
+class SessionIdentity(object):
+    """Loads users for Flask-Login from session snapshots."""
+
+    def __init__(self, app=None):
+        self.ttl = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_SESSION_TTL', self.ttl)
+        user_logged_in.connect(self._logged_in, app)
+        user_logged_out.connect(self._logged_out, app)
+
+    def load(self, user_id):
+        """Return SessionUser from session, from database if the snapshot
+        is missing or stale. None if there is no such user.
+        """
+        snapshot = session.get(SESSION_KEY)
+        if snapshot and len(snapshot) == len(FIELDS) + 1 and \
+                snapshot[0] == user_id and \
+                time.time() - snapshot[-1] < self.ttl:
+            return SessionUser(*snapshot[:-1])
+
+        from app import db
+        from app.models import User
+        row = db.session.query(
+                *(getattr(User, f) for f in FIELDS)
+            ).filter(
+                User.id == user_id
+            ).first()
+        if row is None:
+            session.pop(SESSION_KEY, None)
+            return None
+        self.store(row)
+        return SessionUser(*row)
+
+    def store(self, user):
+        session[SESSION_KEY] = [getattr(user, f) for f in FIELDS] + \
+            [int(time.time())]
+
+    def expire(self, user_ids):
+        """Make the signed in user read versions again if it is among
+        'user_ids'.
+        """
+        if has_request_context():
+            user = current_user._get_current_object()
+            if isinstance(user, SessionUser) and user.id in user_ids:
+                user.expire_versions()
+
+    def _logged_in(self, app, user, **kw):
+        self.store(user)
+
+    def _logged_out(self, app, user, **kw):
+        session.pop(SESSION_KEY, None)
+
+
+class VisitLog(object):
+    """Collects last_seen of users and sign-ins, written in batches."""
+
+    def __init__(self, app=None):
+        self.interval = 30
+        self._app = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get('VISITS_FLUSH_INTERVAL',
+                                       self.interval)
+        self._app = app
+        app.after_request(self._after_request)
+
+    def record(self, user_id, sign_in=False):
+        with self._lock:
+            _, count = self._pending.get(user_id, (None, 0))
+            self._pending[user_id] = (datetime.utcnow(), count + sign_in)
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self._start()
+
+    def flush(self):
+        """Write collected visits in one batched UPDATE, in a transaction
+        of its own and not of the request's session. Return number of
+        users updated.
+        """
+        from app import db
+        from app.models import User
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        t = User.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                t.update().where(
+                    t.c.id == bindparam('_id')
+                ).values(
+                    last_seen=bindparam('_seen'),
+                    times_used=t.c.times_used + bindparam('_count')
+                ), [{'_id': k, '_seen': v[0], '_count': v[1]}
+                    for k, v in pending.items()])
+        return len(pending)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='visit-log')
+        self._thread.start()
+        atexit.register(self._flush_in_context)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._flush_in_context()
+            except Exception:
+                self._app.logger.exception('Visits not written')
+
+    def _flush_in_context(self):
+        with self._app.app_context():
+            self.flush()
+
+    def _after_request(self, response):
+        if current_user.is_authenticated:
+            self.record(current_user.id)
+        return response
@@ -0,0 +1,378 @@
+"""Background jobs with the database as broker.
+
+Statement imports, export files and reconciliation run outside of
+requests: enqueue() adds a row to table 'jobs' and worker processes
+started with 'flask worker' run it. A worker takes the oldest due job with
+a conditional UPDATE, so any number of workers share the queue on SQLite
+and PostgreSQL alike and there is no broker to deploy.
+
+Tasks are functions registered with @jobs.task('name'), called with a
+JobRun and the keyword arguments given to enqueue(). They report progress
+with run.progress(done, total) and return a JSON-able result. A task
+raising JobFailed fails at once; other errors are retried after
+JOBS_BACKOFF * 2 ** (attempt - 1) seconds until JOBS_MAX_ATTEMPTS are
+used. A running job whose worker sent no heartbeat for JOBS_LEASE seconds
+is queued again, its worker is taken for dead.
+
+Files of jobs, uploaded statements and exports made, are kept in JOBS_DIR
+shared by web and worker processes, and removed after JOBS_KEEP_DAYS
+together with finished jobs. With JOBS_INLINE jobs run within enqueue(),
+e.g. for testing.
+"""
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_
+from sqlalchemy.exc import OperationalError
+
+
+INLINE_WORKER = 'inline'
+
+
+class JobFailed(Exception):
+    """Job can not succeed, it is not retried."""
+
+
+class JobRun(object):
+    """Job being run, passed to its task."""
+
+    def __init__(self, queue, job_id, user_id, worker):
+        self.queue = queue
+        self.id = job_id
+        self.user_id = user_id
+        self.worker = worker
+        # Message shown when the job is done
+        self.message = None
+        self._reported = 0
+
+    def progress(self, done, total, message=None):
+        """Record 'done' of 'total' at most every JOBS_PROGRESS_INTERVAL
+        seconds. It is written in its own transaction, so call it between
+        transactions of the task: on SQLite a write made meanwhile fails
+        the task's next write.
+        """
+        now = time.monotonic()
+        if done < total and \
+                now - self._reported < self.queue.progress_interval:
+            return
+        self._reported = now
+        values = {'progress': int(done * 100 / total) if total else 0}
+        if message is not None:
+            values['message'] = message[:256]
+        self.queue.touch(self.id, self.worker, **values)
+
+    def path(self, filename):
+        """Return path of file made by the job, creating its directory."""
+        path = self.queue.path(self.id, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+
+class JobQueue(object):
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        self.dir = None
+        self.max_attempts = 3
+        self.backoff = 30
+        self.lease = 600
+        self.poll_interval = 1.0
+        self.progress_interval = 1.0
+        self.keep_days = 7
+        self.inline = False
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dir = app.config.get('JOBS_DIR') or \
+            os.path.join(app.instance_path, 'jobs')
+        self.max_attempts = app.config.get('JOBS_MAX_ATTEMPTS',
+                                           self.max_attempts)
+        self.backoff = app.config.get('JOBS_BACKOFF', self.backoff)
+        self.lease = app.config.get('JOBS_LEASE', self.lease)
+        self.poll_interval = app.config.get('JOBS_POLL_INTERVAL',
+                                            self.poll_interval)
+        self.progress_interval = app.config.get('JOBS_PROGRESS_INTERVAL',
+                                                self.progress_interval)
+        self.keep_days = app.config.get('JOBS_KEEP_DAYS', self.keep_days)
+        self.inline = app.config.get('JOBS_INLINE', self.inline)
+
+    def task(self, name):
+        """Register decorated function as task 'name'."""
+        def decorator(fn):
+            self.tasks[name] = fn
+            return fn
+        return decorator
+
+    def enqueue(self, name, user_id=None, **args):
+        """Queue task 'name' with keyword arguments 'args', which must be
+        JSON-able, and commit the session. Return Job.
+        """
+        from app import db
+        from app.models import Job
+
+        if name not in self.tasks:
+            raise ValueError('Unknown task {!r}'.format(name))
+        # Nobody would run a retry of an inline job
+        job = Job(name=name, args=args, user_id=user_id,
+                  max_attempts=1 if self.inline else self.max_attempts)
+        db.session.add(job)
+        db.session.commit()
+        if self.inline and self.claim(INLINE_WORKER, job.id):
+            self.run(job.id, INLINE_WORKER)
+            db.session.refresh(job)
+        return job
+
+    def claim(self, worker, job_id=None):
+        """Mark the oldest due job, or queued job 'job_id', as run by
+        'worker' and commit. Return its id, None if there is none.
+        """
+        from app import db
+        from app.models import Job
+
+        t = Job.__table__
+        while True:
+            now = datetime.utcnow()
+            candidate = job_id or db.session.query(
+                    Job.id
+                ).filter(
+                    Job.status == 'queued', Job.run_at <= now
+                ).order_by(
+                    Job.run_at, Job.id
+                ).limit(1).scalar()
+            if candidate is None:
+                db.session.rollback()
+                return None
+            # Of workers racing for the same job only one updates it
+            taken = db.session.execute(
+                t.update().where(
+                    t.c.id == candidate, t.c.status == 'queued'
+                ).values(
+                    status='running', worker=worker, heartbeat_at=now,
+                    attempts=t.c.attempts + 1
+                )).rowcount
+            db.session.commit()
+            if taken:
+                return candidate
+            if job_id is not None:
+                return None
+
+    def run(self, job_id, worker):
+        """Run job claimed by 'worker' and record its outcome together with
+        work the task left uncommitted. Return the new status.
+        """
+        from app import db
+        from app.models import Job
+
+        job = db.session.get(Job, job_id)
+        name, args, user_id = job.name, dict(job.args or {}), job.user_id
+        attempts, max_attempts = job.attempts, job.max_attempts
+        db.session.rollback()
+
+        run = JobRun(self, job_id, user_id, worker)
+        try:
+            task = self.tasks.get(name)
+            if task is None:
+                raise JobFailed('Unknown task {!r}'.format(name))
+            result = task(run, **args)
+        except JobFailed as e:
+            db.session.rollback()
+            return self._finish(job_id, worker, 'failed', message=str(e))
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception('Job %s (%s) failed', job_id, name)
+            message = 'Attempt {} of {} failed: {}'.format(
+                attempts, max_attempts, e)
+            if attempts >= max_attempts:
+                return self._finish(job_id, worker, 'failed',
+                                    message=message)
+            delay = self.backoff * 2 ** (attempts - 1)
+            return self._finish(
+                job_id, worker, 'queued', message=message,
+                run_at=datetime.utcnow() + timedelta(seconds=delay))
+        return self._finish(job_id, worker, 'done', progress=100,
+                            result=result, message=run.message)
+
+    def _finish(self, job_id, worker, status, message=None, **values):
+        """Set outcome of job, unless another worker has taken it over,
+        and commit. Return status.
+        """
+        from app import db
+        from app.models import Job
+
+        t = Job.__table__
+        if status != 'queued':
+            values['finished_at'] = datetime.utcnow()
+        db.session.execute(
+            t.update().where(
+                t.c.id == job_id, t.c.worker == worker
+            ).values(
+                status=status, worker=None,
+                message=message and message[:256], **values
+            ))
+        db.session.commit()
+        return status
+
+    def touch(self, job_id, worker, **values):
+        """Set 'values' and heartbeat of job run by 'worker' in a
+        transaction of its own. Return False if the database is locked.
+        """
+        from app import db
+        from app.models import Job
+
+        if worker == INLINE_WORKER:
+            return True
+        t = Job.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    t.update().where(
+                        t.c.id == job_id, t.c.worker == worker
+                    ).values(heartbeat_at=datetime.utcnow(), **values))
+        except OperationalError:
+            current_app.logger.warning('Job %s not updated, database '
+                                       'locked', job_id)
+            return False
+        return True
+
+    def recover(self):
+        """Queue again running jobs without heartbeat for JOBS_LEASE
+        seconds, or fail them if no attempts are left. Return number of
+        jobs.
+        """
+        from app import db
+        from app.models import Job
+
+        t = Job.__table__
+        now = datetime.utcnow()
+        lost = and_(t.c.status == 'running',
+                    t.c.heartbeat_at < now - timedelta(seconds=self.lease))
+        failed = db.session.execute(
+            t.update().where(
+                lost, t.c.attempts >= t.c.max_attempts
+            ).values(
+                status='failed', worker=None, finished_at=now,
+                message='Worker lost'
+            )).rowcount
+        queued = db.session.execute(
+            t.update().where(lost).values(
+                status='queued', worker=None, run_at=now,
+                message='Worker lost, queued again'
+            )).rowcount
+        db.session.commit()
+        return failed + queued
+
+    def purge(self, days=None):
+        """Delete jobs finished more than 'days' (JOBS_KEEP_DAYS) ago with
+        their files, and uploads as old. Return number of jobs.
+        """
+        from app import db
+        from app.models import Job
+
+        days = self.keep_days if days is None else days
+        before = datetime.utcnow() - timedelta(days=days)
+        ids = [r[0] for r in db.session.query(Job.id).filter(
+            Job.finished_at < before)]
+        if ids:
+            db.session.query(Job).filter(Job.id.in_(ids)).delete(
+                synchronize_session=False)
+        db.session.commit()
+        for job_id in ids:
+            shutil.rmtree(os.path.join(self.dir, str(job_id)),
+                          ignore_errors=True)
+
+        incoming = os.path.join(self.dir, 'incoming')
+        if os.path.isdir(incoming):
+            stale = time.time() - days * 86400
+            for entry in os.scandir(incoming):
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+        return len(ids)
+
+    def work(self, worker=None, burst=False):
+        """Run jobs until stop() is called, or until no job is due if
+        'burst'. Return number of jobs run.
+        """
+        worker = worker or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._stop.clear()
+        count = 0
+        recovered = purged = 0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now - recovered > self.lease / 10:
+                self.recover()
+                recovered = now
+            if now - purged > 3600:
+                self.purge()
+                purged = now
+            job_id = self.claim(worker)
+            if job_id is None:
+                if burst:
+                    break
+                self._stop.wait(self.poll_interval)
+                continue
+            with self._heartbeat(job_id, worker):
+                self.run(job_id, worker)
+            count += 1
+        return count
+
+    def stop(self):
+        """Let work() return after the current job."""
+        self._stop.set()
+
+    def stop_on_signals(self):
+        """Stop after the current job on TERM and INT signals."""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: self.stop())
+
+    def path(self, job_id, filename):
+        """Return path of file made by job."""
+        return os.path.join(self.dir, str(job_id), filename)
+
+    def save_upload(self, stream, suffix=''):
+        """Save uploaded file for a job about to be queued, return path."""
+        directory = os.path.join(self.dir, 'incoming')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, uuid.uuid4().hex + suffix)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        return path
+
+    @contextmanager
+    def _heartbeat(self, job_id, worker):
+        """Touch the job every quarter of JOBS_LEASE while it runs."""
+        app = current_app._get_current_object()
+        done = threading.Event()
+
+        def beat():
+            with app.app_context():
+                while not done.wait(self.lease / 4):
+                    self.touch(job_id, worker)
+
+        thread = threading.Thread(target=beat, daemon=True,
+                                  name='job-heartbeat')
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+
+def run_worker(config, burst=False):
+    """Run a worker process: create app by config name and work."""
+    from app import create_app, jobs
+
+    app = create_app(config)
+    with app.app_context():
+        jobs.stop_on_signals()
+        jobs.work(burst=burst)
@@ -0,0 +1,97 @@
+"""Rate limiting of sign-in attempts with token buckets.
+
+A bucket holds up to 'burst' tokens and gains 'burst' tokens per 'period'
+seconds; every attempt takes one and is refused when the bucket is empty.
+Limits are written as 'burst/period', e.g. LOGIN_LIMIT_PER_IP = '20/60'.
+
+Buckets live in RATE_LIMIT_STORE, a class with method
+take(key, burst, period) -> seconds to wait (0 if allowed). The default
+MemoryBucketStore is per process; a shared backend (e.g. Redis) only has
+to provide the same method.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.utils import import_string
+
+
+def parse_limit(limit):
+    """Return (burst, period) of 'burst/period' string, None if empty."""
+    if not limit:
+        return None
+    burst, period = limit.split('/')
+    return int(burst), float(period)
+
+
+class MemoryBucketStore(object):
+    """Buckets as key -> (tokens, time, time when full again). Buckets
+    that are full again are the same as missing ones, so they are dropped
+    every 'sweep' seconds, and the least recently used go beyond 'size'
+    keys.
+    """
+
+    def __init__(self, size=100000, sweep=60):
+        self.size = size
+        self.sweep = sweep
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+    def take(self, key, burst, period):
+        now = time.monotonic()
+        rate = burst / period
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = burst if bucket is None else \
+                min(burst, bucket[0] + (now - bucket[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self._buckets.move_to_end(key)
+            if now - self._swept > self.sweep:
+                self._swept = now
+                for k in [k for k, b in self._buckets.items()
+                          if b[2] <= now]:
+                    del self._buckets[k]
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter(object):
+    """Limits sign-in attempts per client address and per phone."""
+
+    def __init__(self, app=None):
+        self.limits = {}
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limits = {
+            'ip': parse_limit(app.config.get('LOGIN_LIMIT_PER_IP')),
+            'phone': parse_limit(app.config.get('LOGIN_LIMIT_PER_PHONE')),
+        }
+        store = app.config.get('RATE_LIMIT_STORE',
+                               'app.limiter.MemoryBucketStore')
+        self.store = import_string(store)() if isinstance(store, str) \
+            else store
+
+    def hit(self, **keys):
+        """Take a token of every kind=value given, e.g.
+        hit(ip='10.0.0.1', phone='77010000000').
+        Return seconds to wait before the next attempt, 0 if allowed.
+        """
+        wait = 0
+        for kind, value in sorted(keys.items()):
+            limit = self.limits.get(kind)
+            if limit is None or value is None:
+                continue
+            wait = max(wait, self.store.take('{}:{}'.format(kind, value),
+                                             *limit))
+        return wait
@@ -1,27 +1,56 @@
-from flask import flash, redirect, render_template, request, url_for
+from flask import (flash, redirect, render_template, request, url_for,
+                   current_app, abort, send_file)
 from flask_login import current_user, login_required
 from sqlalchemy import asc, func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
-from app import db
+from app import db, jobs, offload, page_cache, rates
 from app.main import bp
-from app.models import Account, Transaction, Category
+from app.models import Account, Category, Job, MonthlyTotal
 
-from datetime import datetime
+from datetime import date, datetime
 
 
 @bp.route('/', methods=['GET', 'POST'])
 @login_required
+@page_cache.cached(lambda: (date.today(), rates.get().stamp))
 def index():
-    accounts = get_accounts()
-    inc = get_income_statistics()
-    return render_template('index.html', accounts=accounts, inc=inc)
+    accounts, inc = offload.gather(get_accounts, get_income_statistics)
+    currency = current_app.config['NET_WORTH_CURRENCY']
+    net_worth, unconverted = rates.get().consolidate(accounts, currency)
+    return render_template('index.html', accounts=accounts, inc=inc,
+                           net_worth='{:,.2f} {}'.format(net_worth, currency),
+                           unconverted=unconverted)
+
+
+@bp.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job(job_id):
+    """Status and progress of background job, refreshed until finished."""
+    job = Job.query.filter_by(id=job_id,
+                              user_id=current_user.id).first_or_404()
+    return render_template('jobs/job.html', job=job)
+
+
+@bp.route('/jobs/<int:job_id>/file', methods=['GET'])
+@login_required
+def job_file(job_id):
+    """Download file made by background job."""
+    job = Job.query.filter_by(id=job_id,
+                              user_id=current_user.id).first_or_404()
+    if job.status != 'done' or not (job.result or {}).get('file'):
+        abort(404)
+    return send_file(jobs.path(job.id, job.result['file']),
+                     as_attachment=True)
 
 
 # ----------------------------- HELPER FUNCTIONS -----------------------------
 
 def get_accounts():
-    accounts = db.session.query(Account).filter(
+    accounts = db.session.query(Account).options(
+            joinedload(Account.currency)
+        ).filter(
             Account.user_id == current_user.id,
             Account.is_active == True
         ).order_by(
@@ -32,22 +61,20 @@ def get_accounts():
 
 def get_income_statistics():
     stat = db.session.query(
-            Transaction.category_id,
-            func.sum(Transaction.amount)
+            Category.category,
+            func.sum(MonthlyTotal.amount)
+        ).join(
+            Category, Category.id == MonthlyTotal.category_id
         ).filter(
-            Transaction.user_id == current_user.id,
-            Transaction.minus == False,
-            Transaction.tdate >= datetime.today().replace(day=1).date()
+            MonthlyTotal.user_id == current_user.id,
+            MonthlyTotal.minus == False,
+            MonthlyTotal.month == datetime.today().replace(day=1).date()
         ).group_by(
-            Transaction.category_id
+            Category.id, Category.category
+        ).having(
+            func.sum(MonthlyTotal.count) > 0
         ).all()
 
-    categories = db.session.query(Category).filter(
-            Category.user_id == current_user.id
-        ).all()
-
-    categories_dict = {c.id: c.category for c in categories}
-
-    result = [(categories_dict[x[0]], '{:,.2f}'.format(x[1])) for x in stat]
+    result = [(x[0], '{:,.2f}'.format(x[1])) for x in stat]
 
     return result
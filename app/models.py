@@ -1,10 +1,28 @@
-from datetime import datetime
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
-from app import db, login_manager
+from app import db, identity, login_manager, passwords
+from app.money import Fixed, money, rate
+from app.passwords import PasswordBusy
 from flask_login import UserMixin
+from sqlalchemy import bindparam, extract, func
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+def month_start(d):
+    """Return first day of month of date d."""
+    return date(d.year, d.month, 1)
+
+
+def next_month(d):
+    """Return first day of month following date d."""
+    if d.month == 12:
+        return date(d.year + 1, 1, 1)
+    return date(d.year, d.month + 1, 1)
 
 
 class BaseFields(object):
@@ -33,14 +51,35 @@ class ExtraFields(object):
     def is_active(self):
         return db.Column(db.Boolean(), default=True, nullable=False)
 
+    @classmethod
+    def use(cls, counts):
+        """Add {id: delta} to 'times_used' in one batched UPDATE.
+        The sum is computed by database, so concurrent requests do not
+        overwrite each other's counters.
+        """
+        params = [{'_id': k, '_used': v} for k, v in counts.items() if v]
+        if params:
+            t = cls.__table__
+            db.session.execute(
+                t.update().where(
+                    t.c.id == bindparam('_id')
+                ).values(
+                    times_used=t.c.times_used + bindparam('_used')
+                ), params)
+
 
 class User(db.Model, BaseFields, ExtraFields, UserMixin):
     __tablename__ = 'users'
     # Every user identidied by mobile phone number
     phone = db.Column(db.String(20), index=True, nullable=False, unique=True)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
     last_seen = db.Column(db.DateTime(), nullable=False,
                           default=datetime.utcnow)
+    # Bumped on every change of references, see app.cache.RefCache
+    refs_version = db.Column(db.Integer(), default=0, nullable=False)
+    # Bumped on every write of transactions and transfers, see
+    # app.cache.PageCache
+    ledger_version = db.Column(db.Integer(), default=0, nullable=False)
     # References
     accounts = db.relationship('Account', backref='owner', lazy='dynamic',
                                cascade="save-update, merge, delete")
@@ -57,17 +96,48 @@ class User(db.Model, BaseFields, ExtraFields, UserMixin):
                                 cascade="save-update, merge, delete")
 
     def set_password(self, new_password):
-        self.password_hash = generate_password_hash(new_password)
+        self.password_hash = passwords.hash(new_password)
+
+    def check_password(self, a_password, wait_rehash=False):
+        """Return True if password is right. Hash of other method or cost
+        is replaced in the background, or before return with
+        'wait_rehash' (password_hash is updated then). The rehash is
+        skipped when the pool is busy. May raise PasswordBusy.
+        """
+        if not passwords.verify(self.password_hash, a_password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            try:
+                future = passwords.rehash_later(self.id, self.password_hash,
+                                                a_password)
+            except PasswordBusy:
+                return True
+            if wait_rehash:
+                set_committed_value(self, 'password_hash', future.result())
+        return True
 
-    def check_password(self, a_password):
-        return check_password_hash(self.password_hash, a_password)
+    @staticmethod
+    def bump_ledger(user_ids):
+        """Bump ledger version of users in one UPDATE."""
+        if user_ids:
+            db.session.query(User).filter(User.id.in_(user_ids)).update(
+                {User.ledger_version: User.ledger_version + 1},
+                synchronize_session=False)
+            identity.expire(user_ids)
 
 
 class Account(db.Model, BaseFields, ExtraFields):
     """Current account for user. User has zero to many accounts."""
     __tablename__ = 'accounts'
+    # Active references of user ordered by use, see active_* helpers
+    __table_args__ = (
+        db.Index('ix_accounts_user_active_used', 'user_id', 'is_active',
+                 'times_used'),
+    )
     account = db.Column(db.String(128), index=True, nullable=False)
-    balance = db.Column(db.Float(), default=0.0, nullable=False)
+    balance = db.Column(Fixed(2), default=0, nullable=False)
+    # Balance given on creation, the ledger is counted from it
+    opening_balance = db.Column(Fixed(2), default=0, nullable=False)
     currency_id = db.Column(db.Integer(), db.ForeignKey('currency.id'),
                             nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
@@ -76,6 +146,24 @@ class Account(db.Model, BaseFields, ExtraFields):
     transactions = db.relationship('Transaction', backref='account',
                                    lazy='dynamic')
 
+    @staticmethod
+    def adjust(changes):
+        """Add {account id: (balance delta, times_used delta)} to accounts
+        in one batched UPDATE computed by database.
+        """
+        params = [{'_id': k, '_balance': v[0], '_used': v[1]}
+                  for k, v in changes.items() if v[1] or v[0]]
+        if params:
+            t = Account.__table__
+            db.session.execute(
+                t.update().where(
+                    t.c.id == bindparam('_id')
+                ).values(
+                    balance=t.c.balance + bindparam('_balance',
+                                                    type_=t.c.balance.type),
+                    times_used=t.c.times_used + bindparam('_used')
+                ), params)
+
     @hybrid_property
     def full_balance(self):
         return '{:,.2f} {}'.format(self.balance, self.currency.currency)
@@ -104,6 +192,10 @@ class Currency(db.Model, BaseFields):
 class Group(db.Model, BaseFields, ExtraFields):
     """Names of income and expenses. Used as general name."""
     __tablename__ = 'groups'
+    __table_args__ = (
+        db.Index('ix_groups_user_active_used', 'user_id', 'is_active',
+                 'times_used'),
+    )
     group = db.Column(db.String(128), index=True, nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
                         nullable=False)
@@ -115,6 +207,10 @@ class Group(db.Model, BaseFields, ExtraFields):
 class Category(db.Model, BaseFields, ExtraFields):
     """Subname for income and expenses. Used as subname for groups."""
     __tablename__ = 'categories'
+    __table_args__ = (
+        db.Index('ix_categories_user_active_used', 'user_id', 'is_active',
+                 'times_used'),
+    )
     category = db.Column(db.String(128), index=True, nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
                         nullable=False)
@@ -125,6 +221,10 @@ class Category(db.Model, BaseFields, ExtraFields):
 
 class Party(db.Model, BaseFields, ExtraFields):
     __tablename__ = 'parties'
+    __table_args__ = (
+        db.Index('ix_parties_user_active_used', 'user_id', 'is_active',
+                 'times_used'),
+    )
     party = db.Column(db.String(128), index=True, nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
                         nullable=False)
@@ -135,8 +235,20 @@ class Party(db.Model, BaseFields, ExtraFields):
 
 class Transaction(db.Model, BaseFields):
     __tablename__ = 'transactions'
+    # Serve the user's ledger ordered by date (keyset pagination) and
+    # the same ledger filtered by account or reference
+    __table_args__ = (
+        db.Index('ix_transactions_user_tdate_id', 'user_id', 'tdate', 'id'),
+        db.Index('ix_transactions_account_tdate_id', 'account_id', 'tdate',
+                 'id'),
+        db.Index('ix_transactions_group_tdate_id', 'group_id', 'tdate',
+                 'id'),
+        db.Index('ix_transactions_category_tdate_id', 'category_id', 'tdate',
+                 'id'),
+        db.Index('ix_transactions_party_tdate_id', 'party_id', 'tdate', 'id'),
+    )
     tdate = db.Column(db.Date(), nullable=False)
-    amount = db.Column(db.Float(), default=0.0, nullable=False)
+    amount = db.Column(Fixed(2), default=0, nullable=False)
     # If minus=True then it is expense
     minus = db.Column(db.Boolean(), default=True, nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
@@ -159,16 +271,82 @@ class Transaction(db.Model, BaseFields):
     def fancy_amount(self):
         return '{:,.2f}'.format(self.amount)
 
+    @staticmethod
+    def apply(entries):
+        """Apply transactions to balances, usage statistics and totals.
+        'entries' are (transaction, sign) pairs: sign=1 posts transaction,
+        sign=-1 takes it back. Changes are left in the session to be
+        committed by the caller.
+        """
+        postings = Postings()
+        for tr, sign in entries:
+            postings.add(tr, sign)
+        postings.apply()
+
+
+class Postings(object):
+    """Accumulates effects of many transactions on account balances, usage
+    statistics of references and monthly totals, and applies them with one
+    aggregated statement per table. Anything with transaction's attributes
+    can be added, so bulk loaders don't have to build ORM objects.
+    """
+
+    def __init__(self):
+        self.accounts = {}
+        self.groups = {}
+        self.categories = {}
+        self.parties = {}
+        self.totals = {}
+        self.checkpoints = {}
+        self.users = set()
+
+    def add(self, tr, sign=1):
+        """Post transaction (sign=1) or take it back (sign=-1)."""
+        amount = sign * money(tr.amount)
+        change = -amount if tr.minus else amount
+        balance, used = self.accounts.get(tr.account_id, (Decimal(0), 0))
+        self.accounts[tr.account_id] = (balance + change, used + sign)
+        key = (tr.account_id, month_start(tr.tdate))
+        self.checkpoints[key] = self.checkpoints.get(key, 0) + change
+        self.groups[tr.group_id] = self.groups.get(tr.group_id, 0) + sign
+        self.categories[tr.category_id] = \
+            self.categories.get(tr.category_id, 0) + sign
+        self.parties[tr.party_id] = self.parties.get(tr.party_id, 0) + sign
+        key = MonthlyTotal.key(tr)
+        total, count = self.totals.get(key, (Decimal(0), 0))
+        self.totals[key] = (total + amount, count + sign)
+        self.users.add(tr.user_id)
+
+    def apply(self):
+        """Write accumulated changes to the session and start over.
+        Changes are left to be committed by the caller.
+        """
+        Account.adjust(self.accounts)
+        Group.use(self.groups)
+        Category.use(self.categories)
+        Party.use(self.parties)
+        MonthlyTotal.add(self.totals)
+        BalanceCheckpoint.shift(self.checkpoints)
+        User.bump_ledger(self.users)
+        self.__init__()
+
 
 class Transfer(db.Model, BaseFields):
     __tablename__ = 'transfers'
+    __table_args__ = (
+        db.Index('ix_transfers_user_tdate', 'user_id', 'tdate'),
+        db.Index('ix_transfers_from_account_tdate', 'from_account_id',
+                 'tdate'),
+        db.Index('ix_transfers_to_account_tdate', 'to_account_id', 'tdate'),
+    )
     from_account_id = db.Column(db.Integer(), db.ForeignKey('accounts.id'),
                                 nullable=False)
     to_account_id = db.Column(db.Integer(), db.ForeignKey('accounts.id'),
                               nullable=False)
     tdate = db.Column(db.Date(), nullable=False)
-    amount = db.Column(db.Float(), default=0.0, nullable=False)
-    coef = db.Column(db.Float(), default=1.0, nullable=False)
+    amount = db.Column(Fixed(2), default=0, nullable=False)
+    # Exchange rate applied to amount for receiving account
+    coef = db.Column(Fixed(6), default=1, nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
                         nullable=False)
     # References
@@ -183,7 +361,487 @@ class Transfer(db.Model, BaseFields):
     def fancy_amount(self):
         return '{:,.2f}'.format(self.amount)
 
+    @hybrid_property
+    def fancy_coef(self):
+        return '{:f}'.format(self.coef.normalize())
+
+    @staticmethod
+    def apply(entries):
+        """Apply transfers to balances of accounts and their checkpoints.
+        'entries' are (transfer, sign) pairs like in Transaction.apply.
+        """
+        accounts, checkpoints, users = {}, {}, set()
+        for tf, sign in entries:
+            users.add(tf.user_id)
+            month = month_start(tf.tdate)
+            # Received amount must follow the coef as stored
+            tf.coef = rate(tf.coef)
+            for account_id, change in (
+                    (tf.from_account_id, -sign * money(tf.amount)),
+                    (tf.to_account_id,
+                     sign * money(Decimal(tf.amount) * tf.coef))):
+                balance, used = accounts.get(account_id, (Decimal(0), 0))
+                accounts[account_id] = (balance + change, used)
+                key = (account_id, month)
+                checkpoints[key] = checkpoints.get(key, 0) + change
+
+        Account.adjust(accounts)
+        BalanceCheckpoint.shift(checkpoints)
+        User.bump_ledger(users)
+
+
+class MonthlyTotal(db.Model, BaseFields):
+    """Transactions summed up per user, month, category, account and
+    direction. Kept up to date by every write of transaction, so statistics
+    read a few pre-summed rows instead of scanning the ledger.
+    """
+    __tablename__ = 'monthly_totals'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'month', 'category_id', 'account_id',
+                            'minus', name='uq_monthly_totals_key'),
+    )
+    user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
+                        nullable=False)
+    # First day of the month
+    month = db.Column(db.Date(), nullable=False)
+    category_id = db.Column(db.Integer(), db.ForeignKey('categories.id'),
+                            nullable=False)
+    account_id = db.Column(db.Integer(), db.ForeignKey('accounts.id'),
+                           nullable=False)
+    minus = db.Column(db.Boolean(), nullable=False)
+    amount = db.Column(Fixed(2), default=0, nullable=False)
+    count = db.Column(db.Integer(), default=0, nullable=False)
+
+    @staticmethod
+    def key(tr):
+        """Return totals key of transaction as tuple
+        (user id, month, category id, account id, minus).
+        """
+        return (tr.user_id, date(tr.tdate.year, tr.tdate.month, 1),
+                tr.category_id, tr.account_id, bool(tr.minus))
+
+    @staticmethod
+    def add(deltas):
+        """Add {key: (amount, count)} to the totals with one batched
+        INSERT ... ON CONFLICT DO UPDATE, so first posts of the same key
+        made at once add up instead of failing on uq_monthly_totals_key.
+        Changes are left in the session to be committed by the caller.
+        """
+        deltas = {k: v for k, v in deltas.items() if v[1] or v[0]}
+        if not deltas:
+            return
+
+        t = MonthlyTotal.__table__
+        if db.session.get_bind().dialect.name == 'postgresql':
+            stmt = postgresql.insert(t)
+        else:
+            stmt = sqlite.insert(t)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[t.c.user_id, t.c.month, t.c.category_id,
+                            t.c.account_id, t.c.minus],
+            set_={'amount': t.c.amount + stmt.excluded.amount,
+                  'count': t.c.count + stmt.excluded.count})
+        db.session.execute(stmt, [
+            dict(user_id=k[0], month=k[1], category_id=k[2],
+                 account_id=k[3], minus=k[4], amount=v[0], count=v[1])
+            for k, v in deltas.items()])
+
+    @staticmethod
+    def rebuild(check_only=False):
+        """Recompute totals from transactions.
+        Return list of (key, stored, actual) for every key that drifted,
+        where stored and actual are (amount, count) tuples.
+        If 'check_only' is False, replace table content by actual totals.
+        """
+        year = extract('year', Transaction.tdate)
+        month = extract('month', Transaction.tdate)
+        rows = db.session.query(
+                Transaction.user_id, year, month, Transaction.category_id,
+                Transaction.account_id, Transaction.minus,
+                func.sum(Transaction.amount), func.count(Transaction.id)
+            ).group_by(
+                Transaction.user_id, year, month, Transaction.category_id,
+                Transaction.account_id, Transaction.minus
+            )
+
+        actual = {}
+        for u, y, m, c, a, minus, amount, count in rows:
+            key = (u, date(int(y), int(m), 1), c, a, bool(minus))
+            actual[key] = (amount, count)
+
+        stored = {}
+        for t in MonthlyTotal.query:
+            if t.count == 0 and t.amount == 0:
+                continue
+            key = (t.user_id, t.month, t.category_id, t.account_id, t.minus)
+            stored[key] = (t.amount, t.count)
+
+        drift = []
+        for key in set(actual) | set(stored):
+            s = stored.get(key, (Decimal(0), 0))
+            a = actual.get(key, (Decimal(0), 0))
+            if s != a:
+                drift.append((key, s, a))
+
+        if not check_only:
+            MonthlyTotal.query.delete()
+            if actual:
+                db.session.execute(MonthlyTotal.__table__.insert(), [
+                        dict(user_id=k[0], month=k[1], category_id=k[2],
+                             account_id=k[3], minus=k[4],
+                             amount=v[0], count=v[1])
+                        for k, v in actual.items()
+                    ])
+            db.session.commit()
+
+        return sorted(drift, key=lambda d: d[0])
+
+
+class BalanceCheckpoint(db.Model, BaseFields):
+    """Balance of account at the end of month, so balance on any date is
+    found from the nearest checkpoint plus rows dated after it instead of
+    replaying the whole history. Checkpoints are created by 'refresh' for
+    past months and shifted by every back-dated change of transactions and
+    transfers.
+    """
+    __tablename__ = 'balance_checkpoints'
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'month',
+                            name='uq_balance_checkpoints_key'),
+    )
+    account_id = db.Column(db.Integer(), db.ForeignKey('accounts.id'),
+                           nullable=False)
+    # First day of the month, balance is as of its last day
+    month = db.Column(db.Date(), nullable=False)
+    balance = db.Column(Fixed(2), default=0, nullable=False)
+
+    @staticmethod
+    def shift(changes):
+        """Add {(account id, month): balance change} to checkpoints of the
+        month and all later ones with one batched UPDATE.
+        Changes are left in the session to be committed by the caller.
+        """
+        params = [{'_account': k[0], '_month': k[1], '_change': v}
+                  for k, v in changes.items() if v]
+        if params:
+            t = BalanceCheckpoint.__table__
+            db.session.execute(
+                t.update().where(
+                    t.c.account_id == bindparam('_account')
+                ).where(
+                    t.c.month >= bindparam('_month')
+                ).values(
+                    balance=t.c.balance + bindparam('_change',
+                                                    type_=t.c.balance.type)
+                ), params)
+
+    @staticmethod
+    def movement(account_id, start=None, end=None):
+        """Return net change of account balance by transactions and
+        transfers dated from 'start' to 'end' inclusive (None is open end).
+        """
+        def dated(query, column):
+            if start is not None:
+                query = query.filter(column >= start)
+            if end is not None:
+                query = query.filter(column <= end)
+            return query
+
+        change = Decimal(0)
+        rows = dated(db.session.query(
+                Transaction.minus, func.sum(Transaction.amount)
+            ).filter(
+                Transaction.account_id == account_id
+            ), Transaction.tdate).group_by(Transaction.minus)
+        for minus, amount in rows:
+            change += -amount if minus else amount
+
+        sent = dated(db.session.query(
+                func.sum(Transfer.amount)
+            ).filter(
+                Transfer.from_account_id == account_id
+            ), Transfer.tdate).scalar()
+        change -= sent or 0
+
+        # Received amount is rounded per transfer, so sum it up in Python
+        received = dated(db.session.query(
+                Transfer.amount, Transfer.coef
+            ).filter(
+                Transfer.to_account_id == account_id
+            ), Transfer.tdate)
+        for amount, coef in received:
+            change += money(amount * coef)
+        return change
+
+    @staticmethod
+    def balance_on(account, on_date):
+        """Return balance of account at the end of 'on_date'."""
+        cp = BalanceCheckpoint.query.filter(
+                BalanceCheckpoint.account_id == account.id,
+                BalanceCheckpoint.month < month_start(
+                    on_date + timedelta(days=1))
+            ).order_by(
+                BalanceCheckpoint.month.desc()
+            ).first()
+        if cp is not None:
+            return cp.balance + BalanceCheckpoint.movement(
+                account.id, start=next_month(cp.month), end=on_date)
+        # No checkpoint yet, go back from current balance
+        return account.balance - BalanceCheckpoint.movement(
+            account.id, start=on_date + timedelta(days=1))
+
+    @staticmethod
+    def history(account_id):
+        """Return list of (month, balance at its end) of account."""
+        return db.session.query(
+                BalanceCheckpoint.month, BalanceCheckpoint.balance
+            ).filter(
+                BalanceCheckpoint.account_id == account_id
+            ).order_by(
+                BalanceCheckpoint.month
+            ).all()
+
+    @staticmethod
+    def refresh(until=None):
+        """Recreate checkpoints of all accounts for every month with
+        movements before 'until' (first day of current month by default).
+        Return number of checkpoints.
+        """
+        until = month_start(until or date.today())
+        changes = {}
+
+        def add(account_id, year, month, change):
+            key = (account_id, date(int(year), int(month), 1))
+            changes[key] = changes.get(key, 0) + change
+
+        year = extract('year', Transaction.tdate)
+        month = extract('month', Transaction.tdate)
+        for account_id, y, m, minus, amount in db.session.query(
+                Transaction.account_id, year, month, Transaction.minus,
+                func.sum(Transaction.amount)
+                ).group_by(Transaction.account_id, year, month,
+                           Transaction.minus):
+            add(account_id, y, m, -amount if minus else amount)
+
+        year = extract('year', Transfer.tdate)
+        month = extract('month', Transfer.tdate)
+        for account_id, y, m, amount in db.session.query(
+                Transfer.from_account_id, year, month,
+                func.sum(Transfer.amount)
+                ).group_by(Transfer.from_account_id, year, month):
+            add(account_id, y, m, -amount)
+        for account_id, tdate, amount, coef in db.session.query(
+                Transfer.to_account_id, Transfer.tdate, Transfer.amount,
+                Transfer.coef).yield_per(1000):
+            add(account_id, tdate.year, tdate.month, money(amount * coef))
+
+        by_account = {}
+        for (account_id, month), change in changes.items():
+            by_account.setdefault(account_id, []).append((month, change))
+
+        rows = []
+        balances = dict(db.session.query(Account.id, Account.balance))
+        for account_id, months in by_account.items():
+            # Current balance is the balance at the end of the latest month,
+            # walk back taking changes of months off one by one
+            balance = balances[account_id]
+            for month, change in sorted(months, reverse=True):
+                if month < until:
+                    rows.append(dict(account_id=account_id, month=month,
+                                     balance=balance))
+                balance -= change
+
+        BalanceCheckpoint.query.delete()
+        if rows:
+            db.session.execute(BalanceCheckpoint.__table__.insert(), rows)
+        db.session.commit()
+        return len(rows)
+
+
+class ExchangeRate(db.Model, BaseFields):
+    """Price of one unit of 'base' currency in 'quote' currency on date.
+    Loaded from files, see app.rates.
+    """
+    __tablename__ = 'exchange_rates'
+    __table_args__ = (
+        db.UniqueConstraint('base_id', 'quote_id', 'rdate',
+                            name='uq_exchange_rates_key'),
+    )
+    base_id = db.Column(db.Integer(), db.ForeignKey('currency.id'),
+                        nullable=False)
+    quote_id = db.Column(db.Integer(), db.ForeignKey('currency.id'),
+                         nullable=False)
+    rdate = db.Column(db.Date(), nullable=False)
+    rate = db.Column(Fixed(8), nullable=False)
+    # References
+    base = db.relationship('Currency', foreign_keys=[base_id])
+    quote = db.relationship('Currency', foreign_keys=[quote_id])
+
+    @staticmethod
+    def load(rates):
+        """Insert or replace [(base code, quote code, date, rate)] with one
+        lookup of existing rows, one batched UPDATE and one batched INSERT.
+        Unknown currencies are created. Return number of rates.
+        Changes are left in the session to be committed by the caller.
+        """
+        currencies = dict(db.session.query(Currency.currency, Currency.id))
+        for code in {r[0] for r in rates} | {r[1] for r in rates}:
+            if code not in currencies:
+                new = Currency(currency=code)
+                db.session.add(new)
+                db.session.flush()
+                currencies[code] = new.id
+
+        values = {(currencies[b], currencies[q], d): r
+                  for b, q, d, r in rates}
+        if not values:
+            return 0
+        existing = {}
+        rows = db.session.query(
+                ExchangeRate.id, ExchangeRate.base_id, ExchangeRate.quote_id,
+                ExchangeRate.rdate
+            ).filter(
+                ExchangeRate.rdate.between(min(k[2] for k in values),
+                                           max(k[2] for k in values))
+            )
+        for row in rows:
+            existing[(row[1], row[2], row[3])] = row[0]
+
+        t = ExchangeRate.__table__
+        updates = [{'_id': existing[k], '_rate': v}
+                   for k, v in values.items() if k in existing]
+        inserts = [dict(base_id=k[0], quote_id=k[1], rdate=k[2], rate=v)
+                   for k, v in values.items() if k not in existing]
+        if updates:
+            db.session.execute(
+                t.update().where(
+                    t.c.id == bindparam('_id')
+                ).values(
+                    rate=bindparam('_rate', type_=t.c.rate.type)
+                ), updates)
+        if inserts:
+            db.session.execute(t.insert(), inserts)
+        return len(values)
+
+
+class RecurringTransaction(db.Model, BaseFields):
+    """Rule creating the same transaction every 'interval' days, weeks,
+    months or years from 'start_date' until 'end_date', see
+    app.transaction.scheduler. Monthly and yearly occurrences keep the day
+    of 'start_date', moved to the last day of shorter months.
+    """
+    __tablename__ = 'recurring_transactions'
+    FREQUENCIES = ('daily', 'weekly', 'monthly', 'yearly')
+
+    frequency = db.Column(db.String(10), nullable=False, default='monthly')
+    interval = db.Column(db.Integer(), nullable=False, default=1)
+    start_date = db.Column(db.Date(), nullable=False)
+    end_date = db.Column(db.Date())
+    # Next occurrence to create and its number counted from 0
+    next_date = db.Column(db.Date(), index=True, nullable=False)
+    sequence = db.Column(db.Integer(), nullable=False, default=0)
+    is_active = db.Column(db.Boolean(), default=True, nullable=False)
+    # Transaction to create
+    amount = db.Column(Fixed(2), default=0, nullable=False)
+    minus = db.Column(db.Boolean(), default=True, nullable=False)
+    user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
+                        index=True, nullable=False)
+    account_id = db.Column(db.Integer(), db.ForeignKey('accounts.id'),
+                           nullable=False)
+    group_id = db.Column(db.Integer(), db.ForeignKey('groups.id'),
+                         nullable=False)
+    category_id = db.Column(db.Integer(), db.ForeignKey('categories.id'),
+                            nullable=False)
+    party_id = db.Column(db.Integer(), db.ForeignKey('parties.id'),
+                         nullable=False)
+    comment = db.Column(db.String(128))
+    # References
+    account = db.relationship('Account')
+    party = db.relationship('Party')
+
+    def occurrence(self, n):
+        """Return date of occurrence number n."""
+        start = self.start_date
+        if self.frequency == 'daily':
+            return start + timedelta(days=n * self.interval)
+        if self.frequency == 'weekly':
+            return start + timedelta(weeks=n * self.interval)
+        months = n * self.interval * (12 if self.frequency == 'yearly'
+                                      else 1)
+        year, month = divmod(start.month - 1 + months, 12)
+        year += start.year
+        return date(year, month + 1,
+                    min(start.day, monthrange(year, month + 1)[1]))
+
+    @hybrid_property
+    def fancy_amount(self):
+        return '{:,.2f}'.format(self.amount)
+
+    @hybrid_property
+    def fancy_next_date(self):
+        return datetime.strftime(self.next_date, '%d.%m.%Y')
+
+
+class RecurringOccurrence(db.Model):
+    """Key of occurrence created by recurring transaction. Kept when the
+    created transaction is deleted, so it is not created again.
+    """
+    __tablename__ = 'recurring_occurrences'
+    recurring_id = db.Column(db.Integer(),
+                             db.ForeignKey('recurring_transactions.id',
+                                           ondelete='CASCADE'),
+                             primary_key=True)
+    odate = db.Column(db.Date(), primary_key=True)
+
+
+class Job(db.Model, BaseFields):
+    """Background job, see app.jobs. The table is the queue: workers take
+    'queued' jobs due by 'run_at' and mark them 'running', then 'done' or
+    'failed', or 'queued' again with a later 'run_at' to retry.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+    STATUSES = ('queued', 'running', 'done', 'failed')
+
+    name = db.Column(db.String(64), nullable=False)
+    args = db.Column(db.JSON())
+    user_id = db.Column(db.Integer(), db.ForeignKey('users.id'),
+                        index=True)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    run_at = db.Column(db.DateTime(), nullable=False,
+                       default=datetime.utcnow)
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    max_attempts = db.Column(db.Integer(), nullable=False, default=3)
+    # Worker running the job and its last sign of life
+    worker = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime())
+    # Percent done and last progress, retry or error message
+    progress = db.Column(db.Integer(), nullable=False, default=0)
+    message = db.Column(db.String(256))
+    result = db.Column(db.JSON())
+    finished_at = db.Column(db.DateTime())
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'result': self.result,
+            'attempts': self.attempts,
+            'created_at': self.created_at.isoformat(),
+            'run_at': self.run_at.isoformat(),
+            'finished_at': self.finished_at and self.finished_at.isoformat(),
+        }
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity.load(int(user_id))
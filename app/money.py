@@ -0,0 +1,132 @@
+"""Exact money arithmetic.
+
+Amounts are stored as integers of minor units (cents) and seen from Python
+as Decimal, so sums done either by database or in Python never drift.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import BigInteger, MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import sqltypes
+from sqlalchemy.types import TypeDecorator
+
+
+CENT = Decimal('0.01')
+# Exchange rates of transfers are kept in millionths, see Transfer.coef
+RATE_UNIT = Decimal('0.000001')
+
+
+def money(value):
+    """Return value as Decimal rounded to cents."""
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def rate(value):
+    """Return exchange rate as Decimal rounded to millionths, the value
+    stored in Transfer.coef.
+    """
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(RATE_UNIT, rounding=ROUND_HALF_UP)
+
+
+class Fixed(TypeDecorator):
+    """Fixed-point number with 'places' digits after point stored as
+    integer, e.g. Fixed(2) keeps 12.34 as 1234.
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def __init__(self, places=2):
+        super().__init__()
+        self.places = places
+
+    def __repr__(self):
+        return 'Fixed({})'.format(self.places)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return int(value.scaleb(self.places).quantize(
+            Decimal(1), rounding=ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(int(value)).scaleb(-self.places)
+
+    def coerce_compared_value(self, op, value):
+        return self
+
+
+def money_columns(metadata):
+    """Return {table name: {column name: places}} of Fixed columns."""
+    result = {}
+    for table in metadata.sorted_tables:
+        for column in table.columns:
+            if isinstance(column.type, Fixed):
+                result.setdefault(table.name, {})[column.name] = \
+                    column.type.places
+    return result
+
+
+def migrate_float_columns(engine, metadata):
+    """Convert money columns still stored as floats into integers of minor
+    units. Tables already converted or not created yet are skipped, so it
+    is safe to run more than once. Return names of converted tables.
+    """
+    converted = []
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    for name, columns in money_columns(metadata).items():
+        if name not in existing:
+            continue
+        types = {c['name']: c['type'] for c in inspector.get_columns(name)}
+        to_convert = {c: places for c, places in columns.items()
+                      if c in types and
+                      not isinstance(types[c], sqltypes.Integer)}
+        if not to_convert:
+            continue
+
+        table = metadata.tables[name]
+        with engine.begin() as conn:
+            if engine.dialect.name == 'sqlite':
+                _rebuild_sqlite_table(conn, table, to_convert)
+            else:
+                for column, places in to_convert.items():
+                    conn.execute(text(
+                        'ALTER TABLE {t} ALTER COLUMN {c} TYPE BIGINT '
+                        'USING round({c} * {scale})'.format(
+                            t=name, c=column, scale=10 ** places)))
+        converted.append(name)
+    return converted
+
+
+def _rebuild_sqlite_table(conn, table, to_convert):
+    """SQLite can't change column type, so copy rows into a table with new
+    schema, drop the old one and rename the new one in place.
+    """
+    name = table.name
+    quote = conn.dialect.identifier_preparer.quote
+    # Copy of the whole schema lets foreign keys of the new table resolve
+    metadata = MetaData()
+    for other in table.metadata.tables.values():
+        other.to_metadata(metadata)
+    new = table.to_metadata(metadata, name='_new_' + name)
+    conn.execute(CreateTable(new))
+    columns = [c.name for c in table.columns]
+    values = ['CAST(round({c} * {scale}) AS INTEGER)'.format(
+                  c=quote(c), scale=10 ** to_convert[c])
+              if c in to_convert else quote(c) for c in columns]
+    columns = [quote(c) for c in columns]
+    conn.execute(text('INSERT INTO _new_{t} ({cols}) SELECT {vals} '
+                      'FROM {t}'.format(t=name, cols=', '.join(columns),
+                                        vals=', '.join(values))))
+    conn.execute(text('DROP TABLE {}'.format(name)))
+    conn.execute(text('ALTER TABLE _new_{t} RENAME TO {t}'.format(t=name)))
+    for index in table.indexes:
+        index.create(conn)
@@ -0,0 +1,141 @@
+"""Slow database work in a bounded thread pool.
+
+Views with several independent queries run them at the same time with
+gather(), exports are produced by a pool thread ahead of the socket
+writes with stream(). Every job runs in a copy of the request context
+with an app context of its own, so queries made within the job use a
+database session of the pool thread. A Query built in the request thread
+stays bound to the request's session, which is closed at teardown: build
+queries inside the job.
+
+The pool has OFFLOAD_WORKERS threads per process and takes at most
+OFFLOAD_QUEUE more jobs waiting; requests beyond that get 503 at once.
+So slow endpoints can not take all server threads and database
+connections from the rest. A stream holds its thread for as long as the
+client takes to download, so streams have a pool of their own with
+OFFLOAD_STREAMS threads and no queue: slow downloads can not make gather()
+of other pages fail.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import abort, copy_current_request_context, has_request_context
+
+
+class Busy(Exception):
+    """Pool and its queue are full."""
+
+
+class BoundedExecutor(object):
+    """ThreadPoolExecutor refusing jobs beyond 'workers' + 'queue'."""
+
+    def __init__(self, workers, queue, name):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args), return Future. Raise Busy if full."""
+        if not self._slots.acquire(blocking=False):
+            raise Busy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+
+class Offloader(object):
+
+    def __init__(self, app=None):
+        self.workers = 4
+        self.queue = 16
+        self.streams = 4
+        self.buffer = 8
+        self._executor = None
+        self._stream_executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config.get('OFFLOAD_WORKERS', self.workers)
+        self.queue = app.config.get('OFFLOAD_QUEUE', self.queue)
+        self.streams = app.config.get('OFFLOAD_STREAMS', self.streams)
+        self.buffer = app.config.get('OFFLOAD_STREAM_BUFFER', self.buffer)
+
+    def submit(self, fn, stream=False):
+        """Schedule fn() with copy of the request context, return Future.
+        Abort with 503 if the pool, of streams if 'stream', is full.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = BoundedExecutor(self.workers, self.queue,
+                                                 'offload')
+                self._stream_executor = BoundedExecutor(
+                    self.streams, 0, 'offload-stream')
+        executor = self._stream_executor if stream else self._executor
+        if has_request_context():
+            fn = copy_current_request_context(fn)
+        try:
+            return executor.submit(fn)
+        except Busy:
+            abort(503)
+
+    def gather(self, *calls):
+        """Run callables at the same time, return list of their results.
+        ORM objects returned are detached: their loaded attributes can be
+        read, relationships must be loaded eagerly.
+        """
+        futures = [self.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    def stream(self, chunks):
+        """Return generator of 'chunks' (a generator) produced in the pool
+        of streams up to OFFLOAD_STREAM_BUFFER chunks ahead. Closing it
+        stops the producer. Queries of 'chunks' must be built on its first
+        iteration, not before.
+        """
+        buffer = queue.Queue(self.buffer)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if not put(chunk):
+                        break
+            except Exception as e:
+                put(e)
+            else:
+                put(done)
+            finally:
+                chunks.close()
+
+        future = self.submit(produce, stream=True)
+
+        def consume():
+            try:
+                while True:
+                    item = buffer.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                stop.set()
+                future.result()
+        return consume()
@@ -0,0 +1,133 @@
+"""Password hashing off the request threads.
+
+Hashes are computed with werkzeug by PASSWORD_METHOD, e.g.
+'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'; the cost fitting a latency
+target on a given machine is found with 'flask password-bench'.
+
+Hashing runs in a pool of PASSWORD_WORKERS threads per process, so a burst
+of sign-ins keeps at most that many CPUs busy while other requests go on.
+At most PASSWORD_QUEUE more wait for the pool, further ones fail at once
+with PasswordBusy instead of piling up.
+
+A hash made by another method or cost is replaced after the next
+successful sign-in, in the background.
+"""
+import threading
+import time
+
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS,
+                               check_password_hash, generate_password_hash)
+
+from app.offload import BoundedExecutor, Busy
+
+
+class PasswordBusy(Busy):
+    """Too many passwords being hashed, try later."""
+
+
+class PasswordHasher(object):
+
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.queue = 16
+        self._app = None
+        self._prefix = method_prefix(self.method)
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_WORKERS', self.workers)
+        self.queue = app.config.get('PASSWORD_QUEUE', self.queue)
+        self._app = app
+        self._prefix = method_prefix(self.method)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Return True if hash was made by other method or cost."""
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def rehash_later(self, user_id, pwhash, password):
+        """Replace hash of user in the background, unless it is changed
+        in the meantime. Return Future.
+        """
+        return self.submit(self._rehash, user_id, pwhash, password)
+
+    def run(self, fn, *args):
+        """Call fn(*args) in the pool and return its result."""
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args) in the pool, raise PasswordBusy if the pool
+        and its queue are full.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = BoundedExecutor(self.workers, self.queue,
+                                                 'password')
+        try:
+            return self._executor.submit(fn, *args)
+        except Busy:
+            raise PasswordBusy()
+
+    def _rehash(self, user_id, pwhash, password):
+        from app import db
+        from app.models import User
+
+        new_hash = generate_password_hash(password, self.method)
+        with self._app.app_context():
+            t = User.__table__
+            db.session.execute(
+                t.update().where(
+                    t.c.id == user_id,
+                    t.c.password_hash == pwhash
+                ).values(password_hash=new_hash))
+            db.session.commit()
+        return new_hash
+
+
+def method_prefix(method):
+    """Return method as werkzeug writes it into hashes, with defaults of
+    omitted arguments filled in, e.g. 'scrypt' as 'scrypt:32768:8:1'.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if len(args) not in (0, 3):
+            raise ValueError("'scrypt' takes 3 arguments")
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return 'scrypt:{}:{}:{}'.format(n, r, p)
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments")
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else \
+            DEFAULT_PBKDF2_ITERATIONS
+        return 'pbkdf2:{}:{}'.format(hash_name, iterations)
+    raise ValueError('Invalid hash method {!r}'.format(method))
+
+
+def benchmark(method, target, rounds=3):
+    """Yield (method string, seconds per hash) for growing costs of
+    'scrypt' or 'pbkdf2' until a hash takes longer than 'target' seconds.
+    """
+    if method == 'scrypt':
+        candidates = ('scrypt:{}:8:1'.format(2 ** k) for k in range(12, 21))
+    else:
+        candidates = ('pbkdf2:sha256:{}'.format(100000 * 2 ** k)
+                      for k in range(8))
+    for candidate in candidates:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            generate_password_hash('benchmark', candidate)
+        elapsed = (time.perf_counter() - started) / rounds
+        yield candidate, elapsed
+        if elapsed > target:
+            break
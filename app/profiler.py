@@ -0,0 +1,106 @@
+import re
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from markupsafe import escape
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Literals and lists of bound parameters do not make statements different
+_FINGERPRINT = [
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+\b'), '?'),
+    (re.compile(r'\(\s*(?:\?|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))*'
+                r'\s*\)'), '(...)'),
+]
+
+
+def fingerprint(statement):
+    """Return statement with literals and parameter lists collapsed."""
+    for pattern, replacement in _FINGERPRINT:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class QueryProfiler(object):
+    """Counts SQL statements and time spent in database per request.
+
+    Statements repeated SQL_PROFILER_DUPLICATES times or more within one
+    request are reported as N+1 suspects. Totals are sent in X-SQL-Queries
+    and Server-Timing response headers, optionally as HTML footer, and
+    requests exceeding SQL_PROFILER_MAX_QUERIES or SQL_PROFILER_MAX_TIME
+    are logged.
+    """
+    _listening = False
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('SQL_PROFILER'):
+            return
+        if not QueryProfiler._listening:
+            event.listen(Engine, 'before_cursor_execute', _before_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_execute)
+            QueryProfiler._listening = True
+        app.before_request(_start)
+        app.after_request(_finish)
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    started = conn.info['profiler_start'].pop()
+    if has_request_context():
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.append((statement, time.perf_counter() - started))
+
+
+def _start():
+    g.sql_profile = []
+
+
+def _finish(response):
+    from flask import current_app as app
+
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+
+    count = len(profile)
+    total = sum(t for _, t in profile)
+    repeated = Counter(fingerprint(s) for s, _ in profile)
+    duplicates = [(s, n) for s, n in repeated.most_common()
+                  if n >= app.config['SQL_PROFILER_DUPLICATES']]
+
+    if app.config['SQL_PROFILER_HEADER']:
+        response.headers['X-SQL-Queries'] = '{}; time={:.1f}ms; ' \
+            'duplicates={}'.format(count, total * 1000, len(duplicates))
+        response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} '
+                             'queries"'.format(total * 1000, count))
+
+    if app.config['SQL_PROFILER_FOOTER'] and \
+            response.mimetype == 'text/html' and not response.is_streamed:
+        footer = '<pre class="sql-profile">{} queries, {:.1f} ms{}</pre>' \
+            .format(count, total * 1000, ''.join(
+                '\n{} x {}'.format(n, escape(s)) for s, n in duplicates))
+        body = response.get_data(as_text=True)
+        response.set_data(body.replace('</body>', footer + '</body>', 1))
+
+    if count > app.config['SQL_PROFILER_MAX_QUERIES'] or \
+            total > app.config['SQL_PROFILER_MAX_TIME'] or duplicates:
+        app.logger.warning(
+            'SQL profile %s %s: %d queries, %.1f ms%s', request.method,
+            request.path, count, total * 1000, ''.join(
+                '\n  possible N+1, {} x {}'.format(n, s)
+                for s, n in duplicates))
+    return response
@@ -0,0 +1,181 @@
+"""Exchange rates in memory.
+
+Rates of every currency pair are kept as parallel lists of sorted dates
+and rates, and the rate on a date is found with bisect: the latest one
+known on or before that date. Pairs not loaded are derived from the
+inverse pair or through one intermediate currency.
+"""
+import csv
+import hashlib
+import time
+from bisect import bisect_right
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from threading import Lock
+
+from sqlalchemy.orm import aliased
+
+from app.money import money
+
+
+# Smallest and largest rates ExchangeRate.rate, Fixed(8) in a BigInteger,
+# can hold
+RATE_UNIT = Decimal('0.00000001')
+MAX_RATE = Decimal(10) ** 10
+
+
+class RateTable(object):
+    """Rates by (base code, quote code), see ExchangeRate."""
+
+    def __init__(self):
+        self._dates = {}
+        self._rates = {}
+        # Digest of rates loaded, the same for the same rates
+        self.stamp = ''
+
+    def add(self, base, quote, rdate, rate):
+        """Add rate. Rates of a pair must be added in order of dates."""
+        self._dates.setdefault((base, quote), []).append(rdate)
+        self._rates.setdefault((base, quote), []).append(Decimal(rate))
+
+    @classmethod
+    def load(cls):
+        """Return table of all rates read from database in one query."""
+        from app import db
+        from app.models import Currency, ExchangeRate
+
+        base = aliased(Currency)
+        quote = aliased(Currency)
+        rows = db.session.query(
+                base.currency, quote.currency, ExchangeRate.rdate,
+                ExchangeRate.rate
+            ).join(
+                base, base.id == ExchangeRate.base_id
+            ).join(
+                quote, quote.id == ExchangeRate.quote_id
+            ).order_by(ExchangeRate.rdate)
+        table = cls()
+        digest = hashlib.md5()
+        for row in rows:
+            table.add(*row)
+            digest.update(repr(tuple(row)).encode())
+        table.stamp = digest.hexdigest()
+        return table
+
+    def direct(self, base, quote, on):
+        """Return rate of loaded pair or its inverse, None if unknown."""
+        dates = self._dates.get((base, quote))
+        if dates:
+            i = bisect_right(dates, on) - 1
+            if i >= 0:
+                return self._rates[(base, quote)][i]
+        dates = self._dates.get((quote, base))
+        if dates:
+            i = bisect_right(dates, on) - 1
+            if i >= 0 and self._rates[(quote, base)][i]:
+                return 1 / self._rates[(quote, base)][i]
+        return None
+
+    def rate(self, base, quote, on=None):
+        """Return price of one 'base' in 'quote' on date, None if unknown."""
+        if base == quote:
+            return Decimal(1)
+        on = on or date.today()
+        rate = self.direct(base, quote, on)
+        if rate is not None:
+            return rate
+        codes = {c for pair in self._dates for c in pair} - {base, quote}
+        for via in sorted(codes):
+            first = self.direct(base, via, on)
+            if first is not None:
+                second = self.direct(via, quote, on)
+                if second is not None:
+                    return first * second
+        return None
+
+    def consolidate(self, accounts, currency, on=None):
+        """Return (total in 'currency', accounts without rate) of balances
+        of accounts. Rates are looked up once per currency.
+        """
+        rates = {}
+        total = Decimal(0)
+        missing = []
+        for a in accounts:
+            code = a.currency.currency
+            if code not in rates:
+                rates[code] = self.rate(code, currency, on)
+            if rates[code] is None:
+                missing.append(a)
+            else:
+                total += a.balance * rates[code]
+        return money(total), missing
+
+
+class RateCache(object):
+    """Process-local RateTable, reloaded with one query when it is older
+    than RATES_CACHE_TTL seconds or invalidated.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._table = None
+        self._loaded = 0
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('RATES_CACHE_TTL', self.ttl)
+
+    def get(self):
+        with self._lock:
+            if self._table is not None and \
+                    time.monotonic() - self._loaded < self.ttl:
+                return self._table
+        table = RateTable.load()
+        with self._lock:
+            self._table = table
+            self._loaded = time.monotonic()
+        return table
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+
+
+def parse_rates(lines):
+    """Yield (base, quote, date, rate) from CSV file with header
+    date,base,quote,rate
+    Raise ValueError naming the line for invalid rows.
+    """
+    from app.transaction.importer import parse_date
+
+    reader = csv.DictReader(lines)
+    for record in reader:
+        record = {k.strip().lower(): (v or '').strip()
+                  for k, v in record.items() if k}
+        try:
+            base = record.get('base', '').upper()
+            quote = record.get('quote', '').upper()
+            if not base or not quote:
+                raise ValueError('no currency given')
+            if len(base) > 10 or len(quote) > 10:
+                raise ValueError('invalid currency')
+            try:
+                rate = Decimal(record.get('rate', '').replace(',', '.'))
+            except InvalidOperation:
+                rate = None
+            if rate is None or not rate.is_finite():
+                raise ValueError('invalid rate {!r}'.format(
+                    record.get('rate', '')))
+            if rate <= 0:
+                raise ValueError('rate must be positive')
+            if rate > MAX_RATE:
+                raise ValueError('rate must be at most {}'.format(MAX_RATE))
+            rate = rate.quantize(RATE_UNIT, rounding=ROUND_HALF_UP)
+            if rate == 0:
+                raise ValueError('rate rounds to 0, the smallest rate is '
+                                 '{:f}'.format(RATE_UNIT))
+            yield base, quote, parse_date(record.get('date', '')), rate
+        except ValueError as e:
+            raise ValueError('Line {}: {}'.format(reader.line_num, e))
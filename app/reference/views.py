@@ -1,6 +1,6 @@
 from flask import render_template, redirect, url_for, abort, flash
 from flask_login import current_user, login_required
-from app import db
+from app import db, page_cache, ref_cache
 from app.reference import bp
 from app.models import Group, Category, Party
 from app.reference.forms import GroupForm, GroupEditForm
@@ -16,9 +16,11 @@ from sqlalchemy import desc
 def group():
     form = GroupForm()
     if form.validate_on_submit():
-        a_group = Group(group=form.group.data.strip(), owner=current_user)
+        a_group = Group(group=form.group.data.strip(),
+                        user_id=current_user.id)
         db.session.add(a_group)
         try:
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Group created', 'success')
             return redirect(url_for('main.index'))
@@ -31,7 +33,7 @@ def group():
 @bp.route('/group/<int:group_id>', methods=['GET', 'POST'])
 def group_edit(group_id):
     existing_group = Group.query.filter_by(
-            owner=current_user,
+            user_id=current_user.id,
             id=group_id
         ).first()
     if existing_group is None:
@@ -40,6 +42,7 @@ def group_edit(group_id):
     if form.validate_on_submit():
         form.populate_obj(existing_group)
         try:
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Group updated', 'success')
             return redirect(url_for('main.index'))
@@ -51,6 +54,7 @@ def group_edit(group_id):
 
 @bp.route('/groups')
 @login_required
+@page_cache.cached()
 def groups():
     groups = db.session.query(Group).filter(
             Group.user_id == current_user.id
@@ -68,10 +72,11 @@ def category():
     if form.validate_on_submit():
         category = Category(
                 category=form.category.data.strip(),
-                owner=current_user
+                user_id=current_user.id
             )
         try:
             db.session.add(category)
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Category created', 'success')
             return redirect(url_for('main.index'))
@@ -84,7 +89,7 @@ def category():
 @bp.route('/category/<int:category_id>', methods=['GET', 'POST'])
 def category_edit(category_id):
     existing_category = Category.query.filter_by(
-            owner=current_user,
+            user_id=current_user.id,
             id=category_id
         ).first()
     if existing_category is None:
@@ -93,6 +98,7 @@ def category_edit(category_id):
     if form.validate_on_submit():
         form.populate_obj(existing_category)
         try:
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Category updated', 'success')
             return redirect(url_for('main.index'))
@@ -104,6 +110,7 @@ def category_edit(category_id):
 
 @bp.route('/categories')
 @login_required
+@page_cache.cached()
 def categories():
     categories = db.session.query(Category).filter(
             Category.user_id == current_user.id
@@ -119,9 +126,11 @@ def categories():
 def party():
     form = PartyForm()
     if form.validate_on_submit():
-        party = Party(party=form.party.data.strip(), owner=current_user)
+        party = Party(party=form.party.data.strip(),
+                      user_id=current_user.id)
         try:
             db.session.add(party)
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Party created', 'success')
             return redirect(url_for('main.index'))
@@ -134,7 +143,7 @@ def party():
 @bp.route('/party/<int:party_id>', methods=['GET', 'POST'])
 def party_edit(party_id):
     existing_party = Party.query.filter_by(
-            owner=current_user,
+            user_id=current_user.id,
             id=party_id
         ).first()
     if existing_party is None:
@@ -143,6 +152,7 @@ def party_edit(party_id):
     if form.validate_on_submit():
         form.populate_obj(existing_party)
         try:
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Party updates', 'success')
             return redirect(url_for('main.index'))
@@ -154,6 +164,7 @@ def party_edit(party_id):
 
 @bp.route('/parties')
 @login_required
+@page_cache.cached()
 def parties():
     parties = db.session.query(Party).filter(
             Party.user_id == current_user.id
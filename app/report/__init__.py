@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint(name='report', import_name=__name__)
+
+from app.report import views
@@ -0,0 +1,132 @@
+"""Vectorized spending analytics.
+
+Transactions of a user are loaded with one query into columnar NumPy
+arrays. Reports are computed from the arrays: rows are grouped by integer
+codes with np.bincount, months are kept as a contiguous axis, so rolling
+averages and year-over-year changes are plain array arithmetic.
+Amounts are in cents (int64) everywhere, like in the database.
+"""
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import BigInteger, type_coerce
+
+from app import db
+from app.models import Transaction
+
+
+Ledger = namedtuple('Ledger', ['day', 'amount', 'minus', 'account', 'group',
+                               'category', 'party'])
+
+# Columns of Ledger and their dtypes. Days are counted from 1970-01-01.
+DTYPES = [('day', np.int32), ('amount', np.int64), ('minus', np.bool_),
+          ('account', np.int32), ('group', np.int32),
+          ('category', np.int32), ('party', np.int32)]
+
+
+def load(user_id, start=None, end=None):
+    """Return Ledger of user's transactions dated from 'start' to 'end'
+    inclusive, ordered by date.
+    """
+    q = db.session.query(
+            Transaction.tdate,
+            # Raw cents, Decimal conversion is not needed here
+            type_coerce(Transaction.amount, BigInteger()),
+            Transaction.minus,
+            Transaction.account_id,
+            Transaction.group_id,
+            Transaction.category_id,
+            Transaction.party_id
+        ).filter(
+            Transaction.user_id == user_id
+        )
+    if start is not None:
+        q = q.filter(Transaction.tdate >= start)
+    if end is not None:
+        q = q.filter(Transaction.tdate <= end)
+    rows = q.order_by(Transaction.tdate).all()
+
+    columns = list(zip(*rows)) or [()] * len(DTYPES)
+    arrays = []
+    for (name, dtype), values in zip(DTYPES, columns):
+        if name == 'day':
+            values = np.array(values, dtype='datetime64[D]').astype(np.int64)
+        arrays.append(np.asarray(values, dtype=dtype))
+    return Ledger(*arrays)
+
+
+def months(days):
+    """Return months since 1970-01 of days since 1970-01-01."""
+    return np.asarray(days).astype('datetime64[D]').astype(
+        'datetime64[M]').astype(np.int64)
+
+
+def select(ledger, minus=True):
+    """Return Ledger of expenses (minus=True) or incomes (minus=False)."""
+    mask = ledger.minus == minus
+    return Ledger(*(column[mask] for column in ledger))
+
+
+def pivot(ledger, by='category'):
+    """Return (month_axis, keys, table) where table[i, j] is the sum in
+    cents of ledger rows of month_axis[i] having 'by' equal to keys[j].
+    Month axis ('datetime64[M]') covers every month from first to last.
+    """
+    if not len(ledger.day):
+        return (np.array([], dtype='datetime64[M]'),
+                np.array([], dtype=np.int32),
+                np.zeros((0, 0), dtype=np.int64))
+
+    month = months(ledger.day)
+    first = month.min()
+    n_months = month.max() - first + 1
+    keys, codes = np.unique(getattr(ledger, by), return_inverse=True)
+
+    # Sums of float64 are exact for cents up to 2 ** 53
+    flat = np.bincount((month - first) * len(keys) + codes,
+                       weights=ledger.amount,
+                       minlength=n_months * len(keys))
+    table = np.rint(flat).astype(np.int64).reshape(n_months, len(keys))
+    axis = np.arange(first, first + n_months).astype('datetime64[M]')
+    return axis, keys, table
+
+
+def rolling_average(table, window=3):
+    """Return average of the last 'window' months along the first axis.
+    First months are averaged over the months available.
+    """
+    table = np.asarray(table, dtype=np.float64)
+    sums = np.concatenate([np.zeros((1,) + table.shape[1:]),
+                           np.cumsum(table, axis=0)])
+    n = np.arange(1, len(table) + 1)
+    counts = np.minimum(n, window)
+    counts = counts.reshape((-1,) + (1,) * (table.ndim - 1))
+    return (sums[n] - sums[n - counts.ravel()]) / counts
+
+
+def year_over_year(table):
+    """Return (delta, percent) of every month against the same month a year
+    before. Months without a year before, and percent of zero, are NaN.
+    """
+    table = np.asarray(table, dtype=np.float64)
+    delta = np.full(table.shape, np.nan)
+    percent = np.full(table.shape, np.nan)
+    if len(table) > 12:
+        before = table[:-12]
+        delta[12:] = table[12:] - before
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent[12:] = np.where(before != 0,
+                                    delta[12:] / before * 100, np.nan)
+    return delta, percent
+
+
+def top(ledger, by='party', n=10):
+    """Return [(key, sum in cents, count)] of 'n' largest sums by 'by'."""
+    if not len(ledger.day):
+        return []
+    keys, codes = np.unique(getattr(ledger, by), return_inverse=True)
+    sums = np.rint(np.bincount(codes, weights=ledger.amount)).astype(
+        np.int64)
+    counts = np.bincount(codes)
+    order = np.argsort(-sums, kind='stable')[:n]
+    return [(int(keys[i]), int(sums[i]), int(counts[i])) for i in order]
@@ -0,0 +1,71 @@
+from flask import render_template, request
+from flask_login import current_user, login_required
+from datetime import date
+from decimal import Decimal
+import math
+
+from app import db, offload
+from app.models import Category, Party
+from app.report import bp
+from app.report import analytics
+
+
+@bp.route('/reports', methods=['GET'])
+@login_required
+def reports():
+    """Spending report: monthly expenses with 3-month average and change
+    to the year before, expenses by category and top parties.
+    Query parameter: years=1..10, 3 by default.
+    """
+    years = min(max(request.args.get('years', 3, type=int), 1), 10)
+    today = date.today()
+    start = date(today.year - years, today.month, 1)
+
+    ledger, categories, parties = offload.gather(
+        lambda: analytics.load(current_user.id, start, today),
+        lambda: names(Category, Category.category),
+        lambda: names(Party, Party.party))
+    expenses = analytics.select(ledger, minus=True)
+    axis, keys, table = analytics.pivot(expenses, by='category')
+    totals = table.sum(axis=1)
+    average = analytics.rolling_average(totals, window=3)
+    delta, percent = analytics.year_over_year(totals)
+
+    months = [dict(month=str(axis[i]), total=fancy(totals[i]),
+                   average=fancy(average[i]), delta=fancy(delta[i]),
+                   percent=fancy_percent(percent[i]))
+              for i in reversed(range(len(axis)))]
+
+    # Categories by the last 12 months, largest first
+    last = table[-12:]
+    by_category = [(categories.get(int(keys[j]), keys[j]),
+                    [fancy(v) for v in last[:, j]], fancy(last[:, j].sum()))
+                   for j in (-last.sum(axis=0)).argsort(kind='stable')]
+
+    top_parties = [(parties.get(key, key), fancy(total), count)
+                   for key, total, count in analytics.top(expenses, 'party')]
+
+    return render_template('reports/reports.html', years=years,
+                           months=months, columns=[str(m) for m in axis[-12:]],
+                           by_category=by_category, top_parties=top_parties)
+
+
+# ----------------------------- HELPER FUNCTIONS -----------------------------
+
+def names(model, column):
+    """Return {id: name} of user's references."""
+    return dict(db.session.query(model.id, column).filter(
+        model.user_id == current_user.id))
+
+
+def fancy(cents):
+    """Format amount in cents, empty for NaN."""
+    if math.isnan(cents):
+        return ''
+    return '{:,.2f}'.format(Decimal(int(round(cents))).scaleb(-2))
+
+
+def fancy_percent(value):
+    if math.isnan(value):
+        return ''
+    return '{:+.0f}%'.format(value)
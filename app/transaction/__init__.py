@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('transaction', __name__)
 
-from app.transaction import views
+from app.transaction import tasks, views
@@ -0,0 +1,134 @@
+"""Streaming export of user's ledger.
+
+Rows are read with a server-side cursor in batches (yield_per) and turned
+into CSV or NDJSON lines by generators, optionally gzipped on the fly, so
+memory stays flat and the first bytes go out before the query is exhausted.
+"""
+import csv
+import io
+import json
+import zlib
+
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.models import (Account, Category, Currency, Group, Party,
+                        Transaction, Transfer)
+
+
+KINDS = ('transactions', 'transfers')
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+TRANSACTION_COLUMNS = ('id', 'date', 'amount', 'minus', 'account',
+                       'currency', 'group', 'category', 'party', 'comment')
+TRANSFER_COLUMNS = ('id', 'date', 'from_account', 'to_account', 'amount',
+                    'coef')
+
+# Rows fetched from database and written out at a time
+BATCH_SIZE = 1000
+
+
+def transaction_rows(user_id, batch_size=BATCH_SIZE):
+    """Yield transactions of user as tuples of TRANSACTION_COLUMNS."""
+    return db.session.query(
+            Transaction.id, Transaction.tdate, Transaction.amount,
+            Transaction.minus, Account.account, Currency.currency,
+            Group.group, Category.category, Party.party, Transaction.comment
+        ).join(
+            Account, Account.id == Transaction.account_id
+        ).join(
+            Currency, Currency.id == Account.currency_id
+        ).join(
+            Group, Group.id == Transaction.group_id
+        ).join(
+            Category, Category.id == Transaction.category_id
+        ).join(
+            Party, Party.id == Transaction.party_id
+        ).filter(
+            Transaction.user_id == user_id
+        ).order_by(
+            Transaction.tdate, Transaction.id
+        ).yield_per(batch_size)
+
+
+def transfer_rows(user_id, batch_size=BATCH_SIZE):
+    """Yield transfers of user as tuples of TRANSFER_COLUMNS."""
+    from_account = aliased(Account)
+    to_account = aliased(Account)
+    return db.session.query(
+            Transfer.id, Transfer.tdate, from_account.account,
+            to_account.account, Transfer.amount, Transfer.coef
+        ).join(
+            from_account, from_account.id == Transfer.from_account_id
+        ).join(
+            to_account, to_account.id == Transfer.to_account_id
+        ).filter(
+            Transfer.user_id == user_id
+        ).order_by(
+            Transfer.tdate, Transfer.id
+        ).yield_per(batch_size)
+
+
+def to_csv(columns, rows, batch_size=BATCH_SIZE):
+    """Yield CSV text: header first, then rows in chunks of batch_size."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue()
+
+    buf.seek(0)
+    buf.truncate()
+    for number, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if number % batch_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def to_ndjson(columns, rows, batch_size=BATCH_SIZE):
+    """Yield JSON object per line in chunks of batch_size lines."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row)), default=str))
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def gzipped(chunks):
+    """Yield gzip stream of text chunks, compressed on the fly."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    first = True
+    for chunk in chunks:
+        data = z.compress(chunk.encode('utf-8'))
+        if first:
+            # Let the header and first rows out right away
+            data += z.flush(zlib.Z_SYNC_FLUSH)
+            first = False
+        if data:
+            yield data
+    yield z.flush()
+
+
+def filename(kind, fmt, gzip=False):
+    return '{}.{}{}'.format(kind, fmt, '.gz' if gzip else '')
+
+
+def export(user_id, kind='transactions', fmt='csv', gzip=False):
+    """Yield the whole ledger of user in chunks, str or bytes if gzip is
+    True. The query is built on the first chunk, so it runs in the session
+    of the thread iterating, e.g. a pool thread of app.offload.
+    """
+    if kind == 'transfers':
+        columns, rows = TRANSFER_COLUMNS, transfer_rows(user_id)
+    else:
+        columns, rows = TRANSACTION_COLUMNS, transaction_rows(user_id)
+    writer = to_ndjson if fmt == 'ndjson' else to_csv
+    chunks = writer(columns, rows)
+    yield from gzipped(chunks) if gzip else chunks
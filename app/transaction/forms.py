@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import (DateTimeField, DecimalField, SelectField,
-                     StringField, SubmitField, BooleanField)
-from wtforms.validators import DataRequired, Length, NumberRange
+from flask_wtf.file import FileField, FileRequired
+from wtforms import (DateField, DateTimeField, DecimalField, IntegerField,
+                     SelectField, StringField, SubmitField, BooleanField)
+from wtforms.validators import DataRequired, Length, NumberRange, Optional
 
 
 class TransactionForm(FlaskForm):
@@ -63,6 +64,45 @@ class TransactionEditForm(TransactionForm):
     minus = BooleanField('Expense')
 
 
+class RecurringForm(TransactionForm):
+    """Transaction repeated from start date on."""
+    tdate = DateField(
+            label='Start date',
+            validators=[DataRequired()],
+            format='%d.%m.%Y',
+            id='datepicker',
+            render_kw={'class': 'form-control'}
+        )
+
+    minus = SelectField(
+            label='Direction',
+            choices=[('minus', 'Expense'), ('plus', 'Income')],
+            render_kw={'class': 'form-control'}
+        )
+
+    frequency = SelectField(
+            label='Repeat',
+            choices=[('daily', 'Daily'), ('weekly', 'Weekly'),
+                     ('monthly', 'Monthly'), ('yearly', 'Yearly')],
+            default='monthly',
+            render_kw={'class': 'form-control'}
+        )
+
+    interval = IntegerField(
+            label='Every',
+            validators=[DataRequired(), NumberRange(min=1, max=365)],
+            default=1,
+            render_kw={'class': 'form-control'}
+        )
+
+    end_date = DateField(
+            label='End date',
+            validators=[Optional()],
+            format='%d.%m.%Y',
+            render_kw={'class': 'form-control', 'placeholder': 'dd.mm.yyyy'}
+        )
+
+
 class TransferForm(FlaskForm):
     from_account_id = SelectField(
             label='From account',
@@ -103,3 +143,158 @@ class TransferForm(FlaskForm):
         )
 
     submit = SubmitField('Send', render_kw={'class': 'btn btn-primary'})
+
+
+class ImportForm(FlaskForm):
+    statement = FileField(
+            label='Bank statement',
+            validators=[FileRequired()],
+            id='statementInput',
+            render_kw={'class': 'form-control-file'}
+        )
+
+    statement_format = SelectField(
+            label='Format',
+            choices=[('csv', 'CSV'), ('ofx', 'OFX')],
+            id='formatInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    account_id = SelectField(
+            label='Account (if not in statement)',
+            coerce=int,
+            id='accountInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    group_id = SelectField(
+            label='Group (if not in statement)',
+            coerce=int,
+            id='groupInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    category_id = SelectField(
+            label='Category (if not in statement)',
+            coerce=int,
+            id='categoryInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    party_id = SelectField(
+            label='Party (if not in statement)',
+            coerce=int,
+            id='partyInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    submit = SubmitField('Import', render_kw={'class': 'btn btn-primary'})
+
+
+class ExportForm(FlaskForm):
+    export_format = SelectField(
+            label='Format',
+            choices=[('csv', 'CSV'), ('ndjson', 'JSON (one object per line)')],
+            id='formatInput',
+            render_kw={'class': 'form-control'}
+        )
+
+    gzip = BooleanField('Compress with gzip')
+
+    submit = SubmitField('Export', render_kw={'class': 'btn btn-primary'})
+
+
+class TransferFilterForm(FlaskForm):
+    """Filters of transfers list, sent as query parameters."""
+    class Meta:
+        csrf = False
+
+    date_from = DateField(
+            label='From',
+            validators=[Optional()],
+            format='%d.%m.%Y',
+            render_kw={'class': 'form-control', 'placeholder': 'dd.mm.yyyy'}
+        )
+
+    date_to = DateField(
+            label='To',
+            validators=[Optional()],
+            format='%d.%m.%Y',
+            render_kw={'class': 'form-control', 'placeholder': 'dd.mm.yyyy'}
+        )
+
+    account_id = SelectField(
+            label='Account',
+            coerce=int,
+            default=0,
+            render_kw={'class': 'form-control'}
+        )
+
+    amount_min = DecimalField(
+            label='Amount from',
+            validators=[Optional()],
+            render_kw={'type': 'number', 'step': '0.01',
+                       'class': 'form-control'}
+        )
+
+    amount_max = DecimalField(
+            label='Amount to',
+            validators=[Optional()],
+            render_kw={'type': 'number', 'step': '0.01',
+                       'class': 'form-control'}
+        )
+
+    submit = SubmitField('Filter', render_kw={'class': 'btn btn-secondary'})
+
+
+class TransactionFilterForm(TransferFilterForm):
+    """Filters of transactions list, sent as query parameters."""
+    group_id = SelectField(
+            label='Group',
+            coerce=int,
+            default=0,
+            render_kw={'class': 'form-control'}
+        )
+
+    category_id = SelectField(
+            label='Category',
+            coerce=int,
+            default=0,
+            render_kw={'class': 'form-control'}
+        )
+
+    party_id = SelectField(
+            label='Party',
+            coerce=int,
+            default=0,
+            render_kw={'class': 'form-control'}
+        )
+
+    direction = SelectField(
+            label='Direction',
+            choices=[('', 'All'), ('minus', 'Expense'), ('plus', 'Income')],
+            default='',
+            render_kw={'class': 'form-control'}
+        )
+
+    comment = StringField(
+            label='Comment',
+            validators=[Optional(), Length(max=128)],
+            render_kw={'placeholder': 'Comment contains',
+                       'class': 'form-control'}
+        )
+
+
+class SearchForm(FlaskForm):
+    """Full-text search of transactions, sent as query parameters."""
+    class Meta:
+        csrf = False
+
+    q = StringField(
+            label='Search',
+            validators=[DataRequired(), Length(max=128)],
+            render_kw={'placeholder': 'Comment, party, group or category',
+                       'class': 'form-control'}
+        )
+
+    submit = SubmitField('Search', render_kw={'class': 'btn btn-secondary'})
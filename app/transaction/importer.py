@@ -0,0 +1,178 @@
+"""Bulk import of bank statements.
+
+A statement is parsed lazily line by line. Names of accounts and references
+are resolved through dictionaries built once per import. Transactions are
+inserted in chunks with executemany, and balances, usage statistics and
+monthly totals are applied once at the end, all in one database transaction.
+"""
+import csv
+import re
+from collections import namedtuple
+from datetime import datetime
+from decimal import InvalidOperation
+
+from app import db, ref_cache
+from app.models import Account, Category, Group, Party, Postings, Transaction
+from app.money import money
+
+
+FORMATS = ('csv', 'ofx')
+
+# Columns of transactions table filled by the importer
+Row = namedtuple('Row', ['tdate', 'amount', 'minus', 'user_id', 'account_id',
+                         'group_id', 'category_id', 'party_id', 'comment'])
+
+OFX_TAG = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+
+
+class StatementError(ValueError):
+    """Statement line can not be imported."""
+
+    def __init__(self, line, message):
+        super().__init__('Line {}: {}'.format(line, message))
+        self.line = line
+
+
+def parse_csv(lines):
+    """Yield (line number, record) from CSV statement with header
+    date,amount,account,group,category,party,comment
+    Only date and amount are required. Negative amount is an expense.
+    """
+    reader = csv.DictReader(lines)
+    for record in reader:
+        record = {k.strip().lower(): (v or '').strip()
+                  for k, v in record.items() if k}
+        yield reader.line_num, record
+
+
+def parse_ofx(lines):
+    """Yield (line number, record) for every STMTTRN of OFX statement.
+    Both SGML (OFX 1.x) and XML (OFX 2.x) flavours are understood.
+    """
+    record = None
+    for number, line in enumerate(lines, 1):
+        for closing, tag, value in OFX_TAG.findall(line):
+            value = value.strip()
+            if tag == 'STMTTRN':
+                if closing:
+                    if record is not None:
+                        yield record.pop('line'), record
+                    record = None
+                else:
+                    record = {'line': number}
+            elif record is not None and not closing:
+                if tag == 'DTPOSTED':
+                    record['date'] = value[:8]
+                elif tag == 'TRNAMT':
+                    record['amount'] = value
+                elif tag in ('NAME', 'PAYEE'):
+                    record.setdefault('party', value)
+                elif tag == 'MEMO':
+                    record['comment'] = value
+    # SGML statements may not close the last STMTTRN
+    if record is not None:
+        yield record.pop('line'), record
+
+
+def parse_date(value):
+    for fmt in ('%d.%m.%Y', '%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError('unknown date format {!r}'.format(value))
+
+
+def parse_amount(value):
+    try:
+        return money(value.replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError('invalid amount {!r}'.format(value))
+
+
+def import_statement(user, records, account=None, group=None, category=None,
+                     party=None, account_id=None, group_id=None,
+                     category_id=None, party_id=None, chunk_size=1000):
+    """Import records yielded by parse_csv or parse_ofx for user.
+    Account, group, category and party give names used for records
+    without them, the *_id arguments ids instead, which take precedence.
+    Names are matched case-insensitively. Unknown groups, categories and
+    parties are created, accounts must exist. Return number of imported
+    transactions. On error nothing is imported and StatementError is
+    raised.
+    """
+    accounts = dict(
+        (name.lower(), a_id) for a_id, name in db.session.query(
+            Account.id, Account.account).filter(Account.user_id == user.id))
+    references = {}
+    for model, field in ((Group, 'group'), (Category, 'category'),
+                         (Party, 'party')):
+        column = getattr(model, field)
+        references[field] = dict(
+            (name.lower(), r_id) for r_id, name in db.session.query(
+                model.id, column).filter(model.user_id == user.id))
+    defaults = {'account': account, 'group': group, 'category': category,
+                'party': party}
+    default_ids = {'account': account_id, 'group': group_id,
+                   'category': category_id, 'party': party_id}
+    models = {'group': Group, 'category': Category, 'party': Party}
+
+    def resolve(line, record, field):
+        name = record.get(field)
+        if not name and default_ids[field] is not None:
+            return default_ids[field]
+        name = name or defaults[field]
+        if not name:
+            raise StatementError(line, 'no {} given'.format(field))
+        if field == 'account':
+            if name.lower() not in accounts:
+                raise StatementError(
+                    line, 'unknown account {!r}'.format(name))
+            return accounts[name.lower()]
+        ids = references[field]
+        if name.lower() not in ids:
+            new = models[field](user_id=user.id, **{field: name[:128]})
+            db.session.add(new)
+            db.session.flush()
+            ids[name.lower()] = new.id
+        return ids[name.lower()]
+
+    insert = Transaction.__table__.insert()
+    postings = Postings()
+    chunk = []
+    count = 0
+    try:
+        for line, record in records:
+            try:
+                tdate = parse_date(record.get('date', ''))
+                amount = parse_amount(record.get('amount', ''))
+            except ValueError as e:
+                raise StatementError(line, str(e))
+            row = Row(
+                tdate=tdate,
+                amount=abs(amount),
+                minus=amount < 0,
+                user_id=user.id,
+                account_id=resolve(line, record, 'account'),
+                group_id=resolve(line, record, 'group'),
+                category_id=resolve(line, record, 'category'),
+                party_id=resolve(line, record, 'party'),
+                comment=record.get('comment', '')[:128]
+            )
+            postings.add(row)
+            chunk.append(row._asdict())
+            if len(chunk) >= chunk_size:
+                db.session.execute(insert, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            db.session.execute(insert, chunk)
+            count += len(chunk)
+
+        postings.apply()
+        ref_cache.invalidate(user.id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
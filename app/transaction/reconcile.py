@@ -0,0 +1,215 @@
+"""Reconciliation of denormalized balances and usage statistics.
+
+Account balances and 'times_used' of accounts, groups, categories and
+parties are recomputed from the ledger with one grouped query per table,
+compared with stored values and optionally corrected. Users are split into
+shards by id, every shard is checked in its own thread and connection.
+
+A shard is checked in one snapshot of the database, so a post made during
+the check is either in both the ledger and the stored values or in
+neither. Fixes add the differences found, computed by database, so such
+posts are kept.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from sqlalchemy import (BigInteger, bindparam, func, inspect, text,
+                        type_coerce)
+
+from app import db, ref_cache
+from app.database import is_sqlite_memory
+from app.models import (Account, Category, Group, Party, Transaction,
+                        Transfer, User)
+
+
+Discrepancy = namedtuple('Discrepancy', ['table', 'id', 'user_id', 'field',
+                                         'stored', 'actual'])
+
+# Coefficient of transfer is stored in millionths, see Transfer.coef
+COEF_SCALE = 10 ** 6
+
+
+def movements(shard=0, shards=1):
+    """Return ({account id: balance change}, {account id: times used})
+    made by the ledger for users with id % shards == shard.
+    """
+    def in_shard(column):
+        return column % shards == shard
+
+    balances = {}
+    used = {}
+
+    # Transactions: balance change and usage of account
+    rows = db.session.query(
+            Transaction.account_id, Transaction.minus,
+            func.sum(Transaction.amount), func.count(Transaction.id)
+        ).filter(
+            in_shard(Transaction.user_id)
+        ).group_by(
+            Transaction.account_id, Transaction.minus
+        )
+    for account_id, minus, amount, count in rows:
+        balances[account_id] = balances.get(account_id, 0) + \
+            (-amount if minus else amount)
+        used[account_id] = used.get(account_id, 0) + count
+
+    # Transfers: sent amount and received amount rounded per transfer.
+    # Received cents are round(amount * coef) done in integers, so the sum
+    # matches Decimal arithmetic of posting exactly.
+    rows = db.session.query(
+            Transfer.from_account_id, func.sum(Transfer.amount)
+        ).filter(
+            in_shard(Transfer.user_id)
+        ).group_by(Transfer.from_account_id)
+    for account_id, amount in rows:
+        balances[account_id] = balances.get(account_id, 0) - amount
+
+    product = type_coerce(Transfer.amount, BigInteger()) * \
+        type_coerce(Transfer.coef, BigInteger()) + COEF_SCALE // 2
+    rows = db.session.query(
+            Transfer.to_account_id,
+            func.sum(product - product % COEF_SCALE)
+        ).filter(
+            in_shard(Transfer.user_id)
+        ).group_by(Transfer.to_account_id)
+    for account_id, received in rows:
+        balances[account_id] = balances.get(account_id, 0) + \
+            Decimal(int(received) // COEF_SCALE).scaleb(-2)
+
+    return balances, used
+
+
+def snapshot():
+    """Commit the session and begin a transaction whose reads all see one
+    snapshot: REPEATABLE READ on PostgreSQL, an explicit BEGIN on SQLite,
+    whose driver would run every SELECT in a transaction of its own.
+    """
+    db.session.commit()
+    bind = db.session.get_bind()
+    if bind.dialect.name == 'sqlite':
+        # In-memory database has one connection shared by all threads,
+        # which can not hold a transaction of each
+        if not is_sqlite_memory(bind.url):
+            db.session.connection().exec_driver_sql('BEGIN')
+    else:
+        db.session.connection(
+            execution_options={'isolation_level': 'REPEATABLE READ'})
+
+
+def check_shard(shard=0, shards=1):
+    """Return list of Discrepancy for users with id % shards == shard.
+    The session is committed before and after the check.
+    """
+    def in_shard(column):
+        return column % shards == shard
+
+    snapshot()
+    balances, used = movements(shard, shards)
+
+    result = []
+    accounts = db.session.query(
+            Account.id, Account.user_id, Account.opening_balance,
+            Account.balance, Account.times_used
+        ).filter(in_shard(Account.user_id))
+    for a_id, user_id, opening, balance, times_used in accounts:
+        actual = opening + balances.get(a_id, 0)
+        if balance != actual:
+            result.append(Discrepancy('accounts', a_id, user_id, 'balance',
+                                      balance, actual))
+        if times_used != used.get(a_id, 0):
+            result.append(Discrepancy('accounts', a_id, user_id,
+                                      'times_used', times_used,
+                                      used.get(a_id, 0)))
+
+    for model, column in ((Group, Transaction.group_id),
+                          (Category, Transaction.category_id),
+                          (Party, Transaction.party_id)):
+        counts = dict(db.session.query(
+                column, func.count(Transaction.id)
+            ).filter(
+                in_shard(Transaction.user_id)
+            ).group_by(column))
+        stored = db.session.query(
+                model.id, model.user_id, model.times_used
+            ).filter(in_shard(model.user_id))
+        for r_id, user_id, times_used in stored:
+            if times_used != counts.get(r_id, 0):
+                result.append(Discrepancy(model.__tablename__, r_id, user_id,
+                                          'times_used', times_used,
+                                          counts.get(r_id, 0)))
+    # Fixes are written in a new transaction
+    db.session.commit()
+    return result
+
+
+def fix(discrepancies):
+    """Correct stored values by the difference to actual ones.
+    Differences are added by database, so posts made meanwhile are kept.
+    """
+    models = {'accounts': Account, 'groups': Group, 'categories': Category,
+              'parties': Party}
+    accounts = {}
+    counts = {}
+    for d in discrepancies:
+        delta = d.actual - d.stored
+        if d.table == 'accounts':
+            balance, used = accounts.get(d.id, (Decimal(0), 0))
+            if d.field == 'balance':
+                accounts[d.id] = (balance + delta, used)
+            else:
+                accounts[d.id] = (balance, used + delta)
+        else:
+            counts.setdefault(d.table, {})[d.id] = delta
+
+    Account.adjust(accounts)
+    for table, deltas in counts.items():
+        models[table].use(deltas)
+    users = {d.user_id for d in discrepancies}
+    ref_cache.invalidate_many(users)
+    User.bump_ledger(users)
+    db.session.commit()
+
+
+def reconcile(app, shards=1, jobs=1, apply_fix=False):
+    """Check all users split into 'shards', running 'jobs' shards at once.
+    Fix discrepancies if 'apply_fix' is True. Return list of Discrepancy.
+    """
+    def run(shard):
+        with app.app_context():
+            found = check_shard(shard, shards)
+            if apply_fix and found:
+                fix(found)
+            return found
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(run, range(shards))
+        return [d for found in results for d in found]
+
+
+def init_opening_balances():
+    """Add 'accounts.opening_balance' to database created before it and set
+    it so that current balances are taken as correct. Return number of
+    accounts.
+    """
+    columns = [c['name'] for c in inspect(db.engine).get_columns('accounts')]
+    if 'opening_balance' not in columns:
+        db.session.execute(text('ALTER TABLE accounts ADD COLUMN '
+                                'opening_balance BIGINT NOT NULL DEFAULT 0'))
+        db.session.commit()
+
+    balances, used = movements()
+    params = [{'_id': a_id, '_opening': balance - balances.get(a_id, 0)}
+              for a_id, balance in db.session.query(Account.id,
+                                                    Account.balance)]
+    if params:
+        t = Account.__table__
+        db.session.execute(
+            t.update().where(
+                t.c.id == bindparam('_id')
+            ).values(
+                opening_balance=bindparam('_opening',
+                                          type_=t.c.opening_balance.type)
+            ), params)
+    db.session.commit()
+    return len(params)
@@ -0,0 +1,112 @@
+"""Materialization of recurring transactions.
+
+All due occurrences of all users are created in one run: occurrence keys
+and transactions are inserted in chunks with executemany, balances, usage
+statistics and totals are applied once through Postings, and rules are
+moved on with one batched UPDATE, all in one database transaction.
+
+Every occurrence has a unique key (rule, date). A repeated run finds
+nothing due, a missed month is caught up on the next run, and a run racing
+with another one fails on the key instead of creating duplicates.
+"""
+from datetime import date
+
+from sqlalchemy import bindparam
+
+from app import db, ref_cache
+from app.models import Postings, RecurringOccurrence, RecurringTransaction
+from app.models import Transaction
+from app.transaction.importer import Row
+
+
+def due(rule, until):
+    """Yield (number, date) of occurrences of rule not created yet, up to
+    'until' and the end date of rule.
+    """
+    n = rule.sequence
+    while True:
+        odate = rule.occurrence(n)
+        if odate > until or (rule.end_date and odate > rule.end_date):
+            return
+        yield n, odate
+        n += 1
+
+
+def materialize(until=None, user_id=None, chunk_size=1000):
+    """Create transactions of all occurrences due by 'until' (today by
+    default), for one user or everybody. Return number of created
+    transactions. Raises IntegrityError if another run created some of
+    them meanwhile; nothing is created then.
+    """
+    until = until or date.today()
+    q = RecurringTransaction.query.filter(
+            RecurringTransaction.is_active == True,
+            RecurringTransaction.next_date <= until
+        )
+    if user_id is not None:
+        q = q.filter(RecurringTransaction.user_id == user_id)
+    rules = q.all()
+    if not rules:
+        return 0
+
+    # Keys already taken, e.g. when start of rule was moved back
+    existing = {(r_id, odate) for r_id, odate in db.session.query(
+            RecurringOccurrence.recurring_id, RecurringOccurrence.odate
+        ).filter(
+            RecurringOccurrence.recurring_id.in_([r.id for r in rules]),
+            RecurringOccurrence.odate >= min(r.next_date for r in rules),
+            RecurringOccurrence.odate <= until
+        )}
+
+    postings = Postings()
+    keys, rows, moves = [], [], []
+    for rule in rules:
+        following = rule.sequence
+        for n, odate in due(rule, until):
+            following = n + 1
+            if (rule.id, odate) in existing:
+                continue
+            row = Row(
+                tdate=odate,
+                amount=rule.amount,
+                minus=rule.minus,
+                user_id=rule.user_id,
+                account_id=rule.account_id,
+                group_id=rule.group_id,
+                category_id=rule.category_id,
+                party_id=rule.party_id,
+                comment=rule.comment
+            )
+            postings.add(row)
+            rows.append(row._asdict())
+            keys.append({'recurring_id': rule.id, 'odate': odate})
+        next_date = rule.occurrence(following)
+        moves.append({
+            '_id': rule.id,
+            '_sequence': following,
+            '_next': next_date,
+            '_active': not (rule.end_date and next_date > rule.end_date)
+        })
+
+    try:
+        for start in range(0, len(rows), chunk_size):
+            db.session.execute(RecurringOccurrence.__table__.insert(),
+                               keys[start:start + chunk_size])
+            db.session.execute(Transaction.__table__.insert(),
+                               rows[start:start + chunk_size])
+        postings.apply()
+        t = RecurringTransaction.__table__
+        db.session.execute(
+            t.update().where(
+                t.c.id == bindparam('_id')
+            ).values(
+                sequence=bindparam('_sequence'),
+                next_date=bindparam('_next'),
+                is_active=bindparam('_active')
+            ), moves)
+        ref_cache.invalidate_many({r.user_id for r in rules})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
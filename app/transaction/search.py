@@ -0,0 +1,276 @@
+"""Full-text search over transactions.
+
+Every transaction is indexed as one document made of its comment and the
+names of its party, group and category. The index is kept in sync by
+database triggers, so rows written by the ORM, bulk import or plain SQL
+are all covered, and renaming a reference reindexes its transactions.
+
+SQLite uses an FTS5 table ranked by bm25, PostgreSQL a tsvector table with
+GIN index ranked by ts_rank. Matches are ranked in windows of
+SEARCH_RANK_WINDOW, newest first, so words found in most of the ledger cost
+no more than rare ones: pages of the newest matches come first, then those
+of older windows, each ranked on its own.
+Other databases fall back to LIKE on comments and party names. The index
+is created together with tables, 'flask search-index' builds it for
+existing databases.
+"""
+import re
+
+from sqlalchemy import event, func, or_, text
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.models import Account, Party, Transaction
+
+
+# All searched words must match
+WORD = re.compile(r'\w+')
+MAX_WORDS = 8
+
+# Owner column holds token 'u<user id>', so the index itself narrows
+# matches down to one user
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+        owner, comment, party, grp, category,
+        tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_insert
+        AFTER INSERT ON transactions BEGIN
+        INSERT INTO transactions_fts (rowid, owner, comment, party, grp,
+                                      category)
+        VALUES (new.id, 'u' || new.user_id, new.comment,
+                (SELECT party FROM parties WHERE id = new.party_id),
+                (SELECT "group" FROM groups WHERE id = new.group_id),
+                (SELECT category FROM categories
+                 WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_update
+        AFTER UPDATE OF comment, party_id, group_id, category_id
+        ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.id;
+        INSERT INTO transactions_fts (rowid, owner, comment, party, grp,
+                                      category)
+        VALUES (new.id, 'u' || new.user_id, new.comment,
+                (SELECT party FROM parties WHERE id = new.party_id),
+                (SELECT "group" FROM groups WHERE id = new.group_id),
+                (SELECT category FROM categories
+                 WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_delete
+        AFTER DELETE ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS parties_fts_update
+        AFTER UPDATE OF party ON parties BEGIN
+        UPDATE transactions_fts SET party = new.party WHERE rowid IN
+            (SELECT id FROM transactions WHERE party_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS groups_fts_update
+        AFTER UPDATE OF "group" ON groups BEGIN
+        UPDATE transactions_fts SET grp = new."group" WHERE rowid IN
+            (SELECT id FROM transactions WHERE group_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_fts_update
+        AFTER UPDATE OF category ON categories BEGIN
+        UPDATE transactions_fts SET category = new.category WHERE rowid IN
+            (SELECT id FROM transactions WHERE category_id = new.id);
+    END""",
+]
+
+SQLITE_DROP = ['DROP TABLE IF EXISTS transactions_fts'] + [
+    'DROP TRIGGER IF EXISTS {}'.format(name) for name in (
+        'transactions_fts_insert', 'transactions_fts_update',
+        'transactions_fts_delete', 'parties_fts_update', 'groups_fts_update',
+        'categories_fts_update')]
+
+SQLITE_FILL = """
+    INSERT INTO transactions_fts (rowid, owner, comment, party, grp,
+                                  category)
+    SELECT t.id, 'u' || t.user_id, t.comment, p.party, g."group", c.category
+    FROM transactions t
+    LEFT JOIN parties p ON p.id = t.party_id
+    LEFT JOIN groups g ON g.id = t.group_id
+    LEFT JOIN categories c ON c.id = t.category_id"""
+
+# Comment weighs more than party, party more than group and category
+SQLITE_SEARCH = """
+    SELECT id FROM (
+        SELECT rowid AS id,
+            bm25(transactions_fts, 0.0, 4.0, 2.0, 1.0, 1.0) AS rank
+        FROM transactions_fts WHERE transactions_fts MATCH :query
+        ORDER BY rowid DESC LIMIT :window OFFSET :skip)
+    ORDER BY rank, id DESC LIMIT :limit OFFSET :offset"""
+
+SQLITE_OLDER = """
+    SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH :query
+    ORDER BY rowid DESC LIMIT 1 OFFSET :skip"""
+
+POSTGRES_DDL = [
+    """CREATE TABLE IF NOT EXISTS transaction_search (
+        id INTEGER PRIMARY KEY REFERENCES transactions (id)
+            ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        document TSVECTOR NOT NULL)""",
+    """CREATE INDEX IF NOT EXISTS ix_transaction_search_document
+        ON transaction_search USING GIN (document)""",
+    """CREATE INDEX IF NOT EXISTS ix_transaction_search_user_id
+        ON transaction_search (user_id)""",
+    """CREATE OR REPLACE FUNCTION transaction_search_document(
+            comment TEXT, party_id INTEGER, group_id INTEGER,
+            category_id INTEGER) RETURNS TSVECTOR AS $$
+        SELECT setweight(to_tsvector('simple', coalesce($1, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT party FROM parties WHERE id = $2), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT "group" FROM groups WHERE id = $3), '')), 'C') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT category FROM categories WHERE id = $4), '')), 'C')
+    $$ LANGUAGE SQL STABLE""",
+    """CREATE OR REPLACE FUNCTION transaction_search_sync()
+        RETURNS TRIGGER AS $$
+    BEGIN
+        INSERT INTO transaction_search (id, user_id, document)
+        VALUES (NEW.id, NEW.user_id, transaction_search_document(
+            NEW.comment, NEW.party_id, NEW.group_id, NEW.category_id))
+        ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION transaction_search_reference()
+        RETURNS TRIGGER AS $$
+    BEGIN
+        EXECUTE format('UPDATE transaction_search s SET document = '
+            'transaction_search_document(t.comment, t.party_id, '
+            't.group_id, t.category_id) FROM transactions t '
+            'WHERE s.id = t.id AND t.%I = $1', TG_ARGV[0]) USING NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS transaction_search_sync ON transactions',
+    """CREATE TRIGGER transaction_search_sync
+        AFTER INSERT OR UPDATE OF comment, party_id, group_id, category_id
+        ON transactions
+        FOR EACH ROW EXECUTE PROCEDURE transaction_search_sync()""",
+] + [statement.format(table=table, column=column)
+     for table, column in (('parties', 'party'), ('groups', 'group'),
+                           ('categories', 'category'))
+     for statement in (
+        'DROP TRIGGER IF EXISTS transaction_search_reference ON {table}',
+        """CREATE TRIGGER transaction_search_reference
+            AFTER UPDATE OF "{column}" ON {table}
+            FOR EACH ROW EXECUTE PROCEDURE
+            transaction_search_reference('{column}_id')""")]
+
+POSTGRES_DROP = ['DROP TABLE IF EXISTS transaction_search CASCADE']
+
+POSTGRES_FILL = """
+    INSERT INTO transaction_search (id, user_id, document)
+    SELECT id, user_id, transaction_search_document(
+        comment, party_id, group_id, category_id)
+    FROM transactions
+    ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document"""
+
+POSTGRES_SEARCH = """
+    SELECT id FROM (
+        SELECT id, ts_rank(document, to_tsquery('simple', :query)) AS rank
+        FROM transaction_search
+        WHERE user_id = :user_id
+            AND document @@ to_tsquery('simple', :query)
+        ORDER BY id DESC LIMIT :window OFFSET :skip) AS matches
+    ORDER BY rank DESC, id DESC LIMIT :limit OFFSET :offset"""
+
+POSTGRES_OLDER = """
+    SELECT id FROM transaction_search
+    WHERE user_id = :user_id AND document @@ to_tsquery('simple', :query)
+    ORDER BY id DESC LIMIT 1 OFFSET :skip"""
+
+
+def dialect(connection):
+    return connection.dialect.name
+
+
+@event.listens_for(db.metadata, 'after_create')
+def create_index(target, connection, **kw):
+    """Create search index and triggers after tables."""
+    ddl = {'sqlite': SQLITE_DDL, 'postgresql': POSTGRES_DDL}
+    for statement in ddl.get(dialect(connection), []):
+        connection.execute(text(statement))
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def drop_index(target, connection, **kw):
+    """Drop search index before tables it depends on."""
+    ddl = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}
+    for statement in ddl.get(dialect(connection), []):
+        connection.execute(text(statement))
+
+
+def rebuild():
+    """Recreate search index from transactions. Return number of indexed
+    transactions.
+    """
+    connection = db.session.connection()
+    drop_index(None, connection)
+    create_index(None, connection)
+    if dialect(connection) == 'sqlite':
+        connection.execute(text(SQLITE_FILL))
+        connection.execute(text("INSERT INTO transactions_fts "
+                                "(transactions_fts) VALUES ('optimize')"))
+    elif dialect(connection) == 'postgresql':
+        connection.execute(text(POSTGRES_FILL))
+    db.session.commit()
+    return db.session.query(Transaction).count()
+
+
+def search(user_id, query, page=1, per_page=50, window=1000):
+    """Return (transactions, has next page) matching words of 'query',
+    best matches first. The last word matches as a prefix, as it may be
+    unfinished. Matches are ranked in windows of 'window', rounded up to
+    whole pages, newest window first.
+    """
+    words = WORD.findall(query.lower())[:MAX_WORDS]
+    if not words:
+        return [], False
+
+    q = db.session.query(Transaction).options(
+            joinedload(Transaction.account).joinedload(Account.currency),
+            joinedload(Transaction.group),
+            joinedload(Transaction.category),
+            joinedload(Transaction.party)
+        )
+    # Pages do not cross windows
+    window = -(-window // per_page) * per_page
+    offset = (page - 1) * per_page
+    params = dict(window=window, limit=per_page + 1,
+                  skip=offset - offset % window, offset=offset % window)
+
+    name = db.engine.dialect.name
+    if name == 'sqlite':
+        params['query'] = 'owner:"u{}" {}*'.format(
+            user_id, ' '.join('"{}"'.format(w) for w in words))
+        search_sql, older_sql = SQLITE_SEARCH, SQLITE_OLDER
+    elif name == 'postgresql':
+        params['query'] = ' & '.join(words) + ':*'
+        params['user_id'] = user_id
+        search_sql, older_sql = POSTGRES_SEARCH, POSTGRES_OLDER
+    else:
+        q = q.join(Transaction.party).filter(Transaction.user_id == user_id)
+        for w in words:
+            q = q.filter(or_(
+                func.lower(Transaction.comment).contains(w, autoescape=True),
+                func.lower(Party.party).contains(w, autoescape=True)))
+        rows = q.order_by(
+                Transaction.tdate.desc(), Transaction.id.desc()
+            ).offset(params['offset']).limit(params['limit']).all()
+        return rows[:per_page], len(rows) > per_page
+
+    # Page of ids is ranked by the user's part of the index, rows are
+    # loaded by primary key in one query
+    ids = [r[0] for r in db.session.execute(text(search_sql), params)]
+    more = len(ids) > per_page
+    if not more and params['offset'] + per_page == window:
+        # Last page of its window, a next one is of older matches
+        params['skip'] += window
+        more = db.session.execute(text(older_sql), params).first() is not None
+    found = {tr.id: tr for tr in q.filter(Transaction.id.in_(ids))}
+    rows = [found[i] for i in ids if i in found]
+    return rows[:per_page], more
@@ -0,0 +1,80 @@
+"""Background tasks on the ledger, run by workers of app.jobs.
+
+Progress is reported between transactions only, see JobRun.progress.
+"""
+import os
+
+from flask import current_app
+from sqlalchemy import func
+
+from app import db, jobs
+from app.jobs import JobFailed
+from app.models import Transaction, Transfer, User
+from app.transaction import exporter, reconcile
+from app.transaction.importer import (StatementError, import_statement,
+                                      parse_csv, parse_ofx)
+
+
+@jobs.task('import_statement')
+def import_statement_task(run, path, fmt='csv', **defaults):
+    """Import statement saved at 'path' for user of the job, 'defaults'
+    are names or ids as of import_statement. The file is kept only if the
+    import is to be retried.
+    """
+    user = db.session.get(User, run.user_id)
+    parse = parse_ofx if fmt == 'ofx' else parse_csv
+    try:
+        if user is None:
+            raise JobFailed('No such user')
+        with open(path, encoding='utf-8-sig', errors='replace',
+                  newline='') as f:
+            count = import_statement(
+                user, parse(f),
+                chunk_size=current_app.config['IMPORT_CHUNK_SIZE'],
+                **defaults)
+    except StatementError as e:
+        os.remove(path)
+        raise JobFailed('Statement NOT imported. {}'.format(e))
+    except JobFailed:
+        os.remove(path)
+        raise
+    os.remove(path)
+    run.message = '{} transactions imported'.format(count)
+    return {'count': count}
+
+
+@jobs.task('export')
+def export_task(run, kind='transactions', fmt='csv', gzip=False):
+    """Write the whole ledger of user to a file of the job."""
+    model = Transfer if kind == 'transfers' else Transaction
+    total = db.session.query(func.count(model.id)).filter(
+        model.user_id == run.user_id).scalar()
+    filename = exporter.filename(kind, fmt, gzip)
+    chunks = exporter.export(run.user_id, kind, fmt, gzip)
+    if gzip:
+        f = open(run.path(filename), 'wb')
+    else:
+        f = open(run.path(filename), 'w', encoding='utf-8', newline='')
+    with f:
+        # Chunks after the first hold BATCH_SIZE rows each, before gzip
+        for number, chunk in enumerate(chunks):
+            f.write(chunk)
+            run.progress(min(number * exporter.BATCH_SIZE, total), total)
+    run.message = '{} {} exported'.format(total, kind)
+    return {'file': filename, 'rows': total}
+
+
+@jobs.task('reconcile')
+def reconcile_task(run, shards=1, apply_fix=False):
+    """Check users shard by shard, fix discrepancies if 'apply_fix'."""
+    found = 0
+    for shard in range(shards):
+        discrepancies = reconcile.check_shard(shard, shards)
+        if apply_fix and discrepancies:
+            reconcile.fix(discrepancies)
+        db.session.commit()
+        found += len(discrepancies)
+        run.progress(shard + 1, shards)
+    run.message = '{} discrepancies{}'.format(
+        found, ', fixed' if apply_fix and found else '')
+    return {'discrepancies': found, 'fixed': apply_fix}
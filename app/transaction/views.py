@@ -1,14 +1,21 @@
-from flask import flash, redirect, render_template, url_for, abort
+from flask import (flash, redirect, render_template, url_for, abort,
+                   current_app, request, Response)
 from flask_login import current_user, login_required
-from sqlalchemy import asc, desc
+from sqlalchemy import and_, asc, desc, func, or_
 from sqlalchemy.exc import IntegrityError
-from datetime import date
+from sqlalchemy.orm import joinedload
+from datetime import date, datetime
 
-from app import db
-from app.models import Account, Category, Group, Party, Transaction, Transfer
+from app import db, jobs, offload, page_cache, ref_cache
+from app.money import money, rate
+from app.models import (Account, Category, Currency, Group, Party,
+                        RecurringTransaction, Transaction, Transfer)
 from app.transaction import bp
 from app.transaction.forms import TransactionForm, TransactionEditForm
-from app.transaction.forms import TransferForm
+from app.transaction.forms import TransferForm, ImportForm, ExportForm
+from app.transaction.forms import TransactionFilterForm, TransferFilterForm
+from app.transaction.forms import SearchForm, RecurringForm
+from app.transaction import exporter, scheduler, search
 
 
 @bp.route('/transaction/<tr_type>', methods=['GET', 'POST'])
@@ -31,41 +38,24 @@ def transaction(tr_type):
     form.party_id.choices = active_parties(True)
 
     if form.validate_on_submit():
-        tr = Transaction()
-        tr.tdate = form.tdate.data
-        tr.amount = round(float(form.amount.data), 2)
-        tr.minus = tr_type
-        tr.owner = current_user
-        tr.account_id = form.account_id.data
-        tr.group_id = form.group_id.data
-        tr.category_id = form.category_id.data
-        tr.party_id = form.party_id.data
-        tr.comment = form.comment.data.strip()
+        tr = Transaction(
+                tdate=form.tdate.data,
+                amount=money(form.amount.data),
+                minus=tr_type,
+                user_id=current_user.id,
+                account_id=form.account_id.data,
+                group_id=form.group_id.data,
+                category_id=form.category_id.data,
+                party_id=form.party_id.data,
+                comment=form.comment.data.strip()
+            )
 
         try:
-            # Save transaction to databse
+            # Save transaction, correct balance, usage statistics and
+            # totals in one database transaction
             dbs.add(tr)
-            dbs.commit()
-            # Increase time_used for account
-            tr.account.times_used += 1
-
-            # Increase times_used for group
-            tr.group.times_used += 1
-
-            # Increase times_used for category
-            tr.category.times_used += 1
-
-            # Increase times_used for party
-            tr.party.times_used += 1
-
-            # Subtract expense or add balance from balance
-            if tr_type:
-                # a.balance = a.balance - tr.amount
-                tr.account.balance = tr.account.balance - tr.amount
-            else:
-                # a.balance = a.balance + tr.amount
-                tr.account.balance = tr.account.balance + tr.amount
-
+            Transaction.apply([(tr, 1)])
+            ref_cache.invalidate(current_user.id)
             dbs.commit()
             flash('Transaction created!', 'success')
             return redirect(url_for('main.index'))
@@ -79,21 +69,77 @@ def transaction(tr_type):
 @bp.route('/transactions')
 @login_required
 def transactions():
-    """Show all active transactions."""
-    transactions = db.session.query(Transaction).filter(
+    """Show user's transactions page by page, newest first.
+    Pages are addressed by a (tdate, id) cursor instead of an offset, so
+    every page costs the same however long the history is.
+    """
+    per_page = current_app.config['TRANSACTIONS_PER_PAGE']
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+    form = filter_form(TransactionFilterForm)
+
+    query = db.session.query(Transaction).options(
+            joinedload(Transaction.account).joinedload(Account.currency),
+            joinedload(Transaction.group),
+            joinedload(Transaction.category),
+            joinedload(Transaction.party)
+        ).filter(
             Transaction.user_id == current_user.id
-        ).order_by(
-            asc(Transaction.tdate)
-        ).all()
+        )
+    query = filter_transactions(query, form)
+
+    if after is not None:
+        # Walk towards newer rows and flip the page back to newest first
+        transactions = query.filter(
+                or_(Transaction.tdate > after[0],
+                    and_(Transaction.tdate == after[0],
+                         Transaction.id > after[1]))
+            ).order_by(
+                asc(Transaction.tdate), asc(Transaction.id)
+            ).limit(per_page + 1).all()
+        has_newer = len(transactions) > per_page
+        has_older = True
+        transactions = transactions[:per_page][::-1]
+    else:
+        if before is not None:
+            query = query.filter(
+                    or_(Transaction.tdate < before[0],
+                        and_(Transaction.tdate == before[0],
+                             Transaction.id < before[1]))
+                )
+        transactions = query.order_by(
+                desc(Transaction.tdate), desc(Transaction.id)
+            ).limit(per_page + 1).all()
+        has_older = len(transactions) > per_page
+        has_newer = before is not None
+        transactions = transactions[:per_page]
+
+    newer = older = None
+    if transactions:
+        if has_newer:
+            newer = make_cursor(transactions[0])
+        if has_older:
+            older = make_cursor(transactions[-1])
+
+    # Keep filters when going to other pages
+    filters = {k: v for k, v in request.args.items()
+               if k not in ('before', 'after')}
+
     return render_template('transactions/transactions.html',
-                           transactions=transactions)
+                           transactions=transactions, form=form,
+                           filters=filters, newer=newer, older=older)
 
 
 @bp.route('/transaction/<int:tr_id>', methods=['GET', 'POST'])
 @login_required
 def transaction_edit(tr_id):
     # Get currenct transaction for current user
-    t = db.session.query(Transaction).filter(
+    t = db.session.query(Transaction).options(
+            joinedload(Transaction.account).joinedload(Account.currency),
+            joinedload(Transaction.group),
+            joinedload(Transaction.category),
+            joinedload(Transaction.party)
+        ).filter(
             Transaction.id == tr_id,
             Transaction.user_id == current_user.id
         ).first()
@@ -140,70 +186,29 @@ def transaction_edit(tr_id):
             party_choices.append(p)
     form.party_id.choices = party_choices
 
-    # Temporarily store data for current transaction to correct balans after
-    # edition
-    amount_before = t.amount
-    action_before = t.minus
-    account_before = t.account_id
-    group_before = t.group
-    category_before = t.category
-    party_before = t.party
-
     # Now check if form validation is ok
     if form.validate_on_submit():
-        # Collect new data from form and put it to the transaction t
+        # Keep data of transaction before edition to take it back from
+        # balance, usage statistics and totals
+        before = Transaction(
+                tdate=t.tdate,
+                amount=t.amount,
+                minus=t.minus,
+                user_id=t.user_id,
+                account_id=t.account_id,
+                group_id=t.group_id,
+                category_id=t.category_id,
+                party_id=t.party_id
+            )
+
         try:
+            # Collect new data from form and put it to the transaction t
             form.populate_obj(t)
+            t.amount = money(form.amount.data)
+            Transaction.apply([(before, -1), (t, 1)])
+            ref_cache.invalidate(current_user.id)
             db.session.commit()
             flash('Transaction changed', 'success')
-
-            # Now we have to correct data related to current transaction
-            # ... balance in Account
-            amount_after = round(float(form.amount.data), 2)
-            action_after = form.minus.data
-            account_after = form.account_id.data
-
-            # ... take account before and correct balans
-            ac = Account.query.get(account_before)
-            if action_before:
-                ac.balance = ac.balance + amount_before
-            else:
-                ac.balance = ac.balance - amount_before
-            ac.times_used -= 1
-            db.session.add(ac)
-            db.session.commit()
-
-            # ... take account after and correct balans
-            ac = Account.query.get(account_after)
-            if action_after:
-                ac.balance = ac.balance - amount_after
-            else:
-                ac.balance = ac.balance + amount_after
-            ac.times_used += 1
-            db.session.add(ac)
-            db.session.commit()
-
-            # Update usage statistics for groups categories and parties
-            group_before.times_used -= 1
-            category_before.times_used -= 1
-            party_before.times_used -= 1
-            db.session.add_all([group_before, category_before, party_before])
-
-            group_after = form.group_id.data
-            category_after = form.category_id.data
-            party_after = form.party_id.data
-
-            gai = Group.query.get(int(group_after))
-            cai = Category.query.get(int(category_after))
-            pai = Party.query.get(int(party_after))
-
-            gai.times_used += 1
-            cai.times_used += 1
-            pai.times_used += 1
-
-            db.session.add_all([gai, cai, pai])
-            db.session.commit()
-
             return redirect(url_for('transaction.transactions'))
         except IntegrityError:
             db.session.rollback()
@@ -223,25 +228,100 @@ def transaction_delete(tr_id):
         abort(404)
 
     try:
-        # Correct balans and statistics
-        if t.minus:
-            t.account.balance = t.account.balance + t.amount
-        else:
-            t.account.balance = t.account.balance - t.amount
-
-        t.account.times_used -= 1
-        t.group.times_used -= 1
-        t.category.times_used -= 1
-        t.party.times_used -= 1
-
-        # Delete transaction
+        # Correct balans and statistics and delete transaction
+        Transaction.apply([(t, -1)])
+        ref_cache.invalidate(current_user.id)
         db.session.delete(t)
         db.session.commit()
         flash('Transaction deleted', 'warning')
-        return redirect(url_for('transaction.transactions'))
     except IntegrityError:
         db.session.rollback()
         flash('Transaction NOT deleted', 'error')
+    return redirect(url_for('transaction.transactions'))
+
+
+@bp.route('/transactions/import', methods=['GET', 'POST'])
+@login_required
+def import_transactions():
+    """Queue import of transactions from uploaded bank statement."""
+    form = ImportForm()
+    form.account_id.choices = active_accounts(True)
+    form.group_id.choices = active_groups(True)
+    form.category_id.choices = active_categories(True)
+    form.party_id.choices = active_parties(True)
+
+    if form.validate_on_submit():
+        # Ids of chosen references are used for records without names
+        defaults = dict(account_id=form.account_id.data,
+                        group_id=form.group_id.data,
+                        category_id=form.category_id.data,
+                        party_id=form.party_id.data)
+        # Imported by a worker, see app.transaction.tasks
+        fmt = form.statement_format.data
+        path = jobs.save_upload(form.statement.data.stream, '.' + fmt)
+        job = jobs.enqueue('import_statement', user_id=current_user.id,
+                           path=path, fmt=fmt, **defaults)
+        return redirect(url_for('main.job', job_id=job.id))
+
+    return render_template('transactions/import.html', form=form)
+
+
+@bp.route('/transactions/search', methods=['GET'])
+@login_required
+def search_transactions():
+    """Search transactions by words of comment and reference names,
+    best matches first.
+    """
+    form = SearchForm(request.args)
+    page = max(request.args.get('page', 1, type=int), 1)
+    transactions, more = [], False
+    if form.validate():
+        transactions, more = search.search(
+            current_user.id, form.q.data, page=page,
+            per_page=current_app.config['TRANSACTIONS_PER_PAGE'],
+            window=current_app.config['SEARCH_RANK_WINDOW'])
+    return render_template('transactions/search.html', form=form,
+                           transactions=transactions, page=page, more=more)
+
+
+@bp.route('/export/<kind>', methods=['GET'])
+@login_required
+def export(kind):
+    """Stream all transactions or transfers of user as a file.
+    Query parameters: format=csv|ndjson, gzip=1.
+    """
+    fmt = request.args.get('format', 'csv')
+    if kind not in exporter.KINDS or fmt not in exporter.FORMATS:
+        abort(404)
+    gzip = request.args.get('gzip') == '1'
+
+    chunks = exporter.export(current_user.id, kind, fmt, gzip)
+    filename = exporter.filename(kind, fmt, gzip)
+    headers = {'Content-Disposition':
+               'attachment; filename={}'.format(filename)}
+    if gzip:
+        mimetype = 'application/gzip'
+    else:
+        mimetype = exporter.MIMETYPES[fmt]
+    return Response(offload.stream(chunks), mimetype=mimetype,
+                    headers=headers)
+
+
+@bp.route('/export/<kind>/job', methods=['GET', 'POST'])
+@login_required
+def export_job(kind):
+    """Queue export of all transactions or transfers of user to a file.
+    Only the form is shown on GET, a job is queued by its POST.
+    """
+    if kind not in exporter.KINDS:
+        abort(404)
+    form = ExportForm()
+    if form.validate_on_submit():
+        job = jobs.enqueue('export', user_id=current_user.id, kind=kind,
+                           fmt=form.export_format.data, gzip=form.gzip.data)
+        return redirect(url_for('main.job', job_id=job.id))
+
+    return render_template('transactions/export.html', form=form, kind=kind)
 
 
 @bp.route('/transfer', methods=['GET', 'POST'])
@@ -251,25 +331,22 @@ def transfer():
 
     # Prefill form fields
     form.tdate.data = date.today()
-    form.from_account_id.choices = active_accounts(True)
-    form.to_account_id.choices = active_accounts(True)
+    accounts = active_accounts(True)
+    form.from_account_id.choices = accounts
+    form.to_account_id.choices = accounts
 
     if form.validate_on_submit():
         tf = Transfer(
                 from_account_id=form.from_account_id.data,
                 to_account_id=form.to_account_id.data,
                 tdate=form.tdate.data,
-                amount=round(float(form.amount.data), 2),
-                coef=float(form.coef.data),
+                amount=money(form.amount.data),
+                coef=rate(form.coef.data),
                 user_id=current_user.id
             )
-        f = Account.query.get(tf.from_account_id)
-        t = Account.query.get(tf.to_account_id)
-
-        f.balance = f.balance - tf.amount
-        t.balance = t.balance + tf.amount * tf.coef
-
-        db.session.add_all([tf, t, f])
+        # Balances are changed by database in the same transaction
+        db.session.add(tf)
+        Transfer.apply([(tf, 1)])
         db.session.commit()
         flash('Transfer complete!', 'success')
         return redirect(url_for('main.index'))
@@ -278,23 +355,202 @@ def transfer():
 
 @bp.route('/transfers', methods=['GET'])
 @login_required
+@page_cache.cached()
 def transfers():
-    """Show all transfers"""
-    transfers = db.session.query(Transfer).filter(
+    """Show all transfers matching filters"""
+    form = filter_form(TransferFilterForm)
+    query = db.session.query(Transfer).options(
+            joinedload(Transfer.from_account),
+            joinedload(Transfer.to_account)
+        ).filter(
             Transfer.user_id == current_user.id
-        ).order_by(
-            desc(Transfer.tdate)
+        )
+
+    date_from, date_to, account_id, amount_min, amount_max = filter_values(
+        form, 'date_from', 'date_to', 'account_id', 'amount_min',
+        'amount_max')
+    if date_from:
+        query = query.filter(Transfer.tdate >= date_from)
+    if date_to:
+        query = query.filter(Transfer.tdate <= date_to)
+    if account_id:
+        query = query.filter(or_(Transfer.from_account_id == account_id,
+                                 Transfer.to_account_id == account_id))
+    if amount_min is not None:
+        query = query.filter(Transfer.amount >= amount_min)
+    if amount_max is not None:
+        query = query.filter(Transfer.amount <= amount_max)
+
+    transfers = query.order_by(
+            desc(Transfer.tdate), desc(Transfer.id)
         ).all()
     return render_template('transactions/transfers.html',
-                           transfers=transfers)
+                           transfers=transfers, form=form)
+
+
+@bp.route('/recurring', methods=['GET', 'POST'])
+@login_required
+def recurring():
+    """Show recurring transactions and create new one.
+    Occurrences due by today are created right away.
+    """
+    form = RecurringForm()
+    form.account_id.choices = active_accounts(True)
+    form.group_id.choices = active_groups(True)
+    form.category_id.choices = active_categories(True)
+    form.party_id.choices = active_parties(True)
+
+    if form.validate_on_submit():
+        if form.end_date.data and form.end_date.data < form.tdate.data:
+            flash('End date is before start date', 'warning')
+        else:
+            rule = RecurringTransaction(
+                    frequency=form.frequency.data,
+                    interval=form.interval.data,
+                    start_date=form.tdate.data,
+                    end_date=form.end_date.data,
+                    next_date=form.tdate.data,
+                    amount=money(form.amount.data),
+                    minus=form.minus.data == 'minus',
+                    user_id=current_user.id,
+                    account_id=form.account_id.data,
+                    group_id=form.group_id.data,
+                    category_id=form.category_id.data,
+                    party_id=form.party_id.data,
+                    comment=form.comment.data.strip()
+                )
+            db.session.add(rule)
+            db.session.commit()
+            try:
+                count = scheduler.materialize(user_id=current_user.id)
+            except IntegrityError:
+                # materialize() has rolled back, the rule is kept
+                db.session.rollback()
+                flash('Recurring transaction created, its transactions '
+                      'are being added by another run', 'warning')
+            else:
+                flash('Recurring transaction created, {} transaction(s) '
+                      'added'.format(count), 'success')
+            return redirect(url_for('transaction.recurring'))
+
+    rules = db.session.query(RecurringTransaction).options(
+            joinedload(RecurringTransaction.account),
+            joinedload(RecurringTransaction.party)
+        ).filter(
+            RecurringTransaction.user_id == current_user.id,
+            RecurringTransaction.is_active == True
+        ).order_by(
+            asc(RecurringTransaction.next_date)
+        ).all()
+    return render_template('transactions/recurring.html', form=form,
+                           rules=rules)
+
+
+@bp.route('/recurring/stop/<int:rule_id>', methods=['GET'])
+@login_required
+def recurring_stop(rule_id):
+    """Stop recurring transaction, created transactions are kept."""
+    rule = db.session.query(RecurringTransaction).filter(
+            RecurringTransaction.id == rule_id,
+            RecurringTransaction.user_id == current_user.id
+        ).first()
+    if rule is None:
+        abort(404)
+    rule.is_active = False
+    db.session.commit()
+    flash('Recurring transaction stopped', 'success')
+    return redirect(url_for('transaction.recurring'))
 
 
 # ----------------------------- HELPER FUNCTIONS ----------------------------
+def filter_form(form_class):
+    """Return filter form filled from query parameters."""
+    form = form_class(request.args)
+    everything = [(0, 'All')]
+    form.account_id.choices = everything + active_accounts(True)
+    if hasattr(form, 'group_id'):
+        form.group_id.choices = everything + active_groups(True)
+        form.category_id.choices = everything + active_categories(True)
+        form.party_id.choices = everything + active_parties(True)
+    form.validate()
+    return form
+
+
+def filter_values(form, *names):
+    """Return data of form fields, None for fields with errors."""
+    return [None if form[n].errors else form[n].data for n in names]
+
+
+def filter_transactions(query, form):
+    """Add conditions of TransactionFilterForm to query of transactions."""
+    (date_from, date_to, account_id, group_id, category_id, party_id,
+     direction, amount_min, amount_max, comment) = filter_values(
+        form, 'date_from', 'date_to', 'account_id', 'group_id',
+        'category_id', 'party_id', 'direction', 'amount_min', 'amount_max',
+        'comment')
+
+    if date_from:
+        query = query.filter(Transaction.tdate >= date_from)
+    if date_to:
+        query = query.filter(Transaction.tdate <= date_to)
+    if account_id:
+        query = query.filter(Transaction.account_id == account_id)
+    if group_id:
+        query = query.filter(Transaction.group_id == group_id)
+    if category_id:
+        query = query.filter(Transaction.category_id == category_id)
+    if party_id:
+        query = query.filter(Transaction.party_id == party_id)
+    if direction:
+        query = query.filter(Transaction.minus == (direction == 'minus'))
+    if amount_min is not None:
+        query = query.filter(Transaction.amount >= amount_min)
+    if amount_max is not None:
+        query = query.filter(Transaction.amount <= amount_max)
+    if comment:
+        query = query.filter(func.lower(Transaction.comment).contains(
+            comment.strip().lower(), autoescape=True))
+    return query
+
+
+def make_cursor(tr):
+    """Return keyset cursor of transaction as string 'yyyy-mm-dd_id'."""
+    return '{}_{}'.format(tr.tdate.strftime('%Y-%m-%d'), tr.id)
+
+
+def parse_cursor(cursor):
+    """Return (date, id) from the string made by make_cursor.
+    Return None if cursor is empty or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        tdate, tr_id = cursor.split('_')
+        return datetime.strptime(tdate, '%Y-%m-%d').date(), int(tr_id)
+    except ValueError:
+        return None
+
+
 def active_accounts(for_form=False):
     """Return list of active accounts for current user.
     If 'for_form' is True, then return list of tuples containing
-    (account id, account name and currency)
+    (account id, account name and currency) from the references cache.
     """
+    if for_form:
+        return ref_cache.get(current_user, 'accounts', lambda: [
+                (a_id, '{} ({})'.format(account, currency))
+                for a_id, account, currency in db.session.query(
+                    Account.id, Account.account, Currency.currency
+                ).join(
+                    Currency, Currency.id == Account.currency_id
+                ).filter(
+                    Account.is_active == True,
+                    Account.user_id == current_user.id
+                ).order_by(
+                    desc(Account.times_used)
+                )
+            ])
+
     accounts = db.session.query(Account).filter(
             Account.is_active == True,
             Account.user_id == current_user.id
@@ -302,75 +558,65 @@ def active_accounts(for_form=False):
             desc(Account.times_used)
         ).all()
 
-    if for_form:
-        as_tuples = []
-        for a in accounts:
-            as_tuples.append(
-                    (a.id, '{} ({})'.format(
-                            a.account,
-                            a.currency.currency))
-                )
-        return as_tuples
-
     return accounts
 
 
 def active_groups(for_form=False):
     """Return list of active groups.
-    If 'for_form' is True, then return list of tuple of (group id, group name).
+    If 'for_form' is True, then return list of tuple of (group id, group name)
+    from the references cache.
     """
-    groups = db.session.query(Group).filter(
+    query = db.session.query(Group).filter(
             Group.user_id == current_user.id,
             Group.is_active == True
         ).order_by(
             desc(Group.times_used)
-        ).all()
+        )
 
     if for_form:
-        as_tuples = []
-        for g in groups:
-            as_tuples.append((g.id, g.group))
-        return as_tuples
+        return ref_cache.get(current_user, 'groups', lambda: [
+                tuple(g) for g in query.with_entities(Group.id, Group.group)
+            ])
 
-    return groups
+    return query.all()
 
 
 def active_categories(for_form=False):
     """Return list of active categories.
     If 'for_form' is True, then return list of tuples
-    of (category id, category name).
+    of (category id, category name) from the references cache.
     """
-    categories = db.session.query(Category).filter(
+    query = db.session.query(Category).filter(
             Category.user_id == current_user.id,
             Category.is_active == True
         ).order_by(
             desc(Category.times_used)
-        ).all()
+        )
 
     if for_form:
-        as_tuples = []
-        for c in categories:
-            as_tuples.append((c.id, c.category))
-        return as_tuples
+        return ref_cache.get(current_user, 'categories', lambda: [
+                tuple(c) for c in query.with_entities(Category.id,
+                                                      Category.category)
+            ])
 
-    return categories
+    return query.all()
 
 
 def active_parties(for_form=False):
     """Return list of active parties.
-    If 'for_form' is True, then return list of tuple of (party id, party name).
+    If 'for_form' is True, then return list of tuple of (party id, party name)
+    from the references cache.
     """
-    parties = db.session.query(Party).filter(
+    query = db.session.query(Party).filter(
             Party.user_id == current_user.id,
             Party.is_active == True
         ).order_by(
             desc(Party.times_used)
-        ).all()
+        )
 
     if for_form:
-        as_tuples = []
-        for p in parties:
-            as_tuples.append((p.id, p.party))
-        return as_tuples
+        return ref_cache.get(current_user, 'parties', lambda: [
+                tuple(p) for p in query.with_entities(Party.id, Party.party)
+            ])
 
-    return parties
+    return query.all()
@@ -0,0 +1,194 @@
+"""Benchmark of the hot endpoints.
+
+    python -m benchmarks.bench run --transactions 100000 -o after.json
+    python -m benchmarks.bench compare before.json after.json
+
+'run' seeds a database of create_app('testing') (in memory unless
+DATABASE_URL is set), drives the endpoints through Flask test client and
+reports latency percentiles, SQL statements and peak Python memory per
+endpoint. 'compare' shows the difference of two runs and fails when an
+endpoint got slower or chattier than the threshold.
+"""
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+import click
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from app import create_app, db  # noqa: E402
+from app.models import (Account, Category, Group, Party,  # noqa: E402
+                        Transaction)
+from benchmarks.seed import PASSWORD, seed  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def scenarios(client, rnd):
+    """Return {name: function making one request} for a signed in user."""
+    ids = {}
+    for model in (Account, Group, Category, Party):
+        ids[model] = [r[0] for r in db.session.query(model.id).filter(
+            model.user_id == 1)]
+    tr_ids = [r[0] for r in db.session.query(Transaction.id).filter(
+        Transaction.user_id == 1).limit(1000)]
+    today = date.today().strftime('%d.%m.%Y')
+
+    def form(**extra):
+        data = dict(tdate=today, amount='{:.2f}'.format(rnd.uniform(1, 99)),
+                    account_id=rnd.choice(ids[Account]),
+                    group_id=rnd.choice(ids[Group]),
+                    category_id=rnd.choice(ids[Category]),
+                    party_id=rnd.choice(ids[Party]), comment='benchmark')
+        data.update(extra)
+        return data
+
+    def edit():
+        tr_id = rnd.choice(tr_ids)
+        client.get('/transaction/{}'.format(tr_id))
+        return client.post('/transaction/{}'.format(tr_id),
+                           data=form(minus='y'))
+
+    def transfer():
+        a, b = rnd.sample(ids[Account], 2)
+        return client.post('/transfer', data=dict(
+            tdate=today, from_account_id=a, to_account_id=b,
+            amount='10.00', coef='1.5'))
+
+    return {
+        'main.index': lambda: client.get('/'),
+        'transaction.transactions': lambda: client.get('/transactions'),
+        'transaction.transaction POST':
+            lambda: client.post('/transaction/minus', data=form()),
+        'transaction.transaction_edit': edit,
+        'transaction.transfer POST': transfer,
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--users', default=1, help='Users to seed.')
+@click.option('--accounts', default=5, help='Accounts per user.')
+@click.option('--references', default=30,
+              help='Groups, categories and parties per user.')
+@click.option('--transactions', default=10000, help='Transactions per user.')
+@click.option('--repeat', default=50, help='Requests per endpoint.')
+@click.option('--seed', 'random_seed', default=1, help='Random seed.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Save results as JSON.')
+def run(users, accounts, references, transactions, repeat, random_seed,
+        output):
+    """Seed database and measure the hot endpoints."""
+    app = create_app('testing')
+    app.config['WTF_CSRF_ENABLED'] = False
+    rnd = random.Random(random_seed)
+
+    with app.app_context():
+        db.engine.echo = False
+        started = time.perf_counter()
+        phones = seed(users=users, accounts=accounts, references=references,
+                      transactions=transactions, random_seed=random_seed)
+        click.echo('Seeded {} user(s) x {} transactions in {:.1f}s'.format(
+            users, transactions, time.perf_counter() - started))
+
+        queries = []
+        event.listen(db.engine, 'after_cursor_execute',
+                     lambda *args: queries.append(1))
+
+        client = app.test_client()
+        client.post('/auth/signin', data=dict(phone=phones[0],
+                                              password=PASSWORD))
+        results = {}
+        for name, request in scenarios(client, rnd).items():
+            latencies, counts, peaks = [], [], []
+            for i in range(repeat):
+                del queries[:]
+                started = time.perf_counter()
+                response = request()
+                latencies.append((time.perf_counter() - started) * 1000)
+                counts.append(len(queries))
+                if response.status_code >= 400:
+                    raise click.ClickException('{} returned {}'.format(
+                        name, response.status_code))
+            # Memory is traced apart, tracing slows requests down
+            for i in range(min(repeat, 5)):
+                tracemalloc.start()
+                request()
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+                tracemalloc.stop()
+            results[name] = {
+                'p50_ms': percentile(latencies, 50),
+                'p90_ms': percentile(latencies, 90),
+                'p99_ms': percentile(latencies, 99),
+                'queries': sum(counts) / len(counts),
+                'peak_kib': max(peaks),
+            }
+
+    report(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'params': dict(users=users, accounts=accounts,
+                                      references=references,
+                                      transactions=transactions,
+                                      repeat=repeat),
+                       'results': results}, f, indent=2)
+
+
+def report(results):
+    click.echo('{:<32}{:>10}{:>10}{:>10}{:>10}{:>12}'.format(
+        'endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'queries', 'peak KiB'))
+    for name, r in results.items():
+        click.echo('{:<32}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.1f}{:>12.0f}'
+                   .format(name, r['p50_ms'], r['p90_ms'], r['p99_ms'],
+                           r['queries'], r['peak_kib']))
+
+
+@cli.command()
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+@click.option('--threshold', default=10.0,
+              help='Allowed slowdown of p50 and p90, percent.')
+def compare(before, after, threshold):
+    """Compare two runs, fail on regressions."""
+    before = json.load(before)['results']
+    after = json.load(after)['results']
+    regressions = []
+    click.echo('{:<32}{:>12}{:>12}{:>16}'.format(
+        'endpoint', 'p50', 'p90', 'queries'))
+    for name in sorted(set(before) & set(after)):
+        b, a = before[name], after[name]
+        changes = []
+        for key in ('p50_ms', 'p90_ms'):
+            change = (a[key] - b[key]) / b[key] * 100 if b[key] else 0
+            changes.append(change)
+            if change > threshold:
+                regressions.append('{} {} +{:.0f}%'.format(name, key, change))
+        if a['queries'] > b['queries']:
+            regressions.append('{} queries {:.1f} -> {:.1f}'.format(
+                name, b['queries'], a['queries']))
+        click.echo('{:<32}{:>+11.0f}%{:>+11.0f}%{:>16}'.format(
+            name, changes[0], changes[1], '{:.1f} -> {:.1f}'.format(
+                b['queries'], a['queries'])))
+    if regressions:
+        raise click.ClickException('Regressions:\n' + '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,220 @@
+"""Load test of the production server.
+
+    python -m benchmarks.load run --threads 1 -o sync.json
+    python -m benchmarks.load run --threads 8 -o threaded.json
+    python -m benchmarks.load compare sync.json threaded.json
+
+'run' seeds a SQLite file, starts gunicorn with wsgi:app and the given
+workers and threads, and lets 'concurrency' signed in clients request a
+mix of fast pages, reports and exports for 'duration' seconds. It reports
+requests per second and latency percentiles per endpoint. 'compare'
+shows the change of throughput and latency between two runs.
+"""
+import http.cookiejar
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench import percentile  # noqa: E402
+from benchmarks.seed import PASSWORD  # noqa: E402
+
+# Endpoint and its share of requests
+MIX = [
+    ('/', 4),
+    ('/transactions', 4),
+    ('/transfers', 2),
+    ('/reports', 1),
+    ('/export/transactions?format=csv', 1),
+]
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_database(env, transactions):
+    """Seed database of env in a child process, as the configuration reads
+    DATABASE_URL on import. Return phones of users.
+    """
+    out = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.load', 'seed',
+         '--transactions', str(transactions)],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, check=True)
+    return json.loads(out.stdout)
+
+
+def start_server(env, port, workers, threads, log):
+    env = dict(env, WEB_BIND='127.0.0.1:{}'.format(port),
+               WEB_WORKERS=str(workers), WEB_THREADS=str(threads))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         'wsgi:app'], cwd=ROOT, env=env, stdout=log, stderr=log)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(
+                'http://127.0.0.1:{}/auth/signin'.format(port), timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise click.ClickException('Server did not start')
+
+
+def client(base, phone):
+    """Return urllib opener signed in as phone."""
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(
+        http.cookiejar.CookieJar()))
+    page = opener.open(base + '/auth/signin').read().decode()
+    token = CSRF.search(page).group(1)
+    opener.open(base + '/auth/signin', urllib.parse.urlencode(dict(
+        csrf_token=token, phone=phone, password=PASSWORD)).encode()).read()
+    return opener
+
+
+def drive(opener, base, deadline, offset, results):
+    paths = [path for path, share in MIX for _ in range(share)]
+    i = offset
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            with opener.open(base + path, timeout=120) as response:
+                while response.read(65536):
+                    pass
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        elapsed = (time.perf_counter() - started) * 1000
+        results.append((path, status, elapsed))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--transactions', default=20000)
+def seed(transactions):
+    """Seed database of FINEXP_CONFIG, print phones of users as JSON."""
+    from app import create_app
+    from benchmarks.seed import seed as seed_data
+
+    app = create_app(os.environ.get('FINEXP_CONFIG', 'production'))
+    with app.app_context():
+        click.echo(json.dumps(seed_data(transactions=transactions)))
+
+
+@cli.command()
+@click.option('--workers', default=1, help='Server processes.')
+@click.option('--threads', default=8, help='Threads per process.')
+@click.option('--concurrency', default=16, help='Clients at once.')
+@click.option('--duration', default=20, help='Seconds of load.')
+@click.option('--transactions', default=20000, help='Transactions seeded.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Save results as JSON.')
+def run(workers, threads, concurrency, duration, transactions, output):
+    """Seed database, start server and put it under load."""
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, FINEXP_CONFIG='production',
+                   DATABASE_URL='sqlite:///' + os.path.join(tmp, 'load.db'),
+                   LOGIN_LIMIT_PER_IP='', LOGIN_LIMIT_PER_PHONE='')
+        phones = seed_database(env, transactions)
+        port = free_port()
+        log = open(os.path.join(tmp, 'server.log'), 'w+')
+        server = start_server(env, port, workers, threads, log)
+        try:
+            base = 'http://127.0.0.1:{}'.format(port)
+            openers = [client(base, phones[0]) for _ in range(concurrency)]
+            results = []
+            deadline = time.monotonic() + duration
+            drivers = [threading.Thread(target=drive, args=(
+                opener, base, deadline, i, results))
+                for i, opener in enumerate(openers)]
+            for t in drivers:
+                t.start()
+            for t in drivers:
+                t.join()
+        except Exception:
+            log.seek(0)
+            click.echo(log.read()[-4000:], err=True)
+            raise
+        finally:
+            server.terminate()
+            server.wait()
+            log.close()
+
+    summary = summarize(results, duration)
+    summary['params'] = dict(workers=workers, threads=threads,
+                             concurrency=concurrency, duration=duration,
+                             transactions=transactions)
+    report(summary)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def summarize(results, duration):
+    endpoints = {}
+    for path, status, elapsed in results:
+        endpoints.setdefault(path, []).append((status, elapsed))
+    return {
+        'rps': len(results) / duration,
+        'errors': sum(1 for r in results if r[1] >= 400),
+        'endpoints': {path: {
+            'requests': len(rows),
+            'p50_ms': percentile([e for _, e in rows], 50),
+            'p90_ms': percentile([e for _, e in rows], 90),
+            'p99_ms': percentile([e for _, e in rows], 99),
+        } for path, rows in endpoints.items()},
+    }
+
+
+def report(summary):
+    click.echo('{:.1f} requests/s, {} errors'.format(summary['rps'],
+                                                     summary['errors']))
+    click.echo('{:<36}{:>10}{:>10}{:>10}{:>10}'.format(
+        'endpoint', 'requests', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for path, r in sorted(summary['endpoints'].items()):
+        click.echo('{:<36}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            path, r['requests'], r['p50_ms'], r['p90_ms'], r['p99_ms']))
+
+
+@cli.command()
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def compare(before, after):
+    """Compare throughput and latency of two runs."""
+    before, after = json.load(before), json.load(after)
+    click.echo('requests/s {:.1f} -> {:.1f} ({:+.0f}%)'.format(
+        before['rps'], after['rps'],
+        (after['rps'] - before['rps']) / before['rps'] * 100))
+    click.echo('{:<36}{:>20}{:>20}'.format('endpoint', 'p50 ms', 'p90 ms'))
+    for path in sorted(set(before['endpoints']) & set(after['endpoints'])):
+        b, a = before['endpoints'][path], after['endpoints'][path]
+        click.echo('{:<36}{:>20}{:>20}'.format(
+            path, '{:.1f} -> {:.1f}'.format(b['p50_ms'], a['p50_ms']),
+            '{:.1f} -> {:.1f}'.format(b['p90_ms'], a['p90_ms'])))
+
+
+if __name__ == '__main__':
+    cli()
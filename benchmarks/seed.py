@@ -0,0 +1,99 @@
+"""Synthetic data for benchmarks.
+
+Rows are inserted with executemany, then balances, usage statistics,
+monthly totals and checkpoints are derived from them with the same
+set-based code used for maintenance, so the data is consistent.
+"""
+import random
+from datetime import date, timedelta
+
+from app import db
+from app.models import (Account, BalanceCheckpoint, Category, Currency,
+                        Group, MonthlyTotal, Party, Transaction, Transfer,
+                        User)
+from app.transaction import reconcile
+
+
+PASSWORD = 'benchmark'
+CHUNK_SIZE = 5000
+
+
+def phone(number):
+    return '7{:010d}'.format(number)
+
+
+def seed(users=1, accounts=5, references=30, transactions=10000,
+         transfers=None, years=3, random_seed=1):
+    """Fill empty database and return list of user phones.
+    'transactions' and 'transfers' are counts per user.
+    """
+    rnd = random.Random(random_seed)
+    if transfers is None:
+        transfers = transactions // 20
+
+    db.create_all()
+    if not Currency.query.count():
+        Currency.create()
+    currencies = [c.id for c in Currency.query]
+
+    phones = []
+    first_day = date.today() - timedelta(days=365 * years)
+    for number in range(users):
+        user = User(phone=phone(number))
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.flush()
+        phones.append(user.phone)
+
+        for i in range(accounts):
+            opening = rnd.randint(0, 100000)
+            db.session.add(Account(account='Account {}'.format(i),
+                                   balance=opening, opening_balance=opening,
+                                   currency_id=rnd.choice(currencies),
+                                   user_id=user.id))
+        for i in range(references):
+            db.session.add_all([
+                Group(group='Group {}'.format(i), user_id=user.id),
+                Category(category='Category {}'.format(i), user_id=user.id),
+                Party(party='Party {}'.format(i), user_id=user.id)
+            ])
+        db.session.flush()
+
+        ids = {}
+        for model in (Account, Group, Category, Party):
+            ids[model] = [r[0] for r in db.session.query(model.id).filter(
+                model.user_id == user.id)]
+
+        def day():
+            return first_day + timedelta(days=rnd.randint(0, 365 * years))
+
+        insert = Transaction.__table__.insert()
+        for start in range(0, transactions, CHUNK_SIZE):
+            db.session.execute(insert, [dict(
+                tdate=day(),
+                amount=rnd.randint(100, 50000) / 100,
+                minus=rnd.random() < 0.8,
+                user_id=user.id,
+                account_id=rnd.choice(ids[Account]),
+                group_id=rnd.choice(ids[Group]),
+                category_id=rnd.choice(ids[Category]),
+                party_id=rnd.choice(ids[Party]),
+                comment='Synthetic {}'.format(start + i)
+            ) for i in range(min(CHUNK_SIZE, transactions - start))])
+
+        insert = Transfer.__table__.insert()
+        for start in range(0, transfers, CHUNK_SIZE):
+            db.session.execute(insert, [dict(
+                tdate=day(),
+                amount=rnd.randint(100, 100000) / 100,
+                coef=rnd.choice([1, 1, 0.5, 2, 475.5]),
+                from_account_id=rnd.choice(ids[Account]),
+                to_account_id=rnd.choice(ids[Account]),
+                user_id=user.id
+            ) for i in range(min(CHUNK_SIZE, transfers - start))])
+        db.session.commit()
+
+    reconcile.fix(reconcile.check_shard())
+    MonthlyTotal.rebuild()
+    BalanceCheckpoint.refresh()
+    return phones
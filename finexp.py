@@ -1,9 +1,232 @@
-from app import create_app, db
-from app.models import User, Account, Currency
+import multiprocessing
+import os
+import signal
+import sys
 
-app = create_app('development')
+import click
+from sqlalchemy.exc import IntegrityError
+
+from app import create_app, db, jobs, rates
+from app.jobs import run_worker
+from app.models import (User, Account, Currency, MonthlyTotal,
+                        BalanceCheckpoint, ExchangeRate)
+from app.money import migrate_float_columns
+from app.passwords import benchmark
+from app.rates import parse_rates
+from app.transaction import exporter, reconcile, scheduler, search
+from app.transaction.importer import (FORMATS, StatementError,
+                                      import_statement, parse_csv, parse_ofx)
+
+config = os.environ.get('FINEXP_CONFIG', 'development')
+app = create_app(config)
 
 
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db, User=User, Account=Account, Currency=Currency)
+
+
+@app.cli.command('rebuild-totals')
+@click.option('--check', is_flag=True,
+              help='Only report drift, do not change the table.')
+def rebuild_totals(check):
+    """Recompute monthly totals from transactions and report drift."""
+    drift = MonthlyTotal.rebuild(check_only=check)
+    for key, stored, actual in drift:
+        click.echo('user={} month={} category={} account={} minus={}: '
+                   'stored {:.2f}/{} actual {:.2f}/{}'.format(
+                        *key, stored[0], stored[1], actual[0], actual[1]))
+    click.echo('{} drifted total(s){}'.format(
+        len(drift), '' if check else ', table rebuilt'))
+
+
+@app.cli.command('import-statement')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--phone', required=True, help='Phone of the user.')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv')
+@click.option('--account', help='Account for rows without one.')
+@click.option('--group', help='Group for rows without one.')
+@click.option('--category', help='Category for rows without one.')
+@click.option('--party', help='Party for rows without one.')
+def import_statement_command(path, phone, fmt, account, group, category,
+                             party):
+    """Import bank statement from CSV or OFX file."""
+    user = User.query.filter_by(phone=phone).first()
+    if user is None:
+        raise click.ClickException('No user with phone {}'.format(phone))
+    parse = parse_ofx if fmt == 'ofx' else parse_csv
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        try:
+            count = import_statement(
+                user, parse(f), account=account, group=group,
+                category=category, party=party,
+                chunk_size=app.config['IMPORT_CHUNK_SIZE'])
+        except StatementError as e:
+            raise click.ClickException(str(e))
+    click.echo('{} transactions imported'.format(count))
+
+
+@app.cli.command('export')
+@click.option('--phone', required=True, help='Phone of the user.')
+@click.option('--kind', type=click.Choice(exporter.KINDS),
+              default='transactions')
+@click.option('--format', 'fmt', type=click.Choice(exporter.FORMATS),
+              default='csv')
+@click.option('--gzip', is_flag=True, help='Compress output with gzip.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Output file, standard output by default.')
+def export_command(phone, kind, fmt, gzip, output):
+    """Export all transactions or transfers of user."""
+    user = User.query.filter_by(phone=phone).first()
+    if user is None:
+        raise click.ClickException('No user with phone {}'.format(phone))
+    chunks = exporter.export(user.id, kind, fmt, gzip)
+    if output:
+        f = open(output, 'wb') if gzip else open(output, 'w', newline='')
+    else:
+        f = sys.stdout.buffer if gzip else sys.stdout
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+    finally:
+        if output:
+            f.close()
+
+
+@app.cli.command('migrate-money')
+def migrate_money():
+    """Convert money columns of existing database from floats to integers
+    of minor units. Safe to run more than once.
+    """
+    converted = migrate_float_columns(db.engine, db.metadata)
+    click.echo('Converted tables: {}'.format(', '.join(converted) or 'none'))
+
+
+@app.cli.command('checkpoint-balances')
+def checkpoint_balances():
+    """Recreate month-end balance checkpoints of all accounts.
+    Run it after the turn of month, so new months get their checkpoints.
+    """
+    count = BalanceCheckpoint.refresh()
+    click.echo('{} checkpoint(s) created'.format(count))
+
+
+@app.cli.command('reconcile')
+@click.option('--fix', 'apply_fix', is_flag=True,
+              help='Correct stored values.')
+@click.option('--shards', default=1, help='Split users into N shards.')
+@click.option('--jobs', 'threads', default=1,
+              help='Check N shards at once.')
+@click.option('--init-opening', is_flag=True,
+              help='Take current balances as correct and derive opening '
+                   'balances of accounts from them.')
+@click.option('--background', is_flag=True,
+              help='Queue as a job for workers instead.')
+def reconcile_command(apply_fix, shards, threads, init_opening, background):
+    """Recompute account balances and usage statistics from the ledger."""
+    if init_opening:
+        count = reconcile.init_opening_balances()
+        click.echo('Opening balances set for {} account(s)'.format(count))
+        return
+    if background:
+        job = jobs.enqueue('reconcile', shards=shards, apply_fix=apply_fix)
+        click.echo('Job {} queued'.format(job.id))
+        return
+    found = reconcile.reconcile(app, shards=shards, jobs=threads,
+                                apply_fix=apply_fix)
+    for d in found:
+        click.echo('{} id={} user={} {}: stored {} actual {}'.format(
+            d.table, d.id, d.user_id, d.field, d.stored, d.actual))
+    click.echo('{} discrepancies{}'.format(
+        len(found), ', fixed' if apply_fix and found else ''))
+
+
+@app.cli.command('search-index')
+def search_index():
+    """Rebuild full-text search index of transactions."""
+    count = search.rebuild()
+    click.echo('{} transaction(s) indexed'.format(count))
+
+
+@app.cli.command('load-rates')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+def load_rates(paths):
+    """Load exchange rates from CSV files with header date,base,quote,rate.
+    Rates already loaded for the same pair and date are replaced.
+    """
+    count = 0
+    for path in paths:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            try:
+                count += ExchangeRate.load(list(parse_rates(f)))
+            except ValueError as e:
+                db.session.rollback()
+                raise click.ClickException('{}: {}'.format(path, e))
+    db.session.commit()
+    rates.invalidate()
+    click.echo('{} rate(s) loaded'.format(count))
+
+
+@app.cli.command('run-recurring')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Create occurrences due by date, today by default.')
+def run_recurring(until):
+    """Create transactions of all due recurring transactions.
+    Safe to run more than once, missed occurrences are caught up.
+    """
+    try:
+        count = scheduler.materialize(until=until and until.date())
+    except IntegrityError:
+        raise click.ClickException('Another run created the same '
+                                   'occurrences, nothing created')
+    click.echo('{} transaction(s) created'.format(count))
+
+
+@app.cli.command('password-bench')
+@click.option('--method', type=click.Choice(['scrypt', 'pbkdf2']),
+              default='scrypt')
+@click.option('--target', default=250,
+              help='Longest acceptable hashing time, milliseconds.')
+def password_bench(method, target):
+    """Measure password hashing costs and pick PASSWORD_METHOD that fits
+    the target time on this machine.
+    """
+    best = None
+    for candidate, elapsed in benchmark(method, target / 1000):
+        click.echo('{:<28} {:8.1f} ms'.format(candidate, elapsed * 1000))
+        if elapsed <= target / 1000:
+            best = candidate
+    if best is None:
+        raise click.ClickException('Even the lowest cost is over target')
+    click.echo('PASSWORD_METHOD={}'.format(best))
+
+
+@app.cli.command('worker')
+@click.option('--processes', default=1, help='Worker processes to run.')
+@click.option('--burst', is_flag=True, help='Exit when no job is due.')
+def worker(processes, burst):
+    """Run background jobs, see app.jobs. TERM or Ctrl+C stops workers
+    after their current jobs.
+    """
+    if processes == 1:
+        jobs.stop_on_signals()
+        count = jobs.work(burst=burst)
+        click.echo('{} job(s) run'.format(count))
+        return
+    context = multiprocessing.get_context('spawn')
+    children = [context.Process(target=run_worker, args=(config, burst),
+                                name='worker-{}'.format(i))
+                for i in range(processes)]
+    for child in children:
+        child.start()
+
+    def stop(signum, frame):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()
@@ -0,0 +1,26 @@
+"""Gunicorn settings, overridden by WEB_* environment variables.
+
+Threaded workers (gthread) keep serving other requests while a thread
+waits for a slow report or export. Every worker process has its own
+connection pool, sized to its request threads plus the offload pool
+(see app.offload) unless DB_POOL_SIZE is given.
+"""
+import multiprocessing
+import os
+
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_WORKERS',
+                             min(multiprocessing.cpu_count(), 4)))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then, spread so they do not restart together
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('WEB_ACCESS_LOG')
+
+os.environ.setdefault('DB_POOL_SIZE', str(
+    threads + int(os.environ.get('OFFLOAD_WORKERS', 4))))
@@ -0,0 +1,401 @@
+"""Initial schema
+
+Tables as created by db.create_all(), with the full-text search index of
+transactions on SQLite and PostgreSQL.
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 10:49:38.472042
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from app import money
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# Search index as of this revision, kept here so that later changes of
+# app.transaction.search do not change what the revision creates.
+# Owner column holds token 'u<user id>', so the index itself narrows
+# matches down to one user
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+        owner, comment, party, grp, category,
+        tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_insert
+        AFTER INSERT ON transactions BEGIN
+        INSERT INTO transactions_fts (rowid, owner, comment, party, grp,
+                                      category)
+        VALUES (new.id, 'u' || new.user_id, new.comment,
+                (SELECT party FROM parties WHERE id = new.party_id),
+                (SELECT "group" FROM groups WHERE id = new.group_id),
+                (SELECT category FROM categories
+                 WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_update
+        AFTER UPDATE OF comment, party_id, group_id, category_id
+        ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.id;
+        INSERT INTO transactions_fts (rowid, owner, comment, party, grp,
+                                      category)
+        VALUES (new.id, 'u' || new.user_id, new.comment,
+                (SELECT party FROM parties WHERE id = new.party_id),
+                (SELECT "group" FROM groups WHERE id = new.group_id),
+                (SELECT category FROM categories
+                 WHERE id = new.category_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transactions_fts_delete
+        AFTER DELETE ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS parties_fts_update
+        AFTER UPDATE OF party ON parties BEGIN
+        UPDATE transactions_fts SET party = new.party WHERE rowid IN
+            (SELECT id FROM transactions WHERE party_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS groups_fts_update
+        AFTER UPDATE OF "group" ON groups BEGIN
+        UPDATE transactions_fts SET grp = new."group" WHERE rowid IN
+            (SELECT id FROM transactions WHERE group_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS categories_fts_update
+        AFTER UPDATE OF category ON categories BEGIN
+        UPDATE transactions_fts SET category = new.category WHERE rowid IN
+            (SELECT id FROM transactions WHERE category_id = new.id);
+    END""",
+]
+
+SQLITE_DROP = ['DROP TABLE IF EXISTS transactions_fts'] + [
+    'DROP TRIGGER IF EXISTS {}'.format(name) for name in (
+        'transactions_fts_insert', 'transactions_fts_update',
+        'transactions_fts_delete', 'parties_fts_update', 'groups_fts_update',
+        'categories_fts_update')]
+
+POSTGRES_DDL = [
+    """CREATE TABLE IF NOT EXISTS transaction_search (
+        id INTEGER PRIMARY KEY REFERENCES transactions (id)
+            ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        document TSVECTOR NOT NULL)""",
+    """CREATE INDEX IF NOT EXISTS ix_transaction_search_document
+        ON transaction_search USING GIN (document)""",
+    """CREATE INDEX IF NOT EXISTS ix_transaction_search_user_id
+        ON transaction_search (user_id)""",
+    """CREATE OR REPLACE FUNCTION transaction_search_document(
+            comment TEXT, party_id INTEGER, group_id INTEGER,
+            category_id INTEGER) RETURNS TSVECTOR AS $$
+        SELECT setweight(to_tsvector('simple', coalesce($1, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT party FROM parties WHERE id = $2), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT "group" FROM groups WHERE id = $3), '')), 'C') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT category FROM categories WHERE id = $4), '')), 'C')
+    $$ LANGUAGE SQL STABLE""",
+    """CREATE OR REPLACE FUNCTION transaction_search_sync()
+        RETURNS TRIGGER AS $$
+    BEGIN
+        INSERT INTO transaction_search (id, user_id, document)
+        VALUES (NEW.id, NEW.user_id, transaction_search_document(
+            NEW.comment, NEW.party_id, NEW.group_id, NEW.category_id))
+        ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION transaction_search_reference()
+        RETURNS TRIGGER AS $$
+    BEGIN
+        EXECUTE format('UPDATE transaction_search s SET document = '
+            'transaction_search_document(t.comment, t.party_id, '
+            't.group_id, t.category_id) FROM transactions t '
+            'WHERE s.id = t.id AND t.%I = $1', TG_ARGV[0]) USING NEW.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS transaction_search_sync ON transactions',
+    """CREATE TRIGGER transaction_search_sync
+        AFTER INSERT OR UPDATE OF comment, party_id, group_id, category_id
+        ON transactions
+        FOR EACH ROW EXECUTE PROCEDURE transaction_search_sync()""",
+] + [statement.format(table=table, column=column)
+     for table, column in (('parties', 'party'), ('groups', 'group'),
+                           ('categories', 'category'))
+     for statement in (
+        'DROP TRIGGER IF EXISTS transaction_search_reference ON {table}',
+        """CREATE TRIGGER transaction_search_reference
+            AFTER UPDATE OF "{column}" ON {table}
+            FOR EACH ROW EXECUTE PROCEDURE
+            transaction_search_reference('{column}_id')""")]
+
+POSTGRES_DROP = ['DROP TABLE IF EXISTS transaction_search CASCADE']
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('currency',
+    sa.Column('currency', sa.String(length=10), nullable=True),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('currency', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_currency_currency'), ['currency'], unique=True)
+
+    op.create_table('users',
+    sa.Column('phone', sa.String(length=20), nullable=False),
+    sa.Column('password_hash', sa.String(length=128), nullable=False),
+    sa.Column('last_seen', sa.DateTime(), nullable=False),
+    sa.Column('refs_version', sa.Integer(), nullable=False),
+    sa.Column('ledger_version', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('times_used', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_users_phone'), ['phone'], unique=True)
+
+    op.create_table('accounts',
+    sa.Column('account', sa.String(length=128), nullable=False),
+    sa.Column('balance', money.Fixed(2), nullable=False),
+    sa.Column('opening_balance', money.Fixed(2), nullable=False),
+    sa.Column('currency_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('times_used', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['currency_id'], ['currency.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('accounts', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_accounts_account'), ['account'], unique=False)
+
+    op.create_table('categories',
+    sa.Column('category', sa.String(length=128), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('times_used', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('categories', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_categories_category'), ['category'], unique=False)
+
+    op.create_table('exchange_rates',
+    sa.Column('base_id', sa.Integer(), nullable=False),
+    sa.Column('quote_id', sa.Integer(), nullable=False),
+    sa.Column('rdate', sa.Date(), nullable=False),
+    sa.Column('rate', money.Fixed(8), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['base_id'], ['currency.id'], ),
+    sa.ForeignKeyConstraint(['quote_id'], ['currency.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('base_id', 'quote_id', 'rdate', name='uq_exchange_rates_key')
+    )
+    op.create_table('groups',
+    sa.Column('group', sa.String(length=128), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('times_used', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('groups', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_groups_group'), ['group'], unique=False)
+
+    op.create_table('parties',
+    sa.Column('party', sa.String(length=128), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('times_used', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('parties', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_parties_party'), ['party'], unique=False)
+
+    op.create_table('balance_checkpoints',
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('balance', money.Fixed(2), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('account_id', 'month', name='uq_balance_checkpoints_key')
+    )
+    op.create_table('monthly_totals',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('minus', sa.Boolean(), nullable=False),
+    sa.Column('amount', money.Fixed(2), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'month', 'category_id', 'account_id', 'minus', name='uq_monthly_totals_key')
+    )
+    op.create_table('recurring_transactions',
+    sa.Column('frequency', sa.String(length=10), nullable=False),
+    sa.Column('interval', sa.Integer(), nullable=False),
+    sa.Column('start_date', sa.Date(), nullable=False),
+    sa.Column('end_date', sa.Date(), nullable=True),
+    sa.Column('next_date', sa.Date(), nullable=False),
+    sa.Column('sequence', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.Column('amount', money.Fixed(2), nullable=False),
+    sa.Column('minus', sa.Boolean(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('group_id', sa.Integer(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('party_id', sa.Integer(), nullable=False),
+    sa.Column('comment', sa.String(length=128), nullable=True),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ),
+    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+    sa.ForeignKeyConstraint(['party_id'], ['parties.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('recurring_transactions', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_recurring_transactions_next_date'), ['next_date'], unique=False)
+        batch_op.create_index(batch_op.f('ix_recurring_transactions_user_id'), ['user_id'], unique=False)
+
+    op.create_table('transactions',
+    sa.Column('tdate', sa.Date(), nullable=False),
+    sa.Column('amount', money.Fixed(2), nullable=False),
+    sa.Column('minus', sa.Boolean(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=False),
+    sa.Column('group_id', sa.Integer(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('party_id', sa.Integer(), nullable=False),
+    sa.Column('comment', sa.String(length=128), nullable=True),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['category_id'], ['categories.id'], ),
+    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+    sa.ForeignKeyConstraint(['party_id'], ['parties.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('ix_transactions_account_tdate_id', ['account_id', 'tdate', 'id'], unique=False)
+        batch_op.create_index('ix_transactions_category_tdate_id', ['category_id', 'tdate', 'id'], unique=False)
+        batch_op.create_index('ix_transactions_group_tdate_id', ['group_id', 'tdate', 'id'], unique=False)
+        batch_op.create_index('ix_transactions_party_tdate_id', ['party_id', 'tdate', 'id'], unique=False)
+        batch_op.create_index('ix_transactions_user_tdate_id', ['user_id', 'tdate', 'id'], unique=False)
+
+    op.create_table('transfers',
+    sa.Column('from_account_id', sa.Integer(), nullable=False),
+    sa.Column('to_account_id', sa.Integer(), nullable=False),
+    sa.Column('tdate', sa.Date(), nullable=False),
+    sa.Column('amount', money.Fixed(2), nullable=False),
+    sa.Column('coef', money.Fixed(6), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['from_account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['to_account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('transfers', schema=None) as batch_op:
+        batch_op.create_index('ix_transfers_from_account_tdate', ['from_account_id', 'tdate'], unique=False)
+        batch_op.create_index('ix_transfers_to_account_tdate', ['to_account_id', 'tdate'], unique=False)
+        batch_op.create_index('ix_transfers_user_tdate', ['user_id', 'tdate'], unique=False)
+
+    op.create_table('recurring_occurrences',
+    sa.Column('recurring_id', sa.Integer(), nullable=False),
+    sa.Column('odate', sa.Date(), nullable=False),
+    sa.ForeignKeyConstraint(['recurring_id'], ['recurring_transactions.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('recurring_id', 'odate')
+    )
+    # ### end Alembic commands ###
+    for statement in search_ddl(SQLITE_DDL, POSTGRES_DDL):
+        op.execute(statement)
+
+
+def downgrade():
+    for statement in search_ddl(SQLITE_DROP, POSTGRES_DROP):
+        op.execute(statement)
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('recurring_occurrences')
+    with op.batch_alter_table('transfers', schema=None) as batch_op:
+        batch_op.drop_index('ix_transfers_user_tdate')
+        batch_op.drop_index('ix_transfers_to_account_tdate')
+        batch_op.drop_index('ix_transfers_from_account_tdate')
+
+    op.drop_table('transfers')
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_transactions_user_tdate_id')
+        batch_op.drop_index('ix_transactions_party_tdate_id')
+        batch_op.drop_index('ix_transactions_group_tdate_id')
+        batch_op.drop_index('ix_transactions_category_tdate_id')
+        batch_op.drop_index('ix_transactions_account_tdate_id')
+
+    op.drop_table('transactions')
+    with op.batch_alter_table('recurring_transactions', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_recurring_transactions_user_id'))
+        batch_op.drop_index(batch_op.f('ix_recurring_transactions_next_date'))
+
+    op.drop_table('recurring_transactions')
+    op.drop_table('monthly_totals')
+    op.drop_table('balance_checkpoints')
+    with op.batch_alter_table('parties', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_parties_party'))
+
+    op.drop_table('parties')
+    with op.batch_alter_table('groups', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_groups_group'))
+
+    op.drop_table('groups')
+    op.drop_table('exchange_rates')
+    with op.batch_alter_table('categories', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_categories_category'))
+
+    op.drop_table('categories')
+    with op.batch_alter_table('accounts', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_accounts_account'))
+
+    op.drop_table('accounts')
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_users_phone'))
+
+    op.drop_table('users')
+    with op.batch_alter_table('currency', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_currency_currency'))
+
+    op.drop_table('currency')
+    # ### end Alembic commands ###
+
+
+def search_ddl(sqlite, postgresql):
+    """Return statements for the dialect migrated, none for others."""
+    name = op.get_context().dialect.name
+    return {'sqlite': sqlite, 'postgresql': postgresql}.get(name, [])
@@ -0,0 +1,35 @@
+"""Longer password hashes
+
+Hashes of scrypt, the default PASSWORD_METHOD, are 162 characters long and
+do not fit into VARCHAR(128) on PostgreSQL.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 12:02:14.508113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password_hash',
+                              existing_type=sa.String(length=128),
+                              type_=sa.String(length=256),
+                              existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password_hash',
+                              existing_type=sa.String(length=256),
+                              type_=sa.String(length=128),
+                              existing_nullable=False)
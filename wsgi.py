@@ -0,0 +1,13 @@
+"""Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The profile is taken from FINEXP_CONFIG, 'production' by default, which
+needs SECRET_KEY in the environment.
+"""
+import os
+
+from app import create_app
+
+
+app = create_app(os.environ.get('FINEXP_CONFIG', 'production'))